@@ -2,13 +2,14 @@
 # app/streamlit_app.py
 import sys
 import math
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
 # Make sure src is importable
 sys.path.append(str(Path(__file__).resolve().parents[1]))
 
 import streamlit as st
-from src.pipeline.chain import load_chain
+from src.pipeline.registry import ChainRegistry
 from src.utils.report import generate_pdf_report
 
 
@@ -52,6 +53,19 @@ def get_selected() -> Path | None:
     p = st.session_state.get("selected_path")
     return Path(p) if p else None
 
+@st.cache_resource
+def index_builder() -> dict:
+    """Single background worker (and its last job) for index rebuilds, shared across reruns."""
+    return {"pool": ThreadPoolExecutor(max_workers=1), "job": None}
+
+@st.cache_resource
+def chain_registry() -> ChainRegistry:
+    """
+    One compiled chain per server process, shared across reruns and sessions.
+    The registry rebuilds it only when config/config.yaml changes.
+    """
+    return ChainRegistry()
+
 
 # ------------------------- Layout -------------------------
 left, right = st.columns([1, 1], gap="large")
@@ -135,45 +149,45 @@ with right:
             st.error("Please upload or select an image first.")
         else:
             with st.spinner("Running analysis..."):
-                chain = load_chain()
+                chain = chain_registry().get()
                 results = chain.invoke({"image_path": str(selected_path)})
 
             # ------------------------- Score card -------------------------
             st.markdown("### Fraud Likelihood")
-            score = float(results.get("final_score", 0.0))
+            score = results.final_score
             color_class = "score-ok" if score < 0.35 else ("score-warn" if score < 0.65 else "score-bad")
             st.markdown(
                 f"<div class='card'><h2 class='{color_class}'>Score: {score:.2f}</h2>"
                 f"<span class='badge'>0 (low) → 1 (high)</span></div>",
                 unsafe_allow_html=True
             )
+            if results.stage == "preview":
+                st.caption("Decided on the low-resolution preview (below the escalation threshold).")
+            elif results.preview_score is not None:
+                st.caption(f"Escalated to full resolution (preview score {results.preview_score:.2f}).")
 
             # ------------------------- Explanation -------------------------
             st.markdown("### Explanation")
-            st.code(results.get("explanation", ""), language="text")
+            st.code(results.explanation, language="text")
 
             # ------------------------- Visual Overlays -------------------------
             st.markdown("### Visual Overlays")
             tabs = st.tabs(["ELA", "Noise", "Edges"])
-            overlays = [("ELA", "ela_overlay"), ("Noise", "noise_overlay"), ("Edges", "edges_overlay")]
+            overlays = [("ELA", results.ela.overlay), ("Noise", results.noise.overlay), ("Edges", results.edges.overlay)]
 
-            for tab, (label, key) in zip(tabs, overlays):
+            for tab, (label, overlay) in zip(tabs, overlays):
                 with tab:
-                    overlay = results.get(key)
                     if overlay is None:
                         st.info("No overlay available.")
                     else:
                         try:
-                            st.image(overlay, caption=f"{label} overlay", use_column_width=True)
+                            st.image(overlay.array, caption=f"{label} overlay", use_column_width=True)
                         except Exception:
-                            if isinstance(overlay, dict) and overlay.get("path"):
-                                st.image(overlay["path"], caption=f"{label} overlay", use_column_width=True)
-                            else:
-                                st.info("Overlay could not be displayed.")
+                            st.info("Overlay could not be displayed.")
 
             # ------------------------- Similar cases -------------------------
             st.markdown("### Similar Damage Images (pHash)")
-            sims = results.get("similar", [])
+            sims = results.similar
             if sims:
                 sim_cols = st.columns(min(len(sims), 4))
                 for i, s in enumerate(sims):
@@ -182,6 +196,8 @@ with right:
                         label = s.get("label", "n/a")
                         dist = s.get("distance", "n/a")
                         caption = f"{Path(tpath).name}\nlabel={label}, dist={dist}"
+                        if s.get("cluster_size", 1) > 1:
+                            caption += f"\nnear-duplicate cluster of {s['cluster_size']}"
                         if tpath and Path(tpath).exists():
                             st.image(str(tpath), caption=caption, use_column_width=True)
                         else:
@@ -189,6 +205,23 @@ with right:
             else:
                 st.info("No similar entries found—try rebuilding the index or adding more dataset images.")
 
+            # ------------------------- Timings -------------------------
+            timings = results.timings
+            with st.expander(f"Timings · {timings.get('total', 0.0) * 1e3:.0f} ms total"):
+                rows = []
+                for stage in ("read", "ela", "noise", "edges", "exif", "similar", "aggregate", "preview"):
+                    if stage not in timings:
+                        continue
+                    row = {"stage": stage, "total ms": round(timings[stage] * 1e3, 1)}
+                    for ph in ("decode", "load", "cache", "serialize", "compute"):
+                        row[f"{ph} ms"] = round(timings.get(f"{stage}.{ph}", 0.0) * 1e3, 1)
+                    if f"{stage}.peak_mb" in timings:
+                        row["peak MB"] = round(timings[f"{stage}.peak_mb"], 1)
+                    rows.append(row)
+                st.dataframe(rows, use_container_width=True, hide_index=True)
+                st.caption("Branches run in parallel, so stage totals overlap. "
+                           "Enable profiling.trace_memory in config.yaml for per-stage peak allocation.")
+
             # ------------------------- Report export -------------------------
             st.divider()
             st.subheader("3) Export Report")
@@ -212,14 +245,27 @@ img_count = len(list_images(active_ds))
 st.sidebar.success(f"Dataset path: `{active_ds}`")
 st.sidebar.write(f"Images found: **{img_count}**")
 
-if st.sidebar.button("Rebuild Hash Index"):
+index_job = index_builder().get("job")
+if index_job is not None and not index_job.done():
+    st.sidebar.info("Index update running in the background…")
+    st.sidebar.button("Refresh status")
+elif st.sidebar.button("Rebuild Hash Index"):
+    from src.retrieval.build_index import build_index
+    # Incremental build on a background thread so the UI stays responsive
+    index_builder()["job"] = index_builder()["pool"].submit(build_index, image_dir=str(active_ds))
+    st.rerun()
+elif index_job is not None:
     try:
-        from src.retrieval.build_index import build_index
-        try:
-            build_index(image_dir=str(active_ds))  # If signature supports image_dir
-        except TypeError:
-            build_index()  # Fallback to default
-        st.sidebar.success("Index rebuilt.")
+        report = index_job.result()
+        st.sidebar.success(
+            f"Index updated: +{report.added} added, {report.updated} updated, "
+            f"{report.removed} removed, {report.unchanged} unchanged."
+        )
+        if report.failed:
+            st.sidebar.warning(f"{len(report.failed)} file(s) could not be hashed.")
+            with st.sidebar.expander("Failed files"):
+                for path, error in report.failed:
+                    st.write(f"`{Path(path).name}` — {error}")
     except Exception as e:
         st.sidebar.error(f"Index rebuild failed: {e}")
 
@@ -0,0 +1,151 @@
+
+# benchmarks/bench_retrieval.py
+#
+# Linear scan vs multi-index hashing on synthetic pHash indexes, and the
+# descriptor IVF index (embedding backend) against the pHash scan.
+#   python benchmarks/bench_retrieval.py --sizes 10000 100000 1000000
+#   python benchmarks/bench_retrieval.py --embed --sizes 10000 100000 1000000
+
+import argparse
+import sys
+import time
+from pathlib import Path
+
+import numpy as np
+
+sys.path.append(str(Path(__file__).resolve().parents[1]))
+
+from src.retrieval.embedding import DIM, EmbeddingIndex
+from src.retrieval.packed_index import PackedIndex
+
+
+def synthetic_index(n: int, seed: int = 0, dup_rate: float = 0.01) -> PackedIndex:
+    """Random 64-bit hashes with a share of planted near-duplicates (1-10 bit flips)."""
+    rng = np.random.default_rng(seed)
+    hashes = rng.integers(0, 2**63, n, dtype=np.int64).astype(np.uint64) ^ (
+        rng.integers(0, 2, n, dtype=np.int64).astype(np.uint64) << np.uint64(63))
+    n_dup = int(n * dup_rate)
+    if n_dup:
+        src = rng.integers(0, n, n_dup)
+        masks = np.zeros(n_dup, dtype=np.uint64)
+        for i, k in enumerate(rng.integers(1, 11, n_dup)):
+            for b in rng.choice(64, k, replace=False):
+                masks[i] |= np.uint64(1) << np.uint64(int(b))
+        hashes[rng.integers(0, n, n_dup)] = hashes[src] ^ masks
+    entries = [{"path": f"synthetic_{i}.jpg", "label": "synthetic"} for i in range(n)]
+    return PackedIndex(hashes, entries)
+
+
+def _per_query(fn, queries) -> float:
+    start = time.perf_counter()
+    for q in queries:
+        fn(q)
+    return (time.perf_counter() - start) / len(queries)
+
+
+def bench_retrieval(sizes, n_queries: int = 50, top_k: int = 4, radius: int = 10, bands: int = 4):
+    rows = []
+    for n in sizes:
+        index = synthetic_index(n)
+        rng = np.random.default_rng(1)
+        # half the queries are near-duplicates of indexed hashes, half are random
+        queries = [int(index.hashes[i] ^ np.uint64(1 << int(rng.integers(0, 64)))) for i in rng.integers(0, n, n_queries // 2)]
+        queries += [int(x) for x in rng.integers(0, 2**63, n_queries - len(queries), dtype=np.int64)]
+
+        start = time.perf_counter()
+        index.mih(bands)
+        build = time.perf_counter() - start
+
+        for label, kwargs in (("top_k", {"top_k": top_k}), (f"radius<={radius}", {"top_k": top_k, "max_distance": radius})):
+            for q in queries[:5]:
+                assert index.nearest(q, backend="mih", bands=bands, **kwargs) == index.nearest(q, **kwargs)
+            linear = _per_query(lambda q: index.topk(q, **kwargs), queries)
+            mih = _per_query(lambda q: index.topk(q, backend="mih", bands=bands, **kwargs), queries)
+            rows.append({"entries": n, "query": label, "linear_ms": linear * 1e3, "mih_ms": mih * 1e3,
+                         "speedup": linear / mih if mih else float("inf"), "mih_build_s": build})
+    return rows
+
+
+def synthetic_embeddings(n: int, seed: int = 0, groups: int = 1000) -> np.ndarray:
+    """
+    Unit-length non-negative float16 descriptors shaped like embed_image()
+    output: noisy copies of `groups` random prototypes (similar scenes).
+    """
+    rng = np.random.default_rng(seed)
+    protos = rng.gamma(0.5, 1.0, (groups, DIM)).astype(np.float32)
+    out = np.empty((n, DIM), dtype=np.float16)
+    for start in range(0, n, 1 << 16):
+        m = min(1 << 16, n - start)
+        x = protos[rng.integers(0, groups, m)] + rng.gamma(0.5, 0.5, (m, DIM)).astype(np.float32)
+        out[start:start + m] = x / np.linalg.norm(x, axis=1, keepdims=True)
+    return out
+
+
+def bench_embedding(sizes, n_queries: int = 50, top_k: int = 4, nprobe: int = 8):
+    """
+    Per-query latency of the IVF descriptor index (and of an exact scan over the
+    same descriptors) next to the linear pHash scan, with recall@top_k of the IVF
+    result against the exact one and the bytes each entry costs on disk / in RAM.
+    """
+    rows = []
+    for n in sizes:
+        vectors = synthetic_embeddings(n)
+        start = time.perf_counter()
+        ivf = EmbeddingIndex.from_vectors(vectors, np.arange(n), np.zeros(n, dtype=np.uint64))
+        build = time.perf_counter() - start
+        flat = EmbeddingIndex.from_vectors(vectors, np.arange(n), np.zeros(n, dtype=np.uint64),
+                                           centroids=np.full((1, DIM), DIM ** -0.5, dtype=np.float32))
+        del vectors
+
+        rng = np.random.default_rng(1)
+        # re-photographed stand-ins: indexed descriptors with a little extra noise
+        picks = rng.integers(0, n, n_queries)
+        queries = [np.asarray(ivf.vectors[np.flatnonzero(ivf.ids == i)[0]], dtype=np.float32)
+                   + rng.normal(0, 0.01, DIM).astype(np.float32) for i in picks]
+        queries = [q / np.linalg.norm(q) for q in queries]
+        hits = sum(len(set(ivf.search(q, top_k, nprobe)[0].tolist()) & set(flat.search(q, top_k)[0].tolist()))
+                   for q in queries)
+
+        index = synthetic_index(n)
+        phash_queries = [int(h) for h in index.hashes[picks]]
+        rows.append({
+            "entries": n,
+            "phash_ms": _per_query(lambda q: index.topk(q, top_k), phash_queries) * 1e3,
+            "ivf_ms": _per_query(lambda q: ivf.search(q, top_k, nprobe), queries) * 1e3,
+            "flat_ms": _per_query(lambda q: flat.search(q, top_k), queries) * 1e3,
+            "recall": hits / (top_k * n_queries),
+            "phash_bytes": index.hashes.itemsize,
+            "embed_bytes": ivf.vectors.itemsize * DIM + ivf.ids.itemsize,
+            "nlist": ivf.nlist,
+            "build_s": build,
+        })
+    return rows
+
+
+def main():
+    ap = argparse.ArgumentParser(description="Benchmark linear vs multi-index Hamming search.")
+    ap.add_argument("--sizes", type=int, nargs="+", default=[10_000, 100_000, 1_000_000])
+    ap.add_argument("--queries", type=int, default=50)
+    ap.add_argument("--radius", type=int, default=10)
+    ap.add_argument("--bands", type=int, default=4)
+    ap.add_argument("--embed", action="store_true", help="descriptor IVF index vs the pHash scan instead")
+    ap.add_argument("--nprobe", type=int, default=8)
+    args = ap.parse_args()
+
+    if args.embed:
+        print(f"{'entries':>9} {'phash ms':>9} {'ivf ms':>8} {'flat ms':>8} {'recall':>7} "
+              f"{'B/entry phash':>14} {'B/entry embed':>14} {'nlist':>6} {'build s':>8}")
+        for r in bench_embedding(args.sizes, args.queries, nprobe=args.nprobe):
+            print(f"{r['entries']:>9} {r['phash_ms']:>9.3f} {r['ivf_ms']:>8.3f} {r['flat_ms']:>8.3f} "
+                  f"{r['recall']:>7.3f} {r['phash_bytes']:>14} {r['embed_bytes']:>14} {r['nlist']:>6} "
+                  f"{r['build_s']:>8.2f}")
+        return
+
+    print(f"{'entries':>9} {'query':>12} {'linear ms':>10} {'mih ms':>8} {'speedup':>8} {'mih build s':>12}")
+    for r in bench_retrieval(args.sizes, args.queries, radius=args.radius, bands=args.bands):
+        print(f"{r['entries']:>9} {r['query']:>12} {r['linear_ms']:>10.3f} {r['mih_ms']:>8.3f} "
+              f"{r['speedup']:>8.1f} {r['mih_build_s']:>12.3f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,253 @@
+
+# benchmarks/run_benchmarks.py
+#
+# Analyzer, retrieval and end-to-end benchmarks on synthetic data, with a JSON
+# baseline to compare later runs against.
+#   python benchmarks/run_benchmarks.py --save benchmarks/baseline.json
+#   python benchmarks/run_benchmarks.py --compare benchmarks/baseline.json
+#   python benchmarks/run_benchmarks.py --quick
+
+import argparse
+import json
+import platform
+import resource
+import statistics
+import sys
+import tempfile
+import time
+from io import BytesIO
+from pathlib import Path
+from typing import Any, Callable, Dict, List
+
+import numpy as np
+from PIL import Image
+
+sys.path.append(str(Path(__file__).resolve().parents[1]))
+
+from benchmarks.bench_retrieval import bench_retrieval, synthetic_index
+from src.retrieval.packed_index import index_exists
+from src.utils.pool import process_pool
+
+RESOLUTIONS = {"vga": (640, 480), "fhd": (1920, 1080), "12mp": (4000, 3000)}
+INDEX_SIZES = [1_000, 100_000, 1_000_000]
+
+# Units where a larger number is an improvement; everything else is a cost
+HIGHER_IS_BETTER = {"claims/s"}
+# Latencies this close are timer noise, whatever the relative change
+NOISE_FLOOR_MS = 0.1
+
+Metrics = Dict[str, Dict[str, Any]]
+
+
+def metric(metrics: Metrics, name: str, value: float, unit: str) -> None:
+    metrics[name] = {"value": round(float(value), 4), "unit": unit}
+
+
+# ----------------------------- Data -----------------------------
+def synthetic_image(width: int, height: int, seed: int = 0) -> bytes:
+    """
+    A JPEG claim photo stand-in: smooth gradients plus sensor-like noise, with
+    a patch pasted in from a lower-quality re-encode so ELA/noise have work to do.
+    """
+    rng = np.random.default_rng(seed)
+    yy, xx = np.mgrid[0:height, 0:width].astype(np.float32)
+    base = np.stack([128 + 90 * np.sin(xx / (37 + 11 * c) + yy / (53 + 7 * c) + seed) for c in range(3)], axis=-1)
+    base += rng.normal(0, 4, base.shape).astype(np.float32)
+    img = Image.fromarray(base.clip(0, 255).astype(np.uint8))
+
+    buf = BytesIO()
+    img.save(buf, format="JPEG", quality=60)
+    patch = Image.open(buf).crop((width // 4, height // 4, width // 2, height // 2))
+    img.paste(patch, (width // 3, height // 3))
+    out = BytesIO()
+    img.save(out, format="JPEG", quality=90)
+    return out.getvalue()
+
+
+def write_images(folder: Path, resolutions: Dict[str, tuple], per_resolution: int) -> Dict[str, List[str]]:
+    paths = {}
+    for name, (w, h) in resolutions.items():
+        paths[name] = []
+        for i in range(per_resolution):
+            p = folder / f"{name}_{i}.jpg"
+            p.write_bytes(synthetic_image(w, h, seed=i))
+            paths[name].append(str(p))
+    return paths
+
+
+def _median_seconds(fn: Callable[[], Any], repeat: int) -> float:
+    fn()  # warm-up: imports, scratch buffers, memory-mapped pages
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    return statistics.median(times)
+
+
+# ----------------------------- Suites -----------------------------
+def bench_analyzers(paths: Dict[str, List[str]], repeat: int) -> Metrics:
+    """Median latency of decode and of each analyzer, per resolution (scores only)."""
+    from src.analysis.context import ImageContext
+    from src.analysis.edges import edge_inconsistency
+    from src.analysis.ela import compute_ela
+    from src.analysis.exif import inspect_exif
+    from src.analysis.noise import block_noise_score
+    from src.retrieval.simple_hash import phash_image
+
+    analyzers = {
+        "ela": lambda ctx: compute_ela(ctx, 95, 30, want_overlays=False),
+        "noise": lambda ctx: block_noise_score(ctx, 16, want_overlays=False),
+        "edges": lambda ctx: edge_inconsistency(ctx, 16, want_overlays=False),
+        "exif": lambda ctx: inspect_exif(ctx),
+        "phash": phash_image,
+    }
+    metrics: Metrics = {}
+    for res, files in paths.items():
+        path = files[0]
+        metric(metrics, f"decode/{res}", 1e3 * _median_seconds(lambda: ImageContext.open(path).image, repeat), "ms")
+        decoded = ImageContext.open(path).image
+        for name, fn in analyzers.items():
+            # a fresh context per run, so derived planes (gray, rgb) are paid for every time
+            seconds = _median_seconds(lambda: fn(ImageContext(decoded, path=path)), repeat)
+            metric(metrics, f"analyzer/{name}/{res}", 1e3 * seconds, "ms")
+    return metrics
+
+
+def bench_index(sizes: List[int], queries: int) -> Metrics:
+    """Per-query latency of the linear scan and MIH on synthetic pHash indexes."""
+    metrics: Metrics = {}
+    for row in bench_retrieval(sizes, n_queries=queries):
+        query = "topk" if row["query"] == "top_k" else "radius"
+        metric(metrics, f"retrieval/linear/{query}/{row['entries']}", row["linear_ms"], "ms")
+        metric(metrics, f"retrieval/mih/{query}/{row['entries']}", row["mih_ms"], "ms")
+    return metrics
+
+
+def bench_chain(paths: List[str], index_size: int, workdir: str, rounds: int, want_overlays: bool) -> Metrics:
+    """End-to-end claims/sec of the (uncached) chain against a synthetic index."""
+    from src.pipeline.chain import load_chain
+    from src.utils.config import load_config
+
+    index_path = Path(workdir) / f"index_{index_size}.npy"
+    if not index_exists(index_path):
+        synthetic_index(index_size).save(index_path)
+    config = load_config()
+    config["cache"] = {"enabled": False}
+    config["retrieval"] = dict(config["retrieval"], hash_index_path=str(index_path))
+    chain = load_chain(config, want_overlays=want_overlays)
+
+    chain.invoke({"image_path": paths[0]})  # warm-up
+    start = time.perf_counter()
+    for _ in range(rounds):
+        for p in paths:
+            chain.invoke({"image_path": p})
+    elapsed = time.perf_counter() - start
+    mode = "overlays" if want_overlays else "scores"
+    metrics: Metrics = {}
+    metric(metrics, f"chain/{mode}/claims_per_s", rounds * len(paths) / elapsed, "claims/s")
+    return metrics
+
+
+def peak_rss_mb() -> float:
+    """
+    Peak resident set size of this process. VmHWM is per address space, so a
+    spawned worker doesn't inherit its parent's peak the way ru_maxrss does.
+    """
+    try:
+        with open("/proc/self/status", "r") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 2**10
+    except OSError:
+        pass
+    # ru_maxrss is KiB on Linux, bytes on macOS
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss / (2**20 if sys.platform == "darwin" else 2**10)
+
+
+def _isolated(label: str, fn: Callable[..., Metrics], *args) -> Metrics:
+    metrics = fn(*args)
+    metric(metrics, f"peak_rss/{label}", peak_rss_mb(), "MB")
+    return metrics
+
+
+def run_suite(label: str, fn: Callable[..., Metrics], *args) -> Metrics:
+    """Run one suite in a fresh interpreter and add that process's peak RSS."""
+    with process_pool(1) as pool:
+        return pool.submit(_isolated, label, fn, *args).result()
+
+
+# ----------------------------- Baselines -----------------------------
+def compare(current: Metrics, baseline: Metrics, tolerance: float) -> List[Dict[str, Any]]:
+    """
+    One row per metric present in both runs. `change` is the relative change in
+    the metric's own direction (positive = better); a row regresses when it got
+    worse by more than `tolerance` (and, for latencies, by more than NOISE_FLOOR_MS).
+    """
+    rows = []
+    for name in sorted(current.keys() & baseline.keys()):
+        now, base = current[name]["value"], baseline[name]["value"]
+        if not base:
+            continue
+        unit = current[name]["unit"]
+        change = (now - base) / base
+        if unit not in HIGHER_IS_BETTER:
+            change = -change
+        noise = unit == "ms" and abs(now - base) < NOISE_FLOOR_MS
+        rows.append({"name": name, "baseline": base, "current": now, "unit": unit,
+                     "change": change, "regressed": change < -tolerance and not noise})
+    return rows
+
+
+def main():
+    ap = argparse.ArgumentParser(description="Benchmark analyzers, retrieval and the end-to-end chain.")
+    ap.add_argument("--quick", action="store_true", help="small images and indexes only (vga/fhd, 1k/100k)")
+    ap.add_argument("--resolutions", nargs="+", choices=list(RESOLUTIONS), default=None)
+    ap.add_argument("--index-sizes", type=int, nargs="+", default=None)
+    ap.add_argument("--chain-index-size", type=int, default=100_000)
+    ap.add_argument("--repeat", type=int, default=5)
+    ap.add_argument("--queries", type=int, default=50)
+    ap.add_argument("--save", default=None, help="write results to this JSON baseline")
+    ap.add_argument("--compare", default=None, help="compare against a JSON baseline from --save")
+    ap.add_argument("--tolerance", type=float, default=0.15, help="allowed relative slowdown before failing")
+    args = ap.parse_args()
+
+    names = args.resolutions or (["vga", "fhd"] if args.quick else list(RESOLUTIONS))
+    sizes = args.index_sizes or (INDEX_SIZES[:2] if args.quick else INDEX_SIZES)
+    resolutions = {n: RESOLUTIONS[n] for n in names}
+
+    metrics: Metrics = {}
+    with tempfile.TemporaryDirectory(prefix="bench_") as workdir:
+        paths = write_images(Path(workdir), resolutions, per_resolution=2)
+        chain_paths = [p for files in paths.values() for p in files]
+        metrics.update(run_suite("analyzers", bench_analyzers, paths, args.repeat))
+        metrics.update(run_suite("retrieval", bench_index, sizes, args.queries))
+        for want_overlays in (False, True):
+            label = "chain/overlays" if want_overlays else "chain/scores"
+            metrics.update(run_suite(label, bench_chain, chain_paths, args.chain_index_size, workdir, 2, want_overlays))
+
+    for name, m in metrics.items():
+        print(f"{name:<40} {m['value']:>12.3f} {m['unit']}")
+
+    if args.save:
+        report = {"created": time.strftime("%Y-%m-%dT%H:%M:%S"), "python": platform.python_version(),
+                  "machine": platform.machine(), "metrics": metrics}
+        Path(args.save).write_text(json.dumps(report, indent=2), encoding="utf-8")
+        print(f"Saved baseline -> {args.save}")
+
+    if args.compare:
+        baseline = json.loads(Path(args.compare).read_text(encoding="utf-8"))["metrics"]
+        rows = compare(metrics, baseline, args.tolerance)
+        print(f"\n{'metric':<40} {'baseline':>12} {'current':>12} {'change':>8}")
+        for r in rows:
+            flag = "  REGRESSED" if r["regressed"] else ""
+            print(f"{r['name']:<40} {r['baseline']:>12.3f} {r['current']:>12.3f} {r['change']:>+8.1%}{flag}")
+        regressed = [r for r in rows if r["regressed"]]
+        if regressed:
+            print(f"{len(regressed)} metric(s) regressed by more than {args.tolerance:.0%}")
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
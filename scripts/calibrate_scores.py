@@ -1,55 +1,206 @@
-
-import csv, yaml
+import argparse, csv, os, re, sys, yaml
+from functools import partial
 from pathlib import Path
+from typing import Any, Dict, List, Optional, Sequence, Tuple
 import numpy as np
-from PIL import Image
 from sklearn.linear_model import LogisticRegression
-from sklearn.model_selection import train_test_split
+from sklearn.model_selection import StratifiedKFold, train_test_split
 from sklearn.metrics import roc_auc_score, classification_report
 
+from src.analysis.context import ImageContext
 from src.analysis.ela import compute_ela
 from src.analysis.noise import block_noise_score
 from src.analysis.edges import edge_inconsistency
 from src.analysis.exif import inspect_exif
+from src.pipeline.cache import analyzer_params, fingerprint
+from src.pipeline.tools import budget_bytes
+from src.retrieval.ingest import DIGEST_DTYPE, file_digests, sha256_file
+from src.utils.config import CONFIG_PATH, load_config, resolve_path
+from src.utils.pool import map_reported
 
-CFG_PATH = Path("config/config.yaml")
-CFG = yaml.safe_load(open(CFG_PATH, "r"))
+FEATURES = ("ela", "noise", "edges", "exif")
+FEATURE_CACHE = resolve_path("data/calibration/features.npz")
 
 
-def features(image_path: str):
-    img = Image.open(image_path).convert("RGB")
-    ela = compute_ela(img, CFG["analysis"]["ela_quality"], CFG["analysis"]["ela_threshold"])['score']
-    noise = block_noise_score(img, CFG["analysis"]["block_size"])['score']
-    edges = edge_inconsistency(img, CFG["analysis"]["block_size"])['score']
-    exif = inspect_exif(image_path, CFG["scoring"]["suspicious_software"])['score']
+def features(image_path: str, cfg: Dict[str, Any]):
+    ctx = ImageContext.open(image_path)
+    # scores only: overlays are never rendered
+    max_bytes = budget_bytes(cfg["analysis"])
+    ela = compute_ela(ctx, cfg["analysis"]["ela_quality"], cfg["analysis"]["ela_threshold"], want_overlays=False,
+                      max_bytes=max_bytes, backend=cfg["analysis"].get("ela_backend", "pil"))['score']
+    noise = block_noise_score(ctx, cfg["analysis"]["block_size"], want_overlays=False, max_bytes=max_bytes)['score']
+    edges = edge_inconsistency(ctx, cfg["analysis"]["block_size"], want_overlays=False, max_bytes=max_bytes)['score']
+    exif = inspect_exif(ctx, cfg["scoring"]["suspicious_software"])['score']
     return [ela, noise, edges, exif]
 
 
-def main():
-    labels_csv = Path("data/calibration/labels.csv")
-    if not labels_csv.exists():
-        print("Create data/calibration/labels.csv with columns: image_path,label")
-        return
-    rows = list(csv.DictReader(open(labels_csv, "r")))
-    X, y = [], []
-    for r in rows:
-        X.append(features(r['image_path']))
-        y.append(1 if r['label']=='manipulated' else 0)
-    X = np.array(X); y = np.array(y)
+# ----------------------------- Feature cache -----------------------------
+def feature_fingerprint(cfg: Dict[str, Any]) -> str:
+    """Changes only with the config values the four features depend on (not the scoring weights)."""
+    params = analyzer_params(cfg)
+    return fingerprint("calibration", {name: params[name] for name in FEATURES})
+
+
+def load_feature_cache(path: Path, fp: str) -> Tuple[Dict[str, np.ndarray], np.ndarray]:
+    """
+    (digest -> feature row, DIGEST_DTYPE stamps of the files hashed so far).
+    The rows are {} when the file is missing or was built with other analysis
+    settings; the stamps only depend on the files, so they are kept either way.
+    """
+    if not path.exists():
+        return {}, np.zeros(0, dtype=DIGEST_DTYPE)
+    with np.load(path) as npz:
+        stamps = npz["stamps"] if "stamps" in npz.files else np.zeros(0, dtype=DIGEST_DTYPE)
+        if str(npz["fingerprint"]) != fp:
+            return {}, stamps
+        return dict(zip(npz["digests"].tolist(), npz["X"])), stamps
+
+
+def save_feature_cache(path: Path, fp: str, rows: Dict[str, np.ndarray], stamps: np.ndarray) -> None:
+    path.parent.mkdir(parents=True, exist_ok=True)
+    digests = list(rows)
+    X = np.array([rows[d] for d in digests], dtype=np.float64).reshape(-1, len(FEATURES))
+    tmp = path.with_name(path.stem + ".tmp.npz")
+    np.savez(tmp, fingerprint=np.array(fp), digests=np.array(digests, dtype=str), X=X, stamps=stamps)
+    os.replace(tmp, path)
+
+
+def extract_features(paths: Sequence[str], cfg: Dict[str, Any], cache_path: Optional[Path] = FEATURE_CACHE,
+                     workers: Optional[int] = None) -> Tuple[np.ndarray, np.ndarray, List[Tuple[str, str]]]:
+    """
+    (feature matrix, positions in `paths` of its rows, failed (path, error)).
+    Images that cannot be read or analyzed are left out and listed as failed.
+    Rows for images already in the .npz cache (same content digest and
+    analysis config) are reused; the rest are extracted on a process pool
+    (workers <= 1: in-process) and added to the cache. Files unchanged since
+    the last run (path, size and mtime) are not hashed again.
+    """
+    workers = (os.cpu_count() or 1) if workers is None else workers
+    fp = feature_fingerprint(cfg)
+    rows, cached = load_feature_cache(cache_path, fp) if cache_path else ({}, np.zeros(0, dtype=DIGEST_DTYPE))
+    failed = [(p, "FileNotFoundError: no such file") for p in paths if not Path(p).is_file()]
+    present = [i for i, p in enumerate(paths) if Path(p).is_file()]
+    # content digests: from the stamps where path, size and mtime match, else hashed on the pool
+    stamps = file_digests([Path(paths[i]) for i in present], cached)
+    unhashed = np.flatnonzero(stamps["sha256"] == b"")
+    for i, (p, digest, error) in zip(unhashed, map_reported(sha256_file, [Path(paths[present[i]]) for i in unhashed],
+                                                            workers)):
+        if error:
+            failed.append((str(p), error))
+        else:
+            stamps["sha256"][i] = digest
+    digests = {i: d.decode() for i, d in zip(present, stamps["sha256"]) if d}
+
+    todo = list({d: paths[i] for i, d in digests.items() if d not in rows}.items())
+    if todo:
+        print(f"Extracting features for {len(todo)} images ({len(digests) - len(todo)} cached)", file=sys.stderr)
+        for (d, p), (_, x, error) in zip(todo, map_reported(partial(features, cfg=cfg), [p for _, p in todo], workers)):
+            if error:
+                failed.append((p, error))
+            else:
+                rows[d] = np.asarray(x, dtype=np.float64)
+    if cache_path and (todo or len(unhashed)):
+        stamps = stamps[stamps["sha256"] != b""]
+        _, first = np.unique(stamps["path"], return_index=True)
+        stamps = stamps[first]
+        save_feature_cache(cache_path, fp, rows,
+                           np.concatenate([cached[~np.isin(cached["path"], stamps["path"])], stamps]))
+    kept = np.array([i for i in present if digests.get(i) in rows], dtype=np.int64)
+    X = np.array([rows[digests[i]] for i in kept], dtype=np.float64).reshape(-1, len(FEATURES))
+    return X, kept, failed
+
+
+# ----------------------------- Fitting -----------------------------
+def make_classifier() -> LogisticRegression:
+    return LogisticRegression(max_iter=300, class_weight='balanced')
 
-    Xtr, Xte, ytr, yte = train_test_split(X, y, test_size=0.25, random_state=42, stratify=y)
-    clf = LogisticRegression(max_iter=300, class_weight='balanced')
-    clf.fit(Xtr, ytr)
 
-    prob = clf.predict_proba(Xte)[:,1]
-    print("AUC:", roc_auc_score(yte, prob))
-    print(classification_report(yte, (prob>0.5).astype(int), digits=3))
+def cross_validate(X: np.ndarray, y: np.ndarray, folds: int, seed: int = 42) -> List[float]:
+    """Per-fold AUC of a stratified k-fold split over the cached feature matrix."""
+    aucs = []
+    for train, test in StratifiedKFold(n_splits=folds, shuffle=True, random_state=seed).split(X, y):
+        clf = make_classifier().fit(X[train], y[train])
+        aucs.append(float(roc_auc_score(y[test], clf.predict_proba(X[test])[:, 1])))
+    return aucs
 
+
+def weights_from(clf: LogisticRegression) -> Dict[str, float]:
     coefs = clf.coef_[0]
     coefs = (coefs - coefs.min()) / (coefs.max() - coefs.min() + 1e-8)
-    new_w = {"ela":float(coefs[0]), "noise":float(coefs[1]), "edges":float(coefs[2]), "exif":float(coefs[3])}
-    CFG['scoring']['weights'] = new_w
-    yaml.safe_dump(CFG, open(CFG_PATH, "w"))
+    return {name: float(c) for name, c in zip(FEATURES, coefs)}
+
+
+# ----------------------------- Config -----------------------------
+def save_weights(weights: Dict[str, float], path: Path = CONFIG_PATH) -> None:
+    """
+    Rewrite only the values under scoring.weights in config.yaml, keeping its
+    comments and layout; falls back to a full dump (comments lost) with a
+    warning when the block cannot be edited in place.
+    """
+    with open(path, "r", encoding="utf-8") as f:
+        lines = f.read().splitlines(keepends=True)
+    section, done = None, set()
+    for i, line in enumerate(lines):
+        if re.match(r"\S", line):
+            section = line.split(":")[0]
+        elif section == "scoring" and re.match(r"  \S", line):
+            section = "scoring.weights" if line.strip() == "weights:" else "scoring"
+        elif section == "scoring.weights":
+            m = re.match(r"(\s+)(\w+):(\s*)[^#\s]+(.*)", line, re.S)
+            if m and m.group(2) in weights:
+                lines[i] = f"{m.group(1)}{m.group(2)}:{m.group(3)}{weights[m.group(2)]}{m.group(4)}"
+                done.add(m.group(2))
+    text = "".join(lines)
+    if done != set(weights) or yaml.safe_load(text)["scoring"]["weights"] != weights:
+        print(f"Warning: no scoring.weights block to edit in {path}; rewriting it without comments", file=sys.stderr)
+        cfg = load_config(path)
+        cfg["scoring"]["weights"] = weights
+        text = yaml.safe_dump(cfg)
+    tmp = path.with_name(path.name + ".tmp")
+    with open(tmp, "w", encoding="utf-8") as f:
+        f.write(text)
+    os.replace(tmp, path)
+
+
+def main():
+    ap = argparse.ArgumentParser(description="Fit scoring weights from labeled claim images.")
+    ap.add_argument("--labels", default="data/calibration/labels.csv", help="CSV with columns image_path,label")
+    ap.add_argument("--folds", type=int, default=0, help="k-fold cross-validation, then fit on all rows (0: holdout)")
+    ap.add_argument("--workers", type=int, default=None, help="feature extraction processes (default: all cores)")
+    ap.add_argument("--feature-cache", default=str(FEATURE_CACHE), help="'' disables the .npz feature cache")
+    ap.add_argument("--dry-run", action="store_true", help="report only, leave config.yaml untouched")
+    args = ap.parse_args()
+
+    cfg = load_config()
+    labels_csv = resolve_path(args.labels)
+    if not labels_csv.exists():
+        print(f"Create {labels_csv} with columns: image_path,label")
+        return
+    with open(labels_csv, "r", newline="") as f:
+        rows = list(csv.DictReader(f))
+    X, kept, failed = extract_features([str(resolve_path(r['image_path'])) for r in rows], cfg,
+                                       resolve_path(args.feature_cache) if args.feature_cache else None, args.workers)
+    for path, error in failed:
+        print(f"Skipped {path}: {error}", file=sys.stderr)
+    y = np.array([1 if rows[i]['label']=='manipulated' else 0 for i in kept])
+
+    if args.folds > 1:
+        aucs = cross_validate(X, y, args.folds)
+        print(f"AUC ({args.folds}-fold): {np.mean(aucs):.4f} ± {np.std(aucs):.4f}  "
+              f"[{', '.join(f'{a:.3f}' for a in aucs)}]")
+        clf = make_classifier().fit(X, y)
+    else:
+        Xtr, Xte, ytr, yte = train_test_split(X, y, test_size=0.25, random_state=42, stratify=y)
+        clf = make_classifier().fit(Xtr, ytr)
+        prob = clf.predict_proba(Xte)[:,1]
+        print("AUC:", roc_auc_score(yte, prob))
+        print(classification_report(yte, (prob>0.5).astype(int), digits=3))
+
+    new_w = weights_from(clf)
+    if args.dry_run:
+        print("Fitted weights (not saved):", new_w)
+        return
+    save_weights(new_w)
     print("Updated config weights:", new_w)
 
 if __name__ == '__main__':
@@ -1,42 +1,30 @@
 
-import argparse
+import argparse, sys
 from pathlib import Path
-from io import BytesIO
-from PIL import Image
-from datasets import load_dataset
 
-def save_pil(img, out_dir: Path, idx: int):
-    out_dir.mkdir(parents=True, exist_ok=True)
-    img.convert("RGB").save(out_dir / f"hf_{idx:06d}.jpg", quality=95)
+sys.path.append(str(Path(__file__).resolve().parents[1]))
+
+from src.retrieval.ingest import ingest, iter_dataset, open_dataset
 
 def main():
     ap = argparse.ArgumentParser(description="Fetch images from a Hugging Face dataset.")
-    ap.add_argument("--repo", required=True, help="e.g., DrBimmer/comprehensive-car-damage")
+    ap.add_argument("--repo", required=True, help="e.g., DrBimmer/comprehensive-car-damage, or a local dataset dir")
     ap.add_argument("--split", default="train", help="split name")
     ap.add_argument("--limit", type=int, default=1000)
     ap.add_argument("--out", default="data/damage_db/images")
+    ap.add_argument("--workers", type=int, default=None)
+    ap.add_argument("--index", default=None, help="defaults to retrieval.hash_index_path from config.yaml")
+    ap.add_argument("--no-index", action="store_true", help="write images only; leave the pHash index to build_index")
+    ap.add_argument("--no-streaming", action="store_true", help="download the whole split before iterating")
     args = ap.parse_args()
 
-    out_dir = Path(args.out)
-    ds = load_dataset(args.repo, split=args.split)
-    n = min(len(ds), args.limit)
-    print(f"Downloading {n} images from {args.repo}:{args.split} ...")
-    for i in range(n):
-        row = ds[i]
-        img = row.get("image")
-        if img is None:
-            for key in ("img", "Image", "image_bytes"):
-                if key in row:
-                    img = row[key]
-                    break
-        if img is None:
-            continue
-        if hasattr(img, "convert"):
-            save_pil(img, out_dir, i)
-        else:
-            pil = Image.open(BytesIO(img)).convert("RGB")
-            save_pil(pil, out_dir, i)
-    print(f"Saved {n} images to {out_dir.resolve()}")
+    ds = open_dataset(args.repo, args.split, streaming=not args.no_streaming)
+    print(f"Fetching up to {args.limit} images from {args.repo}:{args.split} ...")
+    report = ingest(iter_dataset(ds, args.limit), args.out, args.index, args.workers,
+                    update_index=not args.no_index, progress=True)
+    for name, error in report.failed:
+        print(f"FAILED {name}: {error}")
+    print(report)
 
 if __name__ == "__main__":
     main()
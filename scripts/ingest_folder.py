@@ -1,28 +1,27 @@
 
-import argparse, shutil
+import argparse, sys
 from pathlib import Path
 
+sys.path.append(str(Path(__file__).resolve().parents[1]))
+
+from src.retrieval.ingest import ingest, iter_folder
+
 def main():
     ap = argparse.ArgumentParser(description="Copy images from a local folder into damage_db/images/")
     ap.add_argument("--src", required=True)
     ap.add_argument("--out", default="data/damage_db/images")
     ap.add_argument("--exts", default=".jpg,.jpeg,.png")
+    ap.add_argument("--workers", type=int, default=None)
+    ap.add_argument("--index", default=None, help="defaults to retrieval.hash_index_path from config.yaml")
+    ap.add_argument("--no-index", action="store_true", help="copy only; leave the pHash index to build_index")
     args = ap.parse_args()
 
-    src = Path(args.src); out = Path(args.out)
-    out.mkdir(parents=True, exist_ok=True)
-    exts = {e.strip().lower() for e in args.exts.split(",")}
-    count = 0
-    for p in src.rglob("*"):
-        if p.is_file() and p.suffix.lower() in exts:
-            tgt = out / p.name
-            i = 0
-            while tgt.exists():
-                tgt = out / f"{p.stem}_{i}{p.suffix}"
-                i += 1
-            shutil.copy2(p, tgt)
-            count += 1
-    print(f"Copied {count} images to {out.resolve()}")
+    exts = [e.strip() for e in args.exts.split(",")]
+    report = ingest(iter_folder(args.src, exts), args.out, args.index, args.workers,
+                    update_index=not args.no_index, progress=True)
+    for name, error in report.failed:
+        print(f"FAILED {name}: {error}")
+    print(report)
 
 if __name__ == "__main__":
     main()
@@ -1,35 +1,27 @@
 
-import argparse, zipfile, shutil
+import argparse, sys
 from pathlib import Path
 
+sys.path.append(str(Path(__file__).resolve().parents[1]))
+
+from src.retrieval.ingest import ingest, iter_zip
+
 def main():
-    ap = argparse.ArgumentParser(description="Extract and ingest a ZIP of images into damage_db/images/")
+    ap = argparse.ArgumentParser(description="Stream a ZIP of images into damage_db/images/ (no temp extract)")
     ap.add_argument("--zip", required=True)
     ap.add_argument("--out", default="data/damage_db/images")
     ap.add_argument("--exts", default=".jpg,.jpeg,.png")
+    ap.add_argument("--workers", type=int, default=None)
+    ap.add_argument("--index", default=None, help="defaults to retrieval.hash_index_path from config.yaml")
+    ap.add_argument("--no-index", action="store_true", help="copy only; leave the pHash index to build_index")
     args = ap.parse_args()
 
-    out_dir = Path(args.out); out_dir.mkdir(parents=True, exist_ok=True)
-    exts = {e.strip().lower() for e in args.exts.split(",")}
-    tmp = out_dir.parent / "_tmp_extract"
-    if tmp.exists(): shutil.rmtree(tmp)
-    tmp.mkdir(parents=True, exist_ok=True)
-
-    with zipfile.ZipFile(args.zip, "r") as z:
-        z.extractall(tmp)
-
-    count = 0
-    for p in tmp.rglob("*"):
-        if p.is_file() and p.suffix.lower() in exts:
-            target = out_dir / p.name
-            i = 0
-            while target.exists():
-                target = out_dir / f"{p.stem}_{i}{p.suffix}"
-                i += 1
-            shutil.copy2(p, target)
-            count += 1
-    shutil.rmtree(tmp)
-    print(f"Ingested {count} images to {out_dir.resolve()}")
+    exts = [e.strip() for e in args.exts.split(",")]
+    report = ingest(iter_zip(args.zip, exts), args.out, args.index, args.workers,
+                    update_index=not args.no_index, progress=True)
+    for name, error in report.failed:
+        print(f"FAILED {name}: {error}")
+    print(report)
 
 if __name__ == "__main__":
     main()
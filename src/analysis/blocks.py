@@ -0,0 +1,59 @@
+
+import numpy as np
+
+
+def _block_grid(arr: np.ndarray, block_size: int):
+    """
+    Split a 2-D array into the four rectangular regions that share a block
+    shape: full blocks, the ragged right column, the ragged bottom row and the
+    ragged corner. Each region is returned as a 4-D view (rows, bh, cols, bw)
+    together with the slice of the output grid it fills.
+    """
+    h, w = arr.shape
+    fy, fx = h // block_size, w // block_size
+    ry, rx = h - fy * block_size, w - fx * block_size
+    ny, nx = fy + (ry > 0), fx + (rx > 0)
+
+    regions = []
+    for y0, rows, bh, gy in ((0, fy, block_size, slice(0, fy)), (fy * block_size, 1, ry, slice(fy, ny))):
+        for x0, cols, bw, gx in ((0, fx, block_size, slice(0, fx)), (fx * block_size, 1, rx, slice(fx, nx))):
+            if rows == 0 or cols == 0 or bh == 0 or bw == 0:
+                continue
+            sub = arr[y0:y0 + rows * bh, x0:x0 + cols * bw]
+            regions.append((sub.reshape(rows, bh, cols, bw), gy, gx))
+    return (ny, nx), regions
+
+
+def block_reduce(arr: np.ndarray, block_size: int, stat: str = 'mean') -> np.ndarray:
+    """
+    Per-block statistic ('mean' or 'var') over block_size x block_size patches,
+    returned as a float64 grid in row-major block order. Edge blocks are
+    clipped to the image exactly like arr[y:y+bs, x:x+bs] would be.
+    """
+    reducer = {'mean': np.mean, 'var': np.var}[stat]
+    shape, regions = _block_grid(arr, block_size)
+    out = np.zeros(shape, dtype=np.float64)
+    for blocks, gy, gx in regions:
+        # (rows, cols, bh, bw) keeps each patch contiguous in the reduction axes
+        patches = np.ascontiguousarray(blocks.transpose(0, 2, 1, 3))
+        out[gy, gx] = reducer(patches, axis=(2, 3))
+    return out
+
+
+def paint_blocks(values: np.ndarray, shape, block_size: int) -> np.ndarray:
+    """
+    Expand a (rows, cols) grid of uint8 values back to a full-resolution
+    plane of the given (h, w) shape, cropping the ragged edge blocks.
+    """
+    h, w = shape
+    plane = np.repeat(np.repeat(values, block_size, axis=0), block_size, axis=1)
+    return plane[:h, :w]
+
+
+def normalize(values: np.ndarray) -> np.ndarray:
+    return (values - values.min()) / (values.max() - values.min() + 1e-8)
+
+
+def to_levels(norm: np.ndarray) -> np.ndarray:
+    """Map normalized block values to 0..255 the way int(255 * v) does."""
+    return (255 * norm).astype(np.uint8)
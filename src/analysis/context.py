@@ -0,0 +1,135 @@
+
+import hashlib
+import threading
+from functools import cached_property
+from io import BytesIO
+from pathlib import Path
+from typing import Optional, Union
+
+import numpy as np
+from PIL import Image
+
+from src.utils.profiling import phase
+
+
+class ImageContext:
+    """
+    A claim image decoded once and shared by every analyzer for one request.
+    Holds the RGB image, the raw EXIF read from the original file and lazily
+    derived grayscale planes; RGB arrays are copied out strip by strip
+    (rgb_rows) rather than kept as a second full frame.
+    Contexts opened from a file keep the encoded bytes and decode on first
+    access, so cache lookups by content digest never pay for the decode.
+    """
+
+    def __init__(self, image: Optional[Image.Image] = None, path: Optional[str] = None,
+                 exif: Optional[Image.Exif] = None, data: Optional[bytes] = None,
+                 digest: Optional[str] = None):
+        if image is None and data is None:
+            raise ValueError("ImageContext needs a decoded image or encoded bytes")
+        self.path = path
+        self.data = data
+        self._digest = digest
+        self._image = None if image is None else (image if image.mode == 'RGB' else image.convert('RGB'))
+        self._exif = exif if exif is not None or image is None else image.getexif()
+        self._lock = threading.Lock()
+
+    def __getstate__(self):
+        # Locks and derived planes stay behind when a context is sent to another
+        # process; one opened from a file travels as its encoded bytes only.
+        return {"image": self._image if self.data is None else None, "path": self.path,
+                "data": self.data, "digest": self.__dict__.get("digest", self._digest)}
+
+    def __setstate__(self, state):
+        self.__init__(**state)
+
+    @classmethod
+    def open(cls, path: str) -> "ImageContext":
+        return cls(path=str(path), data=Path(path).read_bytes())
+
+    def _decode(self) -> None:
+        with phase("decode"), self._lock:
+            if self._image is None:
+                with Image.open(BytesIO(self.data)) as src:
+                    self._exif = src.getexif()
+                    self._image = src.convert('RGB')
+
+    @property
+    def image(self) -> Image.Image:
+        if self._image is None:
+            self._decode()
+        return self._image
+
+    @property
+    def exif(self) -> Image.Exif:
+        if self._exif is None:
+            self._decode()
+        return self._exif
+
+    @property
+    def size(self):
+        return self.image.size
+
+    def preview(self, max_side: int) -> Optional["ImageContext"]:
+        """
+        A downscaled context whose longer side is at most max_side, or None if
+        the image is already that small. JPEGs use draft() so the decoder skips
+        most of the IDCT work (1/2, 1/4 or 1/8 scale) instead of decoding the
+        full frame and resizing it.
+        """
+        if self._image is not None:
+            src, close = self._image, False
+        else:
+            src, close = Image.open(BytesIO(self.data)), True
+        try:
+            w, h = src.size
+            if max(w, h) <= max_side:
+                return None
+            target = (max(1, w * max_side // max(w, h)), max(1, h * max_side // max(w, h)))
+            exif = self.exif if not close else src.getexif()
+            if close and src.format == 'JPEG':
+                src.draft('RGB', target)
+            small = src.convert('RGB')
+            small.thumbnail(target, Image.Resampling.BILINEAR)
+        finally:
+            if close:
+                src.close()
+        return ImageContext(small, path=self.path, exif=exif, digest=f"{self.digest}:preview{max_side}")
+
+    @cached_property
+    def digest(self) -> str:
+        """sha256 of the encoded file, or of the raw pixels for in-memory images."""
+        if self._digest is not None:
+            return self._digest
+        if self.data is not None:
+            return hashlib.sha256(self.data).hexdigest()
+        img = self.image
+        h = hashlib.sha256(f"{img.mode}:{img.size}".encode())
+        h.update(img.tobytes())
+        return h.hexdigest()
+
+    def rgb_rows(self, top: int, bottom: int) -> np.ndarray:
+        """RGB array of rows top..bottom, a fresh copy per call."""
+        img = self.image
+        return np.asarray(img if (top, bottom) == (0, img.height) else img.crop((0, top, img.width, bottom)))
+
+    @cached_property
+    def gray_image(self) -> Image.Image:
+        return self.image.convert('L')
+
+    @cached_property
+    def gray(self) -> np.ndarray:
+        return np.asarray(self.gray_image, dtype=np.float32)
+
+    def __repr__(self):
+        state = "x".join(map(str, self._image.size)) if self._image is not None else "not decoded"
+        return f"ImageContext(path={self.path!r}, {state})"
+
+
+def as_context(image: Union[str, Image.Image, ImageContext]) -> ImageContext:
+    """Accept a path, a PIL image or an existing context and return a context."""
+    if isinstance(image, ImageContext):
+        return image
+    if isinstance(image, Image.Image):
+        return ImageContext(image)
+    return ImageContext.open(str(image))
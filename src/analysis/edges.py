@@ -1,28 +1,37 @@
 
 import numpy as np
 from PIL import Image, ImageFilter
+from typing import Optional, Union
 
+from .blocks import block_reduce, normalize, paint_blocks, to_levels
+from .context import ImageContext, as_context
+from .tiles import EDGES_BYTES_PER_PIXEL, iter_strips, strip_rows
 
-def edge_inconsistency(image: Image.Image, block_size: int = 16):
-    edges = image.convert('L').filter(ImageFilter.FIND_EDGES)
-    arr = np.asarray(edges, dtype=np.float32)
-    h, w = arr.shape
-    mags = []
-    for y in range(0, h, block_size):
-        for x in range(0, w, block_size):
-            patch = arr[y:min(y+block_size,h), x:min(x+block_size,w)]
-            mags.append(float(np.mean(patch)))
-    mags = np.array(mags)
-    if mags.size == 0:
-        return {"score": 0.0, "overlay": edges.convert('RGB')}
-    norm = (mags - mags.min()) / (mags.max() - mags.min() + 1e-8)
-    score = float(np.std(norm))
 
-    overlay = np.zeros_like(arr)
-    i = 0
-    for y in range(0, h, block_size):
-        for x in range(0, w, block_size):
-            val = int(255 * norm[i])
-            overlay[y:min(y+block_size,h), x:min(x+block_size,w)] = val
-            i += 1
-    return {"score": score, "overlay": Image.fromarray(overlay.astype('uint8')).convert('RGB')}
+def edge_inconsistency(image: Union[Image.Image, ImageContext], block_size: int = 16,
+                       want_overlays: bool = True, max_bytes: Optional[int] = None):
+    ctx = as_context(image)
+    w, h = ctx.size
+    rows = strip_rows(w, h, EDGES_BYTES_PER_PIXEL, max_bytes, block_size)
+    if rows >= h:
+        edges = ctx.gray_image.filter(ImageFilter.FIND_EDGES)
+        arr = np.asarray(edges, dtype=np.float32)
+        mags = block_reduce(arr, block_size, 'mean')
+        if mags.size == 0:
+            return {"score": 0.0, "overlay": edges.convert('RGB') if want_overlays else None}
+    else:
+        # FIND_EDGES is 3x3: filter each block-aligned strip with a 1-row halo and drop it
+        gray = ctx.gray_image
+        grids = []
+        for y0, y1, top, bottom in iter_strips(h, rows, halo=1):
+            strip = gray.crop((0, top, w, bottom)).filter(ImageFilter.FIND_EDGES)
+            arr = np.asarray(strip, dtype=np.float32)[y0 - top:y1 - top]
+            grids.append(block_reduce(arr, block_size, 'mean'))
+        mags = np.vstack(grids)
+    norm = normalize(mags)
+    score = float(np.std(norm.ravel()))
+    if not want_overlays:
+        return {"score": score, "overlay": None}
+
+    overlay = paint_blocks(to_levels(norm), (h, w), block_size)
+    return {"score": score, "overlay": Image.fromarray(overlay).convert('RGB')}
@@ -1,20 +1,138 @@
 
-from PIL import Image, ImageChops, ImageEnhance
-import numpy as np
+import threading
 from io import BytesIO
+from typing import Dict, Optional, Sequence, Union
+
+import numpy as np
+from PIL import Image
+
+from .context import ImageContext, as_context
+from .tiles import ELA_BYTES_PER_PIXEL, JPEG_MCU, iter_strips, strip_rows
+
+ELA_BACKENDS = ("pil", "cv2")
+
+# ImageEnhance.Brightness(diff).enhance(20) as a lookup table: x20, clipped to 255
+_BRIGHTEN = np.minimum(np.arange(256) * 20, 255).astype(np.uint8)
+# PIL's fixed-point RGB -> L weights (L = (19595 R + 38470 G + 7471 B + 0x8000) >> 16),
+# pre-multiplied into the brightened value
+_LUMA = [(_BRIGHTEN.astype(np.uint32) * w) for w in (19595, 38470, 7471)]
+
+# Scratch planes up to this size stay allocated per thread between calls;
+# larger frames get transient buffers so one huge image doesn't pin memory.
+_SCRATCH_KEEP = 64 * 2**20
+_local = threading.local()
+
+
+def _scratch(name: str, shape, dtype=np.uint8) -> np.ndarray:
+    n = int(np.prod(shape))
+    buf = getattr(_local, name, None)
+    if buf is None or buf.size < n:
+        buf = np.empty(n, dtype)
+        if buf.nbytes <= _SCRATCH_KEEP:
+            setattr(_local, name, buf)
+    return buf[:n].reshape(shape)
+
+
+def _encode_buffer() -> BytesIO:
+    buf = getattr(_local, "jpeg", None)
+    if buf is None:
+        buf = _local.jpeg = BytesIO()
+    buf.seek(0)
+    buf.truncate()
+    return buf
+
+
+def _resave_pil(src: Union[Image.Image, np.ndarray], quality: int) -> np.ndarray:
+    buf = _encode_buffer()
+    (src if isinstance(src, Image.Image) else Image.fromarray(src)).save(buf, format='JPEG', quality=quality)
+    buf.seek(0)
+    with Image.open(buf) as resaved:
+        return np.asarray(resaved)
+
+
+def _resave_cv2(src: Union[Image.Image, np.ndarray], quality: int) -> np.ndarray:
+    import cv2
+    bgr = cv2.cvtColor(np.asarray(src), cv2.COLOR_RGB2BGR)
+    ok, encoded = cv2.imencode('.jpg', bgr, [cv2.IMWRITE_JPEG_QUALITY, int(quality)])
+    if not ok:
+        raise RuntimeError("cv2.imencode failed")
+    return cv2.cvtColor(cv2.imdecode(encoded, cv2.IMREAD_COLOR), cv2.COLOR_BGR2RGB)
+
+
+_RESAVE = {"pil": _resave_pil, "cv2": _resave_cv2}
+
+
+def _brighten(diff: np.ndarray, out: np.ndarray) -> None:
+    np.minimum(diff, 13, out=out)
+    np.multiply(out, 20, out=out)
+    out[out == 4] = 255  # 13 * 20 wrapped around in uint8; PIL clips it to 255
+
+
+def _ela_strip(rgb: np.ndarray, resaved: np.ndarray, threshold: int, overlay: Optional[np.ndarray]) -> int:
+    """
+    Count pixels whose brightened ELA luma exceeds threshold, and write the
+    brightened difference into `overlay` if given. Bit-identical to
+    ImageChops.difference -> Brightness(20) -> convert('L') on the PIL images.
+    """
+    diff = _scratch("diff", rgb.shape)
+    low = _scratch("low", rgb.shape)
+    np.maximum(rgb, resaved, out=diff)
+    np.minimum(rgb, resaved, out=low)
+    np.subtract(diff, low, out=diff)
+
+    # The luma weights sum to 1, so L never exceeds the brightened value of the
+    # largest channel difference: only pixels whose peak difference passes the
+    # threshold on its own need the exact luma.
+    peak = _scratch("peak", rgb.shape[:2])
+    np.maximum(diff[..., 0], diff[..., 1], out=peak)
+    np.maximum(peak, diff[..., 2], out=peak)
+    candidates = np.flatnonzero(peak >= np.searchsorted(_BRIGHTEN, threshold, side='right'))
+    hot = 0
+    if candidates.size:
+        px = diff.reshape(-1, 3)[candidates]
+        luma = _LUMA[0][px[:, 0]] + _LUMA[1][px[:, 1]] + _LUMA[2][px[:, 2]]
+        # (luma + 0x8000) >> 16 > threshold, without the shift
+        hot = int(np.count_nonzero(luma >= ((threshold + 1) << 16) - 0x8000))
+    if overlay is not None:
+        _brighten(diff, overlay)
+    return hot
 
 
-def compute_ela(image: Image.Image, resave_quality: int = 95, threshold: int = 30):
-    buffer = BytesIO()
-    image.save(buffer, format='JPEG', quality=resave_quality)
-    buffer.seek(0)
-    resaved = Image.open(buffer)
+def compute_ela(image: Union[Image.Image, ImageContext], resave_quality: Union[int, Sequence[int]] = 95,
+                threshold: int = 30, want_overlays: bool = True, max_bytes: Optional[int] = None,
+                backend: str = "pil"):
+    """
+    Error Level Analysis: re-encode as JPEG and score the share of pixels whose
+    amplified difference exceeds threshold. `resave_quality` may be a list of
+    qualities; each strip is then shared across all re-encodes, the first
+    quality provides score/overlay, and every quality's score is returned
+    under "by_quality" (keyed by the quality as a string, JSON-style).
+    backend "cv2" re-encodes with OpenCV's libjpeg instead of PIL's (scores
+    can differ slightly between the two).
+    """
+    if backend not in _RESAVE:
+        raise ValueError(f"Unknown ELA backend {backend!r}; expected one of {ELA_BACKENDS}")
+    resave = _RESAVE[backend]
+    qualities = [resave_quality] if isinstance(resave_quality, int) else list(resave_quality)
+    ctx = as_context(image)
+    w, h = ctx.size
+    hot: Dict[int, int] = dict.fromkeys(qualities, 0)
+    overlay = np.empty((h, w, 3), np.uint8) if want_overlays else None
 
-    diff = ImageChops.difference(image, resaved)
-    enhancer = ImageEnhance.Brightness(diff)
-    ela_img = enhancer.enhance(20)
+    # Strips start on MCU rows and re-encode with one MCU of halo on each side,
+    # so chroma upsampling at strip edges sees the same neighbours as the full frame.
+    rows = strip_rows(w, h, ELA_BYTES_PER_PIXEL, max_bytes, JPEG_MCU)
+    for y0, y1, top, bottom in iter_strips(h, rows, halo=JPEG_MCU):
+        strip = ctx.rgb_rows(top, bottom)
+        src = ctx.image if rows >= h else strip
+        core = slice(y0 - top, y1 - top)
+        for i, q in enumerate(qualities):
+            resaved = resave(src, q)
+            strip_overlay = overlay[y0:y1] if overlay is not None and i == 0 else None
+            hot[q] += _ela_strip(strip[core], resaved[core], threshold, strip_overlay)
 
-    arr = np.asarray(ela_img.convert('L'))
-    score = float((arr > threshold).mean())
-    overlay = ela_img.convert('RGB')
-    return {"score": score, "overlay": overlay}
+    result = {"score": hot[qualities[0]] / (w * h),
+              "overlay": Image.fromarray(overlay) if overlay is not None else None}
+    if len(qualities) > 1:
+        result["by_quality"] = {str(q): n / (w * h) for q, n in hot.items()}
+    return result
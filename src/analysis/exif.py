@@ -1,12 +1,17 @@
 
+from typing import Union
 from PIL import Image
 
-def inspect_exif(image_path: str, suspicious_software=None):
+from .context import ImageContext
+
+def inspect_exif(image: Union[str, ImageContext], suspicious_software=None):
     suspicious_software = suspicious_software or []
     info = {"has_exif": False, "software": None, "flags": []}
     try:
-        img = Image.open(image_path)
-        exif = img.getexif()
+        if isinstance(image, ImageContext):
+            exif = image.exif
+        else:
+            exif = Image.open(image).getexif()
         if exif and len(exif) > 0:
             info["has_exif"] = True
             sw = exif.get(305)
@@ -1,27 +1,34 @@
 
 import numpy as np
 from PIL import Image
+from typing import Optional, Union
 
+from .blocks import block_reduce, normalize, paint_blocks, to_levels
+from .context import ImageContext, as_context
+from .tiles import NOISE_BYTES_PER_PIXEL, iter_strips, strip_rows
 
-def block_noise_score(image: Image.Image, block_size: int = 16):
-    arr = np.asarray(image.convert('L'), dtype=np.float32)
-    h, w = arr.shape
-    blocks = []
-    for y in range(0, h, block_size):
-        for x in range(0, w, block_size):
-            patch = arr[y:min(y+block_size,h), x:min(x+block_size,w)]
-            blocks.append(float(np.var(patch)))
-    blocks = np.array(blocks)
-    if blocks.size == 0:
-        return {"score": 0.0, "overlay": Image.fromarray(arr.astype('uint8')).convert('RGB')}
-    norm = (blocks - blocks.min()) / (blocks.max() - blocks.min() + 1e-8)
-    score = float(np.mean(np.sort(norm)[-max(1, len(norm)//4):]))
 
-    overlay = np.zeros_like(arr)
-    i = 0
-    for y in range(0, h, block_size):
-        for x in range(0, w, block_size):
-            val = int(255 * norm[i])
-            overlay[y:min(y+block_size,h), x:min(x+block_size,w)] = val
-            i += 1
-    return {"score": score, "overlay": Image.fromarray(overlay.astype('uint8')).convert('RGB')}
+def block_noise_score(image: Union[Image.Image, ImageContext], block_size: int = 16,
+                      want_overlays: bool = True, max_bytes: Optional[int] = None):
+    ctx = as_context(image)
+    w, h = ctx.size
+    rows = strip_rows(w, h, NOISE_BYTES_PER_PIXEL, max_bytes, block_size)
+    if rows >= h:
+        arr = ctx.gray
+        blocks = block_reduce(arr, block_size, 'var')
+        if blocks.size == 0:
+            overlay = Image.fromarray(arr.astype('uint8')).convert('RGB') if want_overlays else None
+            return {"score": 0.0, "overlay": overlay}
+    else:
+        # Strips are block-aligned, so every block lands whole in one strip
+        gray = ctx.gray_image
+        blocks = np.vstack([block_reduce(np.asarray(gray.crop((0, y0, w, y1)), dtype=np.float32), block_size, 'var')
+                            for y0, y1, _, _ in iter_strips(h, rows)])
+    norm = normalize(blocks)
+    flat = norm.ravel()
+    score = float(np.mean(np.sort(flat)[-max(1, len(flat)//4):]))
+    if not want_overlays:
+        return {"score": score, "overlay": None}
+
+    overlay = paint_blocks(to_levels(norm), (h, w), block_size)
+    return {"score": score, "overlay": Image.fromarray(overlay).convert('RGB')}
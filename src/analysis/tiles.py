@@ -0,0 +1,37 @@
+
+from typing import Iterator, Optional, Tuple
+
+# Rough working-set sizes per pixel of each analyzer's strip buffers. The
+# memory budget (analysis.memory_budget_mb) bounds only these: the planes that
+# stay resident for the whole frame are not counted, i.e. the decoded RGB
+# image and grayscale image held by the ImageContext (4 bytes/pixel) and the
+# full-resolution overlays (up to 3 bytes/pixel per analyzer when requested).
+ELA_BYTES_PER_PIXEL = 15     # RGB strip + re-saved RGB + max/min planes + peak plane + mask
+NOISE_BYTES_PER_PIXEL = 4    # float32 gray
+EDGES_BYTES_PER_PIXEL = 5    # L edges + float32 magnitudes
+
+# JPEG MCU height with 4:2:0 chroma subsampling; ELA strips must start on it
+JPEG_MCU = 16
+
+
+def strip_rows(width: int, height: int, bytes_per_pixel: int, max_bytes: Optional[int], align: int) -> int:
+    """
+    Rows per strip so one strip's working set fits in max_bytes, rounded down
+    to a multiple of `align` (at least one aligned band). Returns `height`
+    when the whole frame fits or no budget is set, meaning: don't tile.
+    """
+    if not max_bytes or width * height * bytes_per_pixel <= max_bytes:
+        return height
+    rows = max_bytes // max(1, width * bytes_per_pixel)
+    return max(align, rows - rows % align)
+
+
+def iter_strips(height: int, rows: int, halo: int = 0) -> Iterator[Tuple[int, int, int, int]]:
+    """
+    Yield (y0, y1, top, bottom): the strip [y0, y1) the caller keeps, and the
+    halo-extended [top, bottom) it should read so filters/codecs that look at
+    neighbouring rows see the same context as on the full frame.
+    """
+    for y0 in range(0, height, rows):
+        y1 = min(y0 + rows, height)
+        yield y0, y1, max(0, y0 - halo), min(height, y1 + halo)
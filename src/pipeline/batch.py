@@ -0,0 +1,280 @@
+
+# src/pipeline/batch.py
+#
+# Score many claim images without the UI:
+#   python -m src.pipeline.batch data/claims/ --out scores.jsonl --workers 8
+#   python -m src.pipeline.batch "data/claims/**/*.jpg" --out scores.parquet
+#   python -m src.pipeline.batch manifest.csv --out scores.jsonl   # column image_path
+
+import argparse
+import csv
+import glob
+import json
+import os
+import shutil
+import sys
+import time
+from concurrent.futures import FIRST_COMPLETED, wait
+from pathlib import Path
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Set
+
+from src.utils.pool import process_pool
+
+IMAGE_EXTS = (".jpg", ".jpeg", ".png")
+
+
+# ----------------------------- Inputs -----------------------------
+def iter_inputs(source: str) -> Iterator[str]:
+    """
+    Expand a folder (recursive), a glob pattern or a manifest (.txt with one
+    path per line, .csv / .jsonl with an 'image_path' field) into image paths.
+    """
+    p = Path(source)
+    if p.is_dir():
+        for f in sorted(p.rglob("*")):
+            if f.is_file() and f.suffix.lower() in IMAGE_EXTS:
+                yield str(f)
+    elif p.is_file() and p.suffix.lower() == ".csv":
+        with open(p, "r", encoding="utf-8", newline="") as f:
+            for row in csv.DictReader(f):
+                yield row["image_path"]
+    elif p.is_file() and p.suffix.lower() == ".jsonl":
+        with open(p, "r", encoding="utf-8") as f:
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)["image_path"]
+    elif p.is_file() and p.suffix.lower() not in IMAGE_EXTS:
+        with open(p, "r", encoding="utf-8") as f:
+            for line in f:
+                if line.strip():
+                    yield line.strip()
+    else:
+        for f in sorted(glob.glob(source, recursive=True)):
+            if Path(f).suffix.lower() in IMAGE_EXTS:
+                yield f
+
+
+# ----------------------------- Worker -----------------------------
+def to_record(image_path: str, result) -> Dict[str, Any]:
+    """Flatten a ClaimResult into a JSON-serializable row (overlays dropped)."""
+    return {
+        "image_path": image_path,
+        "final_score": result.final_score,
+        "ela": result.ela.score,
+        "noise": result.noise.score,
+        "edges": result.edges.score,
+        "exif": result.exif.score,
+        "exif_software": result.exif.software,
+        "exif_flags": list(result.exif.flags),
+        "similar": result.similar,
+        "timings": result.timings,
+        "error": None,
+    }
+
+
+def score_image(image_path: str) -> Dict[str, Any]:
+    """Worker entry point: score one image with this process's shared scores-only chain."""
+    from .registry import get_chain
+    try:
+        return to_record(image_path, get_chain(want_overlays=False).invoke({"image_path": image_path}))
+    except Exception as e:
+        return {"image_path": image_path, "error": f"{type(e).__name__}: {e}"}
+
+
+# ----------------------------- Outputs -----------------------------
+def parquet_parts(out_path: Path) -> List[Path]:
+    """Row-group part files of an unfinished Parquet output (<out>.parts/), in write order."""
+    return sorted(out_path.with_name(out_path.name + ".parts").glob("*.parquet"))
+
+
+def completed_paths(out_path: Path) -> Set[str]:
+    """Images already scored successfully in an existing output file (and, for Parquet, its part files)."""
+    if out_path.suffix == ".parquet":
+        done = set()
+        sources = ([out_path] if out_path.exists() else []) + parquet_parts(out_path)
+        if sources:
+            import pyarrow.parquet as pq
+            for src in sources:
+                table = pq.read_table(src, columns=["image_path", "error"]).to_pydict()
+                done.update(p for p, e in zip(table["image_path"], table["error"]) if not e)
+        return done
+    if not out_path.exists():
+        return set()
+    done = set()
+    with open(out_path, "r", encoding="utf-8") as f:
+        for line in f:
+            try:
+                row = json.loads(line)
+            except json.JSONDecodeError:
+                continue  # torn last line from an interrupted run
+            if not row.get("error"):
+                done.add(row["image_path"])
+    return done
+
+
+def drop_torn_tail(path: Path, chunk: int = 1 << 16) -> None:
+    """Truncate a JSONL file back to its last newline, dropping a line an interrupted run left unterminated."""
+    if not path.exists():
+        return
+    with open(path, "rb+") as f:
+        end = f.seek(0, os.SEEK_END)
+        pos = end
+        while pos > 0:
+            start = max(0, pos - chunk)
+            f.seek(start)
+            newline = f.read(pos - start).rfind(b"\n")
+            if newline >= 0:
+                pos = start + newline + 1
+                break
+            pos = start
+        if pos < end:
+            f.truncate(pos)
+
+
+class JsonlSink:
+    """
+    Appends one JSON line per result and flushes, so an interrupted run loses
+    nothing but the line being written; that torn line is dropped on resume.
+    """
+
+    def __init__(self, path: Path):
+        drop_torn_tail(path)
+        self.f = open(path, "a", encoding="utf-8")
+
+    def write(self, record: Dict[str, Any]) -> None:
+        self.f.write(json.dumps(record) + "\n")
+        self.f.flush()
+
+    def close(self) -> None:
+        self.f.close()
+
+
+class ParquetSink:
+    """
+    Writes each row group to its own part file in <out>.parts/ as soon as it
+    fills, so an interrupted run keeps every full group. close() merges the
+    parts into <out>. Parquet files cannot be appended to, so on resume the
+    previous file and any parts left behind are merged first, keeping only
+    their successful rows (failures are retried).
+    """
+    COLUMNS = ["image_path", "final_score", "ela", "noise", "edges", "exif", "exif_software", "error", "extra"]
+
+    def __init__(self, path: Path, row_group: int = 256):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+        self.pa, self.pq = pa, pq
+        self.path, self.parts = path, path.with_name(path.name + ".parts")
+        self.schema = pa.schema([("image_path", pa.string()), ("final_score", pa.float64()),
+                                 ("ela", pa.float64()), ("noise", pa.float64()), ("edges", pa.float64()),
+                                 ("exif", pa.float64()), ("exif_software", pa.string()),
+                                 ("error", pa.string()), ("extra", pa.string())])
+        self.rows: List[Dict[str, Any]] = []
+        self.row_group = row_group
+        self.written = 0
+        if path.exists() or parquet_parts(path):
+            self._merge(keep_errors=False)
+        self.parts.mkdir(parents=True, exist_ok=True)
+
+    def write(self, record: Dict[str, Any]) -> None:
+        core = {k: record.get(k) for k in self.COLUMNS if k != "extra"}
+        core["extra"] = json.dumps({k: v for k, v in record.items() if k not in self.COLUMNS})
+        self.rows.append(core)
+        if len(self.rows) >= self.row_group:
+            self._flush()
+
+    def _flush(self) -> None:
+        if self.rows:
+            part = self.parts / f"{self.written:06d}.parquet"
+            tmp = part.with_suffix(".tmp")
+            self.pq.write_table(self.pa.Table.from_pylist(self.rows, schema=self.schema), tmp)
+            os.replace(tmp, part)
+            self.written += 1
+            self.rows = []
+
+    def _merge(self, keep_errors: bool) -> None:
+        """Rewrite <out> as its current rows followed by every part file's, then drop the parts."""
+        tmp = self.path.with_name(self.path.name + ".tmp")
+        with self.pq.ParquetWriter(tmp, self.schema) as writer:
+            for src in ([self.path] if self.path.exists() else []) + parquet_parts(self.path):
+                for batch in self.pq.ParquetFile(src).iter_batches():
+                    table = self.pa.Table.from_batches([batch]).cast(self.schema)
+                    if not keep_errors:
+                        table = table.filter(self.pa.array([not e for e in table.column("error").to_pylist()]))
+                    writer.write_table(table)
+        os.replace(tmp, self.path)
+        shutil.rmtree(self.parts, ignore_errors=True)
+
+    def close(self) -> None:
+        self._flush()
+        self._merge(keep_errors=True)
+
+
+def open_sink(out_path: Path):
+    return ParquetSink(out_path) if out_path.suffix == ".parquet" else JsonlSink(out_path)
+
+
+# ----------------------------- Driver -----------------------------
+def run_batch(paths: Iterable[str], out_path: str, workers: Optional[int] = None,
+              max_in_flight: Optional[int] = None, progress: bool = True) -> Dict[str, int]:
+    """
+    Score every path on a process pool and stream rows to out_path as they finish.
+    At most max_in_flight images are queued at once (default 2 per worker), and
+    images already scored successfully in out_path are skipped.
+    """
+    out = Path(out_path)
+    out.parent.mkdir(parents=True, exist_ok=True)
+    workers = workers or os.cpu_count() or 1
+    max_in_flight = max_in_flight or 2 * workers
+    done = completed_paths(out)
+    stats = {"scored": 0, "failed": 0, "skipped": 0}
+
+    todo = iter(paths)
+    sink = open_sink(out)
+    start = time.perf_counter()
+    try:
+        with process_pool(workers) as pool:
+            pending = set()
+            exhausted = False
+            while pending or not exhausted:
+                while not exhausted and len(pending) < max_in_flight:
+                    path = next(todo, None)
+                    if path is None:
+                        exhausted = True
+                    elif path in done:
+                        stats["skipped"] += 1
+                    else:
+                        done.add(path)
+                        pending.add(pool.submit(score_image, path))
+                if not pending:
+                    break
+                finished, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for fut in finished:
+                    record = fut.result()
+                    sink.write(record)
+                    stats["failed" if record.get("error") else "scored"] += 1
+                if progress:
+                    n = stats["scored"] + stats["failed"]
+                    rate = n / max(time.perf_counter() - start, 1e-9)
+                    print(f"\r{n} scored ({stats['failed']} failed, {stats['skipped']} skipped) · {rate:.2f} img/s",
+                          end="", file=sys.stderr, flush=True)
+    finally:
+        sink.close()
+        if progress:
+            print(file=sys.stderr)
+    return stats
+
+
+def main():
+    ap = argparse.ArgumentParser(description="Batch-score claim images to JSONL or Parquet.")
+    ap.add_argument("source", help="folder, glob pattern, or manifest (.txt/.csv/.jsonl)")
+    ap.add_argument("--out", required=True, help="output .jsonl or .parquet (resumed if it exists)")
+    ap.add_argument("--workers", type=int, default=None)
+    ap.add_argument("--max-in-flight", type=int, default=None)
+    args = ap.parse_args()
+
+    stats = run_batch(iter_inputs(args.source), args.out, args.workers, args.max_in_flight)
+    print(f"Scored {stats['scored']} images ({stats['failed']} failed, {stats['skipped']} already done) -> {args.out}")
+
+
+if __name__ == "__main__":
+    main()
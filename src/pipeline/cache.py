@@ -0,0 +1,234 @@
+
+# src/pipeline/cache.py
+
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+from io import BytesIO
+from pathlib import Path
+from typing import Any, Callable, Dict, Optional, Union
+
+from PIL import Image
+
+from src.analysis.context import as_context
+from src.retrieval.packed_index import index_stamp
+from src.utils.config import resolve_path
+from src.utils.profiling import phase
+
+# Bump when an analyzer's algorithm changes so old results stop matching
+CACHE_VERSION = 1
+
+Params = Union[Dict[str, Any], Callable[[], Dict[str, Any]]]
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS scores (
+    key TEXT PRIMARY KEY, analyzer TEXT NOT NULL, payload TEXT NOT NULL,
+    size INTEGER NOT NULL, atime REAL NOT NULL);
+CREATE TABLE IF NOT EXISTS overlays (
+    key TEXT PRIMARY KEY, png BLOB NOT NULL,
+    size INTEGER NOT NULL, atime REAL NOT NULL);
+CREATE INDEX IF NOT EXISTS scores_atime ON scores(atime);
+CREATE INDEX IF NOT EXISTS overlays_atime ON overlays(atime);
+CREATE TABLE IF NOT EXISTS usage (id INTEGER PRIMARY KEY CHECK (id = 0), bytes INTEGER NOT NULL);
+"""
+
+
+def analyzer_params(config: Dict[str, Any]) -> Dict[str, Params]:
+    """
+    The config.yaml values each analyzer's output depends on. Only these feed
+    its fingerprint, so e.g. changing ela_quality invalidates ELA results only.
+    Retrieval params are a callable: the index's stamp (see
+    packed_index.index_stamp: side table, cluster/tile/descriptor tables,
+    every shard) is read per call so a rebuilt index or table invalidates
+    cached neighbours.
+    """
+    analysis, retrieval = config["analysis"], config["retrieval"]
+    index_path = resolve_path(retrieval["hash_index_path"])
+    return {
+        "ela": dict({k: analysis[k] for k in ("ela_quality", "ela_threshold")},
+                    backend=analysis.get("ela_backend", "pil")),
+        "noise": {"block_size": analysis["block_size"]},
+        "edges": {"block_size": analysis["block_size"]},
+        "exif": {"suspicious_software": config["scoring"]["suspicious_software"]},
+        "similar": lambda: dict(retrieval, index_stamp=index_stamp(index_path)),
+    }
+
+
+def fingerprint(analyzer: str, params: Dict[str, Any]) -> str:
+    raw = json.dumps({"v": CACHE_VERSION, "analyzer": analyzer, "params": params}, sort_keys=True, default=str)
+    return hashlib.sha256(raw.encode()).hexdigest()[:16]
+
+
+class ResultCache:
+    """
+    Persistent, size-bounded LRU cache of analyzer results in SQLite.
+    Entries are keyed by analyzer + image content digest + config fingerprint.
+    Scores are stored as JSON; overlays go to a separate table as PNG so a
+    scores-only lookup never reads image blobs. An overlay shares its score
+    row's key and is evicted with it. The total size is kept in `usage`,
+    updated with every write.
+    """
+
+    def __init__(self, path: Union[str, Path], max_bytes: int = 512 * 2**20):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = max_bytes
+        self._local = threading.local()
+        with self._conn() as db:
+            db.executescript(_SCHEMA)
+            if db.execute("SELECT 1 FROM usage").fetchone() is None:
+                # new file, or one written before sizes were tracked (which may hold orphan overlays)
+                db.execute("DELETE FROM overlays WHERE key NOT IN (SELECT key FROM scores)")
+                db.execute("INSERT INTO usage VALUES (0, (SELECT COALESCE(SUM(size), 0) FROM scores)"
+                           " + (SELECT COALESCE(SUM(size), 0) FROM overlays))")
+
+    def _conn(self) -> sqlite3.Connection:
+        db = getattr(self._local, "db", None)
+        if db is None:
+            db = sqlite3.connect(self.path, timeout=30)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("PRAGMA synchronous=NORMAL")
+            self._local.db = db
+        return db
+
+    @staticmethod
+    def key(analyzer: str, digest: str, fp: str) -> str:
+        return f"{analyzer}:{digest}:{fp}"
+
+    def get(self, key: str, with_overlay: bool = True) -> Any:
+        """
+        Cached result or None. Without with_overlay, a stored overlay comes back
+        as None; with it, an entry cached by a scores-only run counts as a miss.
+        """
+        db = self._conn()
+        row = db.execute("SELECT payload FROM scores WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return None
+        now = time.time()
+        result = json.loads(row[0])
+        has_overlay = isinstance(result, dict) and result.get("overlay") is True
+        if isinstance(result, dict) and result.get("overlay") is False:
+            if with_overlay:
+                return None
+            result["overlay"] = None
+        with db:
+            db.execute("UPDATE scores SET atime = ? WHERE key = ?", (now, key))
+            if has_overlay and not with_overlay:
+                result["overlay"] = None
+            elif has_overlay:
+                blob = db.execute("SELECT png FROM overlays WHERE key = ?", (key,)).fetchone()
+                if blob is None:
+                    return None  # overlay evicted on its own: recompute
+                img = Image.open(BytesIO(blob[0]))
+                img.load()
+                result["overlay"] = img
+        return result
+
+    def put(self, key: str, result: Any) -> None:
+        """Store a JSON-serializable result; a PIL 'overlay' in a dict result is stored as PNG."""
+        payload, overlay, png = result, None, None
+        if isinstance(result, dict) and "overlay" in result:
+            payload = {k: v for k, v in result.items() if k != "overlay"}
+            overlay = result["overlay"]
+            # True: PNG stored in overlays; False: scores-only entry
+            payload["overlay"] = isinstance(overlay, Image.Image)
+        if isinstance(overlay, Image.Image):
+            buf = BytesIO()
+            overlay.save(buf, format="PNG", compress_level=6)
+            png = buf.getvalue()
+        text = json.dumps(payload, default=str)
+        now = time.time()
+        db = self._conn()
+        with db:
+            freed = self._delete(db, key)
+            db.execute("INSERT INTO scores VALUES (?, ?, ?, ?, ?)", (key, key.split(":", 1)[0], text, len(text), now))
+            if png is not None:
+                db.execute("INSERT INTO overlays VALUES (?, ?, ?, ?)", (key, png, len(png), now))
+            db.execute("UPDATE usage SET bytes = bytes + ?", (len(text) + len(png or b"") - freed,))
+        self.evict()
+
+    @staticmethod
+    def _delete(db: sqlite3.Connection, key: str) -> int:
+        """Remove an entry's score and overlay rows; returns the bytes freed (usage is the caller's)."""
+        freed = 0
+        for table in ("scores", "overlays"):
+            row = db.execute(f"SELECT size FROM {table} WHERE key = ?", (key,)).fetchone()
+            if row is not None:
+                db.execute(f"DELETE FROM {table} WHERE key = ?", (key,))
+                freed += row[0]
+        return freed
+
+    def total_bytes(self) -> int:
+        return self._conn().execute("SELECT bytes FROM usage").fetchone()[0]
+
+    def evict(self) -> int:
+        """Drop least-recently-used entries until the cache fits in max_bytes; returns entries removed."""
+        db = self._conn()
+        removed = freed = 0
+        with db:
+            excess = db.execute("SELECT bytes FROM usage").fetchone()[0] - self.max_bytes
+            while freed < excess:
+                oldest = db.execute("SELECT key FROM scores ORDER BY atime LIMIT 64").fetchall()
+                if not oldest:
+                    break
+                for (key,) in oldest:
+                    if freed >= excess:
+                        break
+                    freed += self._delete(db, key)
+                    removed += 1
+            db.execute("UPDATE usage SET bytes = bytes - ?", (freed,))
+        return removed
+
+    def clear(self) -> None:
+        db = self._conn()
+        with db:
+            db.execute("DELETE FROM scores")
+            db.execute("DELETE FROM overlays")
+            db.execute("UPDATE usage SET bytes = 0")
+
+
+def cached_analyzer(cache: Optional[ResultCache], analyzer: str, params: Params,
+                    fn: Callable[[Any], Any], want_overlays: bool = True) -> Callable[[Any], Any]:
+    """
+    Wrap an analyzer taking a path/PIL image/ImageContext with a cache lookup.
+    The image digest is taken per call, so hits skip both the decode and the
+    analysis. `params` may be a callable when part of it changes at runtime.
+    Scores-only callers (want_overlays=False) never load overlay blobs.
+    """
+    if cache is None:
+        return fn
+    static_fp = None if callable(params) else fingerprint(analyzer, params)
+
+    def run(image):
+        ctx = as_context(image)
+        fp = static_fp or fingerprint(analyzer, params())
+        key = cache.key(analyzer, ctx.digest, fp)
+        with phase("cache"):
+            hit = cache.get(key, with_overlay=want_overlays)
+        if hit is not None:
+            return hit
+        result = fn(ctx)
+        with phase("serialize"):
+            cache.put(key, result)
+        return result
+    return run
+
+
+_caches: Dict[str, ResultCache] = {}
+_caches_lock = threading.Lock()
+
+
+def open_cache(config: Dict[str, Any]) -> Optional[ResultCache]:
+    """Process-wide ResultCache for the 'cache' section of config.yaml (None if disabled)."""
+    cfg = config.get("cache") or {}
+    if not cfg.get("enabled", False):
+        return None
+    path = str(resolve_path(cfg.get("path", "./data/cache/results.sqlite")))
+    with _caches_lock:
+        cache = _caches.get(path)
+        if cache is None:
+            cache = _caches[path] = ResultCache(path)
+        cache.max_bytes = int(cfg.get("max_mb", 512) * 2**20)
+        return cache
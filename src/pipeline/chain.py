@@ -1,37 +1,46 @@
 
 # src/pipeline/chain.py
 
-from typing import Dict, Any
-from pathlib import Path
-import yaml
+import asyncio
+import json
+import threading
+import time
+from concurrent.futures import Executor, ThreadPoolExecutor
+from dataclasses import replace
+from functools import partial
+from typing import Any, Awaitable, Callable, Dict, Generator, Optional, Tuple
 
 from langchain_core.runnables import RunnableLambda, RunnableParallel
 
+from src.analysis.context import ImageContext
+from src.utils.config import load_config
+from src.utils.pool import process_pool
+from src.utils.profiling import METRICS, flatten, profile_stage
+
+from .result import AnalyzerScore, ClaimResult, ExifScore, Overlay
 # Import tool factories
-from .tools import ela_tool, noise_tool, edges_tool, exif_tool, retrieval_tool
+from .tools import build_tools
 
-# ----------------------------- Config -----------------------------
-# Load config safely (works whether you run from project root or elsewhere)
-CONFIG_PATH = Path("config/config.yaml")
-if not CONFIG_PATH.exists():
-    # Fallback: try relative to this file
-    CONFIG_PATH = Path(__file__).resolve().parents[2] / "config" / "config.yaml"
+# ----------------------------- Aggregation -----------------------------
+def _analyzer_score(out: Dict[str, Any]) -> AnalyzerScore:
+    return AnalyzerScore(float(out.get("score", 0)), Overlay.from_image(out.get("overlay")),
+                         {k: v for k, v in out.items() if k not in ("score", "overlay")})
 
-with open(CONFIG_PATH, "r", encoding="utf-8") as f:
-    CONFIG = yaml.safe_load(f)
 
-# ----------------------------- Aggregation -----------------------------
-def aggregate_scores(inputs: Dict[str, Any]) -> Dict[str, Any]:
+def aggregate_scores(inputs: Dict[str, Any], weights: Optional[Dict[str, float]] = None) -> ClaimResult:
     """
     Combine tool outputs into a single scored result and build a human‑readable explanation.
-    Expect keys: 'ela', 'noise', 'edges', 'exif' — each a dict containing 'score' and optional 'overlay'.
+    Expect keys: 'ela', 'noise', 'edges', 'exif' — each a dict containing 'score' and optional 'overlay'
+    (other fields, such as ELA's 'by_quality', are kept in the AnalyzerScore's `extra`).
+    'similar' and 'timings' from the parallel stage are passed through when present.
+    `weights` defaults to scoring.weights from config.yaml.
     """
     ela = inputs["ela"]
     noise = inputs["noise"]
     edges = inputs["edges"]
     exif = inputs["exif"]
 
-    w = CONFIG["scoring"]["weights"]
+    w = weights or load_config()["scoring"]["weights"]
 
     final = (
         w["ela"] * float(ela.get("score", 0))
@@ -55,64 +64,236 @@ def aggregate_scores(inputs: Dict[str, Any]) -> Dict[str, Any]:
     # IMPORTANT: join with "\n" in ONE string (avoids unterminated literal)
     explanation_text = "\n".join(explanation_lines)
 
-    return {
-        "final_score": float(final),
-        "explanation": explanation_text,
-        "ela":   {"score": ela.get("score", 0),   "overlay": ela.get("overlay")},
-        "noise": {"score": noise.get("score", 0), "overlay": noise.get("overlay")},
-        "edges": {"score": edges.get("score", 0), "overlay": edges.get("overlay")},
-        "exif":  {
-            "score": exif.get("score", 0),
-            "software": exif.get("software"),
-            "flags": exif.get("flags", []),
-            "has_exif": exif.get("has_exif", False),
-        },
-    }
-
-def attach_overlays(inputs: Dict[str, Any]) -> Dict[str, Any]:
+    return ClaimResult(
+        final_score=float(final),
+        explanation=explanation_text,
+        ela=_analyzer_score(ela),
+        noise=_analyzer_score(noise),
+        edges=_analyzer_score(edges),
+        exif=ExifScore(
+            score=float(exif.get("score", 0)),
+            software=exif.get("software"),
+            flags=list(exif.get("flags", [])),
+            has_exif=bool(exif.get("has_exif", False)),
+        ),
+        similar=inputs.get("similar", []),
+        timings=dict(inputs.get("timings", {})),
+    )
+
+def read_image(inputs: Dict[str, Any]) -> Dict[str, Any]:
     """
-    Flatten overlay paths into top‑level keys expected by the UI tabs.
+    Read the claim file once into an ImageContext shared by every branch; the
+    first branch that needs pixels decodes it (its '<branch>.decode' phase).
     """
     out = dict(inputs)
-    out["ela_overlay"] = inputs.get("ela", {}).get("overlay")
-    out["noise_overlay"] = inputs.get("noise", {}).get("overlay")
-    out["edges_overlay"] = inputs.get("edges", {}).get("overlay")
+    if not isinstance(out.get("context"), ImageContext):
+        out["context"] = ImageContext.open(inputs["image_path"])
     return out
 
-def add_similarity(inputs: Dict[str, Any], sim: Any) -> Dict[str, Any]:
+def timed(fn, trace_memory: bool = False):
     """
-    Attach list of similar items from retrieval tool.
+    Wrap a branch so it returns (result, profile) for split_timings(): seconds
+    spent in decode/load/cache/serialize phases, the compute remainder, the
+    total and, with trace_memory, the peak allocation in MB.
     """
-    out = dict(inputs)
-    out["similar"] = sim
+    def run(inputs: Dict[str, Any]):
+        return profile_stage(fn, inputs, trace_memory=trace_memory)
+    return run
+
+def split_timings(inputs: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Unpack timed branch outputs into plain results plus a flat 'timings' dict:
+    seconds per branch under its name and per phase under 'branch.phase'.
+    """
+    out = {name: value[0] for name, value in inputs.items()}
+    out["timings"] = {}
+    for name, value in inputs.items():
+        out["timings"].update(flatten(name, value[1]))
     return out
 
+def inline(fn) -> RunnableLambda:
+    """
+    A RunnableLambda for cheap pure-Python steps: ainvoke calls it directly on
+    the event loop instead of hopping to the default executor.
+    """
+    async def afn(inputs):
+        return fn(inputs)
+    return RunnableLambda(fn, afunc=afn)
+
+# ----------------------------- Executors -----------------------------
+_executors: Dict[Tuple[str, Optional[int]], Executor] = {}
+_executors_lock = threading.Lock()
+
+def get_executor(kind: str = "thread", max_workers: Optional[int] = None) -> Executor:
+    """
+    Process-wide executor the async chain offloads CPU work to. 'thread' runs
+    the branches of a claim concurrently; 'process' runs whole claims on a
+    spawn pool (sidesteps the GIL for pure-Python parts, costs a pickle of
+    the image bytes and the result per claim).
+    """
+    if kind not in ("thread", "process"):
+        raise ValueError(f"Unknown executor kind {kind!r}; expected 'thread' or 'process'")
+    key = (kind, max_workers)
+    with _executors_lock:
+        executor = _executors.get(key)
+        if executor is None:
+            if kind == "process":
+                executor = process_pool(max_workers)
+            else:
+                executor = ThreadPoolExecutor(max_workers, thread_name_prefix="chain")
+            _executors[key] = executor
+        return executor
+
+# ----------------------------- Claim flow -----------------------------
+# One claim as a generator of steps, so invoke and ainvoke share the triage,
+# timing and metrics logic and differ only in how a step runs: it yields
+# (step, argument) for "read" (inputs -> inputs with a context), "preview"
+# (context -> preview context or None) and "score" (claim -> (ClaimResult,
+# the raw outputs of the SHARED branches)). A claim with a "preview" runs the
+# FORENSIC branches on it; one with "shared" reuses those outputs instead of
+# running the SHARED branches again.
+FORENSIC = ("ela", "noise", "edges")
+SHARED = ("exif", "similar")
+Step = Tuple[str, Any]
+
+def claim_flow(inputs: Dict[str, Any], triage: Dict[str, Any]) -> Generator[Step, Any, ClaimResult]:
+    start = time.perf_counter()
+    inputs = yield "read", inputs
+    read = time.perf_counter()
+    preview = (yield "preview", inputs["context"]) if triage.get("enabled") else None
+    if preview is None:
+        out, _ = yield "score", inputs
+        out.stage, out.preview_score = "full", None
+    else:
+        out, shared = yield "score", dict(inputs, preview=preview)
+        out.stage, out.preview_score = "preview", out.final_score
+        if out.final_score >= triage.get("escalate_threshold", 0.3):
+            preview_seconds = time.perf_counter() - read
+            full, _ = yield "score", dict(inputs, shared=shared)
+            out = replace(full, stage="full", preview_score=out.final_score)
+            out.timings["preview"] = preview_seconds
+    out.timings["read"] = read - start
+    out.timings["total"] = time.perf_counter() - start
+    METRICS.observe(out.timings)
+    return out
+
+def run_flow(flow: Generator[Step, Any, ClaimResult], steps: Dict[str, Callable[[Any], Any]]) -> ClaimResult:
+    step, arg = next(flow)
+    while True:
+        try:
+            step, arg = flow.send(steps[step](arg))
+        except StopIteration as done:
+            return done.value
+
+async def arun_flow(flow: Generator[Step, Any, ClaimResult],
+                    steps: Dict[str, Callable[[Any], Awaitable[Any]]]) -> ClaimResult:
+    step, arg = next(flow)
+    while True:
+        try:
+            step, arg = flow.send(await steps[step](arg))
+        except StopIteration as done:
+            return done.value
+
+_process_chains: Dict[Tuple[str, bool], RunnableLambda] = {}
+
+def _invoke_in_process(config_json: str, want_overlays: bool, inputs: Dict[str, Any]) -> ClaimResult:
+    """Process-pool entry point: run the sync chain for one claim in a worker."""
+    key = (config_json, want_overlays)
+    chain = _process_chains.get(key)
+    if chain is None:
+        chain = _process_chains[key] = load_chain(json.loads(config_json), want_overlays)
+    # overlays are handed over to the caller through shared memory instead of a pickle copy
+    return chain.invoke(inputs).share_overlays()
+
 # ----------------------------- Chain loader -----------------------------
-def load_chain() -> RunnableLambda:
+def load_chain(config: Optional[Dict[str, Any]] = None, want_overlays: bool = True) -> RunnableLambda:
     """
     Build the runnable graph:
-      1) Run ELA, Noise, Edges, EXIF in parallel
-      2) Aggregate scores + explanation
-      3) Attach overlays
-      4) Run similarity retrieval and attach results
+      0) Read the image file once into a shared ImageContext (decoded on first use)
+      1) Run ELA, Noise, Edges, EXIF and similarity retrieval in parallel
+      2) Aggregate scores + explanation into a ClaimResult (see .result)
+    Per-branch wall-clock seconds land under result.timings, next to the
+    file read time and the end-to-end total; 'ela.decode', 'ela.compute', ... split
+    each stage further (see src.utils.profiling) and every result is recorded
+    in the process-wide Prometheus metrics (METRICS.render()).
+    With profiling.trace_memory the branches run one at a time under
+    tracemalloc so each stage also reports its own 'peak_mb'.
+    Tools are built once here and reused by every invocation of the returned chain;
+    use get_chain() from .registry to share one chain per process.
+    With want_overlays=False the analyzers skip rendering overlay images and the
+    overlays are None — the fast path for batch and calibration callers.
+    With triage enabled in config.yaml, ELA, noise and edges first run on a
+    downscaled preview (EXIF and retrieval run once, on the original);
+    result.stage says whether the preview ("preview") or the full-resolution
+    pass ("full") decided the score, and result.preview_score keeps the
+    preview's score.
+    `await chain.ainvoke(...)` never blocks the event loop: file reads go to a
+    worker thread and analysis to the executor from the 'executor' section of
+    config.yaml (see get_executor), so one loop can keep many claims in flight.
     """
-    # Each tool returns a callable client; we call .run(image_path) inside the lambda
-    ela   = RunnableLambda(lambda inputs: ela_tool().run(inputs["image_path"]))
-    noise = RunnableLambda(lambda inputs: noise_tool().run(inputs["image_path"]))
-    edges = RunnableLambda(lambda inputs: edges_tool().run(inputs["image_path"]))
-    exif  = RunnableLambda(lambda inputs: exif_tool().run(inputs["image_path"]))
-    sim   = RunnableLambda(lambda inputs: retrieval_tool().run(inputs["image_path"]))
-
-    # Step 1: parallel execution for speed
-    parallel = RunnableParallel(ela=ela, noise=noise, edges=edges, exif=exif)
-
-    # Step 2 & 3: aggregate -> attach overlays
-    chain = parallel | RunnableLambda(aggregate_scores) | RunnableLambda(attach_overlays)
-
-    # Step 4: similarity retrieval and final merge
-    def full_chain(inputs: Dict[str, Any]) -> Dict[str, Any]:
-        intermediate = chain.invoke(inputs)
-        similar = sim.invoke(inputs)
-        return add_similarity(intermediate, similar)
-
-    return RunnableLambda(full_chain)
+    config = config or load_config()
+    tools = build_tools(config, want_overlays)
+
+    trace_memory = bool((config.get("profiling") or {}).get("trace_memory", False))
+
+    executor_cfg = config.get("executor") or {}
+    executor_kind = executor_cfg.get("kind", "thread")
+    max_workers = executor_cfg.get("max_workers")
+    config_json = json.dumps(config, default=str)
+
+    def branch(name: str) -> RunnableLambda:
+        # Each tool is a callable client; we call .run(context) inside the lambda.
+        # Only the forensic analyzers look at a triage preview.
+        key = "preview" if name in FORENSIC else "context"
+        run = timed(lambda inputs: tools[name].run({"image": inputs.get(key, inputs["context"])}), trace_memory)
+
+        async def arun(inputs: Dict[str, Any]):
+            return await asyncio.get_running_loop().run_in_executor(get_executor("thread", max_workers), run, inputs)
+        return RunnableLambda(run, afunc=arun)
+
+    # Step 1: parallel execution for speed; retrieval does not depend on the scores.
+    # An escalated claim re-runs only the forensic branches and reuses the rest.
+    parallel = RunnableParallel(**{name: branch(name) for name in FORENSIC + SHARED})
+    reparallel = RunnableParallel(**{name: branch(name) for name in FORENSIC},
+                                  **{name: inline(lambda inputs, name=name: inputs["shared"][name]) for name in SHARED})
+
+    # Step 2: aggregate into a ClaimResult
+    aggregate = partial(aggregate_scores, weights=config["scoring"]["weights"])
+
+    def aggregate_stage(outputs: Dict[str, Any]) -> Tuple[ClaimResult, Dict[str, Any]]:
+        out, profile = profile_stage(aggregate, split_timings(outputs), trace_memory=trace_memory)
+        out.timings.update(flatten("aggregate", profile))
+        return out, {name: outputs[name] for name in SHARED}
+
+    chain, rechain = parallel | inline(aggregate_stage), reparallel | inline(aggregate_stage)
+    run_config = {"max_concurrency": 1} if trace_memory else None
+
+    # Optional two-stage triage: score a downscaled preview first and only
+    # escalate to full resolution when the cheap score looks suspicious.
+    # EXIF and retrieval always see the original image, once per claim.
+    triage = config.get("triage") or {}
+
+    max_side = triage.get("preview_max_side", 1024)
+
+    def full_chain(inputs: Dict[str, Any]) -> ClaimResult:
+        return run_flow(claim_flow(inputs, triage), {
+            "read": read_image,
+            "preview": lambda context: context.preview(max_side),
+            "score": lambda claim: (rechain if "shared" in claim else chain).invoke(claim, run_config),
+        })
+
+    async def afull_chain(inputs: Dict[str, Any]) -> ClaimResult:
+        if executor_kind == "process":
+            # Whole claims go to the pool; contexts travel as their encoded bytes
+            loop = asyncio.get_running_loop()
+            out = await loop.run_in_executor(get_executor("process", max_workers), _invoke_in_process,
+                                             config_json, want_overlays, inputs)
+            METRICS.observe(out.timings)
+            return out
+        return await arun_flow(claim_flow(inputs, triage), {
+            "read": partial(asyncio.to_thread, read_image),
+            "preview": lambda context: asyncio.to_thread(context.preview, max_side),
+            "score": lambda claim: (rechain if "shared" in claim else chain).ainvoke(claim, run_config),
+        })
+
+    return RunnableLambda(full_chain, afunc=afull_chain)
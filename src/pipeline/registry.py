@@ -0,0 +1,66 @@
+
+# src/pipeline/registry.py
+
+import hashlib
+import threading
+from pathlib import Path
+from typing import Any, Dict, Optional, Union
+
+import yaml
+from langchain_core.runnables import RunnableLambda
+
+from src.utils.config import CONFIG_PATH, file_stamp
+
+from .chain import load_chain
+
+
+class ChainRegistry:
+    """
+    Holds one compiled chain (and its tools) per process and overlay mode.
+    The chain is rebuilt only when config.yaml actually changes: a cheap
+    (mtime, size) check runs on every get(), and the file is re-hashed only
+    when that stamp moves, so touching the file without edits is a no-op.
+    """
+
+    def __init__(self, config_path: Union[str, Path] = CONFIG_PATH):
+        self.config_path = Path(config_path)
+        self.config: Optional[Dict[str, Any]] = None
+        self._chains: Dict[bool, RunnableLambda] = {}
+        self._stamp = None
+        self._digest: Optional[str] = None
+        self._lock = threading.Lock()
+
+    def get(self, want_overlays: bool = True) -> RunnableLambda:
+        stamp = file_stamp(self.config_path)
+        chain = self._chains.get(want_overlays)
+        if chain is not None and stamp == self._stamp:
+            return chain
+        with self._lock:
+            if stamp != self._stamp or self.config is None:
+                self._reload(stamp)
+            if want_overlays not in self._chains:
+                self._chains[want_overlays] = load_chain(self.config, want_overlays)
+            return self._chains[want_overlays]
+
+    def _reload(self, stamp) -> None:
+        raw = self.config_path.read_bytes()
+        digest = hashlib.sha256(raw).hexdigest()
+        if self.config is None or digest != self._digest:
+            self.config = yaml.safe_load(raw)
+            self._chains = {}
+            self._digest = digest
+        self._stamp = stamp
+
+
+_default = ChainRegistry()
+
+
+def get_chain(want_overlays: bool = True) -> RunnableLambda:
+    """Process-wide chain, hot-reloaded when config.yaml changes."""
+    return _default.get(want_overlays)
+
+
+def get_config() -> Dict[str, Any]:
+    """Config snapshot the process-wide chain was built from."""
+    _default.get()
+    return _default.config
@@ -0,0 +1,249 @@
+
+# src/pipeline/result.py
+
+import base64
+import json
+import struct
+import weakref
+from dataclasses import dataclass, field
+from io import BytesIO
+from multiprocessing import resource_tracker, shared_memory
+from typing import Any, Dict, List, Optional, Tuple, Union
+
+import numpy as np
+from PIL import Image
+
+OVERLAY_NAMES = ("ela", "noise", "edges")
+_MAGIC = b"CLR1"
+
+
+class Overlay:
+    """
+    An analyzer overlay held once, as a uint8 RGB array or as PNG bytes,
+    converting to the other form (or a PIL image) only on demand.
+    share() moves the pixels into shared memory and hand_over() gives the
+    segment away: from then on pickling sends only a handle, and the one
+    process that unpickles it maps the same pages and takes over the segment.
+    Pickling has no side effects; an overlay that was not handed over is
+    pickled by value.
+    """
+    __slots__ = ("_array", "_png", "_shm", "_owned", "_handed_over", "__weakref__")
+
+    def __init__(self, array: Optional[np.ndarray] = None, png: Optional[bytes] = None):
+        if array is None and png is None:
+            raise ValueError("Overlay needs an array or PNG bytes")
+        self._array = array
+        self._png = png
+        self._shm = None
+        self._owned = [False]
+        self._handed_over = False
+
+    @classmethod
+    def from_image(cls, image: Union[Image.Image, np.ndarray, "Overlay", None]) -> Optional["Overlay"]:
+        if image is None or isinstance(image, Overlay):
+            return image
+        arr = np.asarray(image.convert("RGB") if isinstance(image, Image.Image) and image.mode != "RGB" else image)
+        return cls(array=arr)
+
+    @property
+    def array(self) -> np.ndarray:
+        if self._array is None:
+            with Image.open(BytesIO(self._png)) as img:
+                self._array = np.asarray(img.convert("RGB"))
+        return self._array
+
+    @property
+    def png(self) -> bytes:
+        if self._png is None:
+            buf = BytesIO()
+            Image.fromarray(self._array).save(buf, format="PNG")
+            self._png = buf.getvalue()
+        return self._png
+
+    @property
+    def image(self) -> Image.Image:
+        return Image.fromarray(self.array)
+
+    @property
+    def shape(self) -> Tuple[int, ...]:
+        return self.array.shape
+
+    def share(self) -> "Overlay":
+        """Move the pixels into shared memory so pickling this overlay is zero-copy."""
+        if self._shm is None:
+            src = self.array
+            shm = shared_memory.SharedMemory(create=True, size=max(1, src.nbytes))
+            arr = np.ndarray(src.shape, dtype=np.uint8, buffer=shm.buf)
+            arr[...] = src
+            self._array, self._shm, self._owned = arr, shm, [True]
+            weakref.finalize(self, _release, shm, self._owned)
+        return self
+
+    def hand_over(self) -> "Overlay":
+        """
+        Give the shared segment to whoever unpickles this overlay next; this
+        process stops owning it (and no longer unlinks it). Send it once.
+        """
+        if self._shm is None:
+            raise ValueError("hand_over() needs a shared overlay; call share() first")
+        if self._owned[0]:
+            self._owned[0] = False
+            resource_tracker.unregister(self._shm._name, "shared_memory")
+            self._handed_over = True
+        return self
+
+    def __reduce__(self):
+        if self._handed_over:
+            return _attach, (self._shm.name, self._array.shape)
+        if self._shm is not None:
+            return Overlay, (np.array(self._array), self._png)
+        return Overlay, (self._array, self._png)
+
+    def __repr__(self):
+        kind = "shared" if self._shm is not None else ("array" if self._array is not None else "png")
+        return f"Overlay({kind}, {'x'.join(map(str, self.shape)) if self._array is not None else len(self._png)})"
+
+
+def _release(shm: shared_memory.SharedMemory, owned: List[bool]) -> None:
+    try:
+        shm.close()
+    except BufferError:
+        pass  # an array view outlived the overlay; the mapping goes with it
+    if owned[0]:
+        shm.unlink()
+
+
+def _attach(name: str, shape: Tuple[int, ...]) -> Overlay:
+    """Unpickle a shared overlay: map the sender's segment and take it over."""
+    shm = shared_memory.SharedMemory(name=name)
+    # Drop the name right away; the pages live until this mapping is closed
+    shm.unlink()
+    overlay = Overlay(array=np.ndarray(shape, dtype=np.uint8, buffer=shm.buf))
+    overlay._shm = shm
+    weakref.finalize(overlay, _release, shm, [False])
+    return overlay
+
+
+class _Mapping:
+    """Read-only dict-style access (result["score"]) for code written against the old dicts."""
+    __slots__ = ()
+
+    def __getitem__(self, key: str) -> Any:
+        try:
+            return getattr(self, key)
+        except AttributeError:
+            raise KeyError(key) from None
+
+    def get(self, key: str, default: Any = None) -> Any:
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+
+@dataclass(slots=True)
+class AnalyzerScore(_Mapping):
+    """An analyzer's score and overlay; any other fields it returned (ELA's "by_quality") are in `extra`."""
+    score: float
+    overlay: Optional[Overlay] = None
+    extra: Dict[str, Any] = field(default_factory=dict)
+
+    def __getitem__(self, key: str) -> Any:
+        if key in self.extra:
+            return self.extra[key]
+        return _Mapping.__getitem__(self, key)
+
+
+@dataclass(slots=True)
+class ExifScore(_Mapping):
+    score: float
+    software: Optional[str] = None
+    flags: List[str] = field(default_factory=list)
+    has_exif: bool = False
+
+
+@dataclass(slots=True)
+class ClaimResult(_Mapping):
+    """
+    One scored claim: what aggregate_scores() used to return as nested dicts.
+    Overlays are stored once (result.ela.overlay); `result["ela_overlay"]`
+    and the other dict-style reads remain for existing callers.
+    """
+    final_score: float
+    explanation: str
+    ela: AnalyzerScore
+    noise: AnalyzerScore
+    edges: AnalyzerScore
+    exif: ExifScore
+    similar: List[Dict[str, Any]] = field(default_factory=list)
+    timings: Dict[str, float] = field(default_factory=dict)
+    stage: str = "full"
+    preview_score: Optional[float] = None
+
+    # ---- dict-style access ----
+    def __getitem__(self, key: str) -> Any:
+        if key.endswith("_overlay") and key[:-len("_overlay")] in OVERLAY_NAMES:
+            return getattr(self, key[:-len("_overlay")]).overlay
+        return _Mapping.__getitem__(self, key)
+
+    def share_overlays(self) -> "ClaimResult":
+        """
+        Put overlays in shared memory and hand them over (Overlay.hand_over) to
+        the process this result is sent to next; send it to exactly one.
+        """
+        for name in OVERLAY_NAMES:
+            overlay = getattr(self, name).overlay
+            if overlay is not None:
+                overlay.share().hand_over()
+        return self
+
+    # ---- serialization ----
+    def to_dict(self, overlays: bool = False) -> Dict[str, Any]:
+        """Plain JSON-ready dict; overlays as base64 PNG strings when requested, else None."""
+        out: Dict[str, Any] = {"final_score": self.final_score, "explanation": self.explanation}
+        for name in OVERLAY_NAMES:
+            part = getattr(self, name)
+            encoded = base64.b64encode(part.overlay.png).decode("ascii") if overlays and part.overlay else None
+            out[name] = {"score": part.score, "overlay": encoded, **part.extra}
+        out["exif"] = {"score": self.exif.score, "software": self.exif.software,
+                       "flags": list(self.exif.flags), "has_exif": self.exif.has_exif}
+        out.update(similar=self.similar, timings=self.timings, stage=self.stage, preview_score=self.preview_score)
+        return out
+
+    def to_json(self, overlays: bool = False) -> str:
+        return json.dumps(self.to_dict(overlays), default=str)
+
+    def to_bytes(self, overlays: bool = True) -> bytes:
+        """Compact binary form: magic, JSON scores, then one length-prefixed PNG per overlay."""
+        header = self.to_json().encode()
+        parts = [_MAGIC, struct.pack("<I", len(header)), header]
+        for name in OVERLAY_NAMES:
+            overlay = getattr(self, name).overlay
+            png = overlay.png if overlays and overlay is not None else b""
+            parts += [struct.pack("<I", len(png)), png]
+        return b"".join(parts)
+
+    @classmethod
+    def from_bytes(cls, raw: bytes) -> "ClaimResult":
+        if raw[:4] != _MAGIC:
+            raise ValueError("not a serialized ClaimResult")
+        (n,) = struct.unpack_from("<I", raw, 4)
+        pos = 8 + n
+        result = cls.from_dict(json.loads(raw[8:pos]))
+        for name in OVERLAY_NAMES:
+            (n,) = struct.unpack_from("<I", raw, pos)
+            if n:
+                getattr(result, name).overlay = Overlay(png=raw[pos + 4:pos + 4 + n])
+            pos += 4 + n
+        return result
+
+    @classmethod
+    def from_dict(cls, d: Dict[str, Any]) -> "ClaimResult":
+        parts = {}
+        for name in OVERLAY_NAMES:
+            png = d[name].get("overlay")
+            parts[name] = AnalyzerScore(d[name]["score"], Overlay(png=base64.b64decode(png)) if png else None,
+                                        {k: v for k, v in d[name].items() if k not in ("score", "overlay")})
+        return cls(final_score=d["final_score"], explanation=d["explanation"], exif=ExifScore(**d["exif"]),
+                   similar=d.get("similar", []), timings=d.get("timings", {}), stage=d.get("stage", "full"),
+                   preview_score=d.get("preview_score"), **parts)
@@ -0,0 +1,304 @@
+
+# src/pipeline/service.py
+#
+# Standalone HTTP scoring service (stdlib only, no web framework needed):
+#   python -m src.pipeline.service --port 8080 --workers 4
+#
+#   curl -X POST localhost:8080/score -H 'Content-Type: application/json' \
+#        -d '{"image_path": "data/input/sample_edited.jpg"}'
+#   curl -X POST 'localhost:8080/score?overlays=1' -H 'Content-Type: image/jpeg' \
+#        --data-binary @claim.jpg
+#   curl localhost:8080/metrics
+
+import argparse
+import base64
+import json
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from concurrent.futures import TimeoutError as FutureTimeout
+from dataclasses import dataclass
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Dict, List, Optional, Tuple
+from urllib.parse import parse_qs, urlparse
+
+from src.utils.config import load_config, resolve_path
+from src.utils.pool import process_pool
+from src.utils.profiling import METRICS
+
+
+class QueueFull(Exception):
+    """Raised by ScoringService.submit when the request queue is at capacity."""
+
+
+# ----------------------------- Worker -----------------------------
+def score_job(payload: Dict[str, Any], want_overlays: bool) -> Dict[str, Any]:
+    """Score one request in a worker: an uploaded image ('data') or a server-side 'image_path'."""
+    from src.analysis.context import ImageContext
+    from .registry import get_chain
+    try:
+        if "data" in payload:
+            inputs = {"context": ImageContext(data=payload["data"], path=payload.get("name"))}
+        else:
+            inputs = {"image_path": payload["image_path"]}
+        # ClaimResult.to_dict: overlays as base64 PNG strings when requested
+        return get_chain(want_overlays=want_overlays).invoke(inputs).to_dict(overlays=want_overlays)
+    except Exception as e:
+        return {"error": f"{type(e).__name__}: {e}"}
+
+
+def score_batch(jobs: List[Tuple[Dict[str, Any], bool]]) -> List[Dict[str, Any]]:
+    """Worker entry point: one pool task per micro-batch amortizes the IPC round trip."""
+    return [score_job(payload, want_overlays) for payload, want_overlays in jobs]
+
+
+# ----------------------------- Dispatcher -----------------------------
+@dataclass
+class _Job:
+    payload: Dict[str, Any]
+    want_overlays: bool
+    future: Future
+
+
+class ScoringService:
+    """
+    Bounded request queue in front of a process pool. A dispatcher thread
+    waits for an idle worker, then hands it the requests that arrived within
+    batch_wait_ms (up to batch_size) as one pool task, so batches never queue
+    up behind a busy worker. While other workers are idle it does not wait
+    and splits the backlog between them. When the queue is full, submit()
+    raises QueueFull so callers can shed load. workers=0 scores in the
+    dispatcher thread instead of a pool.
+    """
+
+    def __init__(self, workers: Optional[int] = None, max_queue: int = 64,
+                 batch_size: int = 8, batch_wait_ms: float = 10.0):
+        self.queue: "queue.Queue[Optional[_Job]]" = queue.Queue(maxsize=max_queue)
+        self.batch_size = max(1, batch_size)
+        self.batch_wait = batch_wait_ms / 1000
+        self.workers = (os.cpu_count() or 1) if workers is None else workers
+        self.pool = process_pool(self.workers) if self.workers > 0 else None
+        self._idle = max(1, self.workers)
+        self._idle_changed = threading.Condition()
+        self._thread = threading.Thread(target=self._dispatch, name="scoring-dispatcher", daemon=True)
+        self._thread.start()
+        self.rejected = 0
+
+    def submit(self, payload: Dict[str, Any], want_overlays: bool = False) -> Future:
+        job = _Job(payload, want_overlays, Future())
+        try:
+            self.queue.put_nowait(job)
+        except queue.Full:
+            self.rejected += 1
+            raise QueueFull(f"{self.queue.maxsize} requests already queued") from None
+        return job.future
+
+    def score(self, payload: Dict[str, Any], want_overlays: bool = False,
+              timeout: Optional[float] = None) -> Dict[str, Any]:
+        return self.submit(payload, want_overlays).result(timeout)
+
+    # ----- Worker slots -----
+    def _take_worker(self) -> int:
+        """Wait for an idle worker and claim it; returns how many others are still idle."""
+        with self._idle_changed:
+            self._idle_changed.wait_for(lambda: self._idle > 0)
+            self._idle -= 1
+            return self._idle
+
+    def _free_worker(self) -> None:
+        with self._idle_changed:
+            self._idle += 1
+            self._idle_changed.notify()
+
+    def _next_batch(self) -> Optional[List[_Job]]:
+        job = self.queue.get()
+        if job is None:
+            return None
+        batch = [job]
+        others_idle = self._take_worker()
+        if others_idle:
+            # no waiting while other workers are idle; leave them their share of the backlog
+            limit, deadline = min(self.batch_size, -(-(1 + self.queue.qsize()) // (others_idle + 1))), 0.0
+        else:
+            limit, deadline = self.batch_size, time.monotonic() + self.batch_wait
+        while len(batch) < limit:
+            remaining = deadline - time.monotonic()
+            try:
+                job = self.queue.get(timeout=remaining) if remaining > 0 else self.queue.get_nowait()
+            except queue.Empty:
+                break
+            if job is None:
+                self.queue.put(None)  # let the loop see the stop marker after this batch
+                break
+            batch.append(job)
+        return batch
+
+    def _dispatch(self) -> None:
+        while True:
+            batch = self._next_batch()
+            if batch is None:
+                return
+            jobs = [(j.payload, j.want_overlays) for j in batch]
+            if self.pool is None:
+                # the chain records its own metrics when it runs in this process
+                self._finish(batch, score_batch(jobs), observe=False)
+                continue
+            try:
+                self.pool.submit(score_batch, jobs).add_done_callback(lambda f, b=batch: self._resolve(b, f))
+            except Exception as e:
+                # a dead worker breaks the whole pool: fail this batch and start a fresh one
+                self._fail(batch, e)
+                self.pool.shutdown(wait=False)
+                self.pool = process_pool(self.workers)
+
+    def _resolve(self, batch: List[_Job], done: Future) -> None:
+        error = done.exception()
+        if error is not None:
+            self._fail(batch, error)
+            return
+        # the worker's chain recorded the metrics in the worker process; record them here for /metrics
+        self._finish(batch, done.result(), observe=True)
+
+    def _fail(self, batch: List[_Job], error: BaseException) -> None:
+        self._free_worker()
+        for job in batch:
+            job.future.set_exception(error)
+
+    def _finish(self, batch: List[_Job], results: List[Dict[str, Any]], observe: bool) -> None:
+        self._free_worker()
+        for job, result in zip(batch, results):
+            if observe and "error" not in result:
+                METRICS.observe(result.get("timings", {}))
+            job.future.set_result(result)
+
+    def close(self) -> None:
+        self.queue.put(None)
+        self._thread.join()
+        if self.pool is not None:
+            self.pool.shutdown()
+
+
+# ----------------------------- HTTP -----------------------------
+class _Handler(BaseHTTPRequestHandler):
+    service: ScoringService
+    settings: Dict[str, Any]
+
+    def _send(self, status: int, body: Any, content_type: str = "application/json",
+              headers: Optional[Dict[str, str]] = None) -> None:
+        raw = body.encode() if isinstance(body, str) else json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(raw)))
+        for k, v in (headers or {}).items():
+            self.send_header(k, v)
+        self.end_headers()
+        self.wfile.write(raw)
+
+    def do_GET(self):
+        path = urlparse(self.path).path
+        if path == "/healthz":
+            self._send(200, {"status": "ok", "queued": self.service.queue.qsize(), "rejected": self.service.rejected})
+        elif path == "/metrics":
+            self._send(200, METRICS.render(), "text/plain; version=0.0.4")
+        else:
+            self._send(404, {"error": "not found"})
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        if url.path != "/score":
+            return self._send(404, {"error": "not found"})
+        length = int(self.headers.get("Content-Length") or 0)
+        if length > self.settings["max_upload_bytes"]:
+            return self._send(413, {"error": f"body larger than {self.settings['max_upload_bytes']} bytes"})
+        body = self.rfile.read(length)
+        want_overlays = parse_qs(url.query).get("overlays", ["0"])[0].lower() in ("1", "true", "yes")
+
+        try:
+            payload, want_overlays = self._parse(body, want_overlays)
+        except (ValueError, KeyError) as e:
+            return self._send(400, {"error": str(e)})
+        except PermissionError as e:
+            return self._send(403, {"error": str(e)})
+        except FileNotFoundError as e:
+            return self._send(404, {"error": str(e)})
+
+        try:
+            result = self.service.score(payload, want_overlays, timeout=self.settings["timeout_s"])
+        except QueueFull as e:
+            return self._send(503, {"error": f"busy: {e}"}, headers={"Retry-After": "1"})
+        except FutureTimeout:
+            return self._send(504, {"error": "scoring timed out"})
+        except Exception as e:
+            return self._send(500, {"error": f"{type(e).__name__}: {e}"})
+        if "error" in result:
+            return self._send(422, result)
+        self._send(200, result)
+
+    def _parse(self, body: bytes, want_overlays: bool) -> Tuple[Dict[str, Any], bool]:
+        """JSON {"image_path" | "image_base64", "overlays"} or a raw image body."""
+        if not (self.headers.get("Content-Type") or "").startswith("application/json"):
+            if not body:
+                raise ValueError("empty upload")
+            return {"data": body, "name": self.headers.get("X-Filename")}, want_overlays
+        req = json.loads(body or b"{}")
+        want_overlays = bool(req.get("overlays", want_overlays))
+        if "image_base64" in req:
+            return {"data": base64.b64decode(req["image_base64"]), "name": req.get("name")}, want_overlays
+        # '..' and symlinks are resolved before the root check; every component
+        # of an existing file resolves, so is_file() below sees the real target
+        path = resolve_path(req["image_path"]).resolve()
+        if not any(path.is_relative_to(root) for root in self.settings["allowed_roots"]):
+            raise PermissionError(f"{req['image_path']} is outside the allowed image roots")
+        if not path.is_file():
+            raise FileNotFoundError(f"{req['image_path']} not found")
+        return {"image_path": str(path)}, want_overlays
+
+    def log_message(self, fmt, *args):
+        if self.settings.get("access_log"):
+            super().log_message(fmt, *args)
+
+
+def make_server(service: ScoringService, host: str = "127.0.0.1", port: int = 8080,
+                config: Optional[Dict[str, Any]] = None) -> ThreadingHTTPServer:
+    """HTTP server bound to host:port (port 0 picks a free one) answering from `service`."""
+    cfg = (config or load_config()).get("service") or {}
+    settings = {
+        "allowed_roots": [resolve_path(r).resolve() for r in cfg.get("allowed_roots", ["./data"])],
+        "max_upload_bytes": int(cfg.get("max_upload_mb", 32) * 2**20),
+        "timeout_s": cfg.get("timeout_s", 60),
+        "access_log": cfg.get("access_log", False),
+    }
+    handler = type("ScoringHandler", (_Handler,), {"service": service, "settings": settings})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    return server
+
+
+def main():
+    cfg = load_config().get("service") or {}
+    ap = argparse.ArgumentParser(description="HTTP scoring service for claim images.")
+    ap.add_argument("--host", default=cfg.get("host", "127.0.0.1"))
+    ap.add_argument("--port", type=int, default=cfg.get("port", 8080))
+    ap.add_argument("--workers", type=int, default=cfg.get("workers"))
+    ap.add_argument("--max-queue", type=int, default=cfg.get("max_queue", 64))
+    ap.add_argument("--batch-size", type=int, default=cfg.get("batch_size", 8))
+    ap.add_argument("--batch-wait-ms", type=float, default=cfg.get("batch_wait_ms", 10))
+    args = ap.parse_args()
+
+    service = ScoringService(args.workers, args.max_queue, args.batch_size, args.batch_wait_ms)
+    server = make_server(service, args.host, args.port)
+    print(f"Scoring service on http://{args.host}:{server.server_address[1]} "
+          f"(POST /score, GET /healthz, GET /metrics)")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        service.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,38 +1,89 @@
+from typing import Any, Dict, Optional
 
 from langchain_core.tools import Tool
-from PIL import Image
-import yaml
-from pathlib import Path
 
+from src.analysis.context import as_context
 from src.analysis.ela import compute_ela
 from src.analysis.noise import block_noise_score
 from src.analysis.edges import edge_inconsistency
 from src.analysis.exif import inspect_exif
 from src.retrieval.simple_hash import nearest
+from src.utils.config import load_config, resolve_path
+from .cache import analyzer_params, cached_analyzer, open_cache
 
-CONFIG = yaml.safe_load(open(Path('config/config.yaml'), 'r'))
+# Every tool takes either an image path or a shared ImageContext, so a chain can
+# decode the claim once and hand the same context to all branches.
+# Factories take the config dict to bind; without one they read config/config.yaml.
+# want_overlays=False builds scores-only tools that skip rendering overlay images.
+# analysis.memory_budget_mb caps the analyzers' working buffers: larger frames are
+# processed in block-aligned strips with identical scores.
 
+def budget_bytes(cfg: Dict[str, Any]) -> Optional[int]:
+    budget = cfg.get('memory_budget_mb')
+    return int(budget * 2**20) if budget else None
 
-def ela_tool():
+def ela_tool(config: Optional[Dict[str, Any]] = None, want_overlays: bool = True):
+    cfg = (config or load_config())['analysis']
     return Tool(name="ELA", description="Error Level Analysis",
-                func=lambda image_path: compute_ela(Image.open(image_path).convert('RGB'),
-                                                  CONFIG['analysis']['ela_quality'],
-                                                  CONFIG['analysis']['ela_threshold']))
+                func=lambda image: compute_ela(as_context(image),
+                                               cfg['ela_quality'],
+                                               cfg['ela_threshold'],
+                                               want_overlays=want_overlays,
+                                               max_bytes=budget_bytes(cfg),
+                                               backend=cfg.get('ela_backend', 'pil')))
 
-def noise_tool():
+def noise_tool(config: Optional[Dict[str, Any]] = None, want_overlays: bool = True):
+    cfg = (config or load_config())['analysis']
     return Tool(name="Noise", description="Block-wise noise variance",
-                func=lambda image_path: block_noise_score(Image.open(image_path).convert('RGB'),
-                                                         CONFIG['analysis']['block_size']))
+                func=lambda image: block_noise_score(as_context(image),
+                                                     cfg['block_size'],
+                                                     want_overlays=want_overlays,
+                                                     max_bytes=budget_bytes(cfg)))
 
-def edges_tool():
+def edges_tool(config: Optional[Dict[str, Any]] = None, want_overlays: bool = True):
+    cfg = (config or load_config())['analysis']
     return Tool(name="Edges", description="Edge inconsistency",
-                func=lambda image_path: edge_inconsistency(Image.open(image_path).convert('RGB'),
-                                                           CONFIG['analysis']['block_size']))
+                func=lambda image: edge_inconsistency(as_context(image),
+                                                      cfg['block_size'],
+                                                      want_overlays=want_overlays,
+                                                      max_bytes=budget_bytes(cfg)))
 
-def exif_tool():
+def exif_tool(config: Optional[Dict[str, Any]] = None):
+    cfg = (config or load_config())['scoring']
     return Tool(name="EXIF", description="EXIF metadata",
-                func=lambda image_path: inspect_exif(image_path, CONFIG['scoring']['suspicious_software']))
+                func=lambda image: inspect_exif(image, cfg['suspicious_software']))
 
-def retrieval_tool():
+def retrieval_tool(config: Optional[Dict[str, Any]] = None):
+    cfg = (config or load_config())['retrieval']
+    index_path = str(resolve_path(cfg['hash_index_path']))
     return Tool(name="Similarity", description="pHash similarity",
-                func=lambda image_path: nearest(image_path, CONFIG['retrieval']['hash_index_path'], CONFIG['retrieval']['top_k']))
+                func=lambda image: nearest(image, index_path, cfg['top_k'],
+                                           max_distance=cfg.get('max_distance'),
+                                           backend=cfg.get('backend', 'linear'),
+                                           bands=cfg.get('mih_bands', 4),
+                                           weights=cfg.get('fused_weights'),
+                                           tile_radius=cfg.get('tile_radius', 8),
+                                           min_votes=cfg.get('tile_min_votes', 2),
+                                           nprobe=cfg.get('embed_nprobe', 8),
+                                           embed_max_distance=cfg.get('embed_max_distance')))
+
+def build_tools(config: Optional[Dict[str, Any]] = None, want_overlays: bool = True) -> Dict[str, Tool]:
+    """
+    Build every tool once against a single config snapshot. With the 'cache'
+    section enabled, each tool answers from the result cache when the same
+    image content was analyzed under the same analyzer settings.
+    """
+    config = config or load_config()
+    tools = {
+        "ela": ela_tool(config, want_overlays),
+        "noise": noise_tool(config, want_overlays),
+        "edges": edges_tool(config, want_overlays),
+        "exif": exif_tool(config),
+        "similar": retrieval_tool(config),
+    }
+    cache = open_cache(config)
+    if cache is not None:
+        params = analyzer_params(config)
+        for name, tool in tools.items():
+            tool.func = cached_analyzer(cache, name, params[name], tool.func, want_overlays)
+    return tools
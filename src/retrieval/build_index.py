@@ -1,28 +1,172 @@
 
+import argparse
+import hashlib
+import os
+from dataclasses import dataclass, field
+from io import BytesIO
 from pathlib import Path
-import json
-from .simple_hash import phash_image
-
-
-def build_index():
-    root = Path(__file__).resolve().parents[2]
-    images_dir = root / 'data' / 'damage_db' / 'images'
-    index_path = root / 'data' / 'index' / 'hash_index.json'
-    entries = []
-    for p in sorted(images_dir.glob('*.jpg')) + sorted(images_dir.glob('*.png')) + sorted(images_dir.glob('*.jpeg')):
-        try:
-            entries.append({
-                'path': str(p),
-                'label': p.stem.split('_')[0],
-                'phash': str(phash_image(str(p)))
-            })
-        except Exception:
-            pass
-    index = {'entries': entries}
-    index_path.parent.mkdir(parents=True, exist_ok=True)
-    with open(index_path, 'w', encoding='utf-8') as f:
-        json.dump(index, f, indent=2)
-    print(f"Built index with {len(entries)} entries at {index_path}")
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+from PIL import Image
+
+from src.utils.config import ROOT, load_config, resolve_path
+from src.utils.pool import map_reported
+from .packed_index import PackedIndex, index_exists
+from .side_table import side_tables
+from .multi_hash import HASH_KINDS, multi_hash
+
+IMAGE_EXTS = (".jpg", ".jpeg", ".png")
+
+
+@dataclass
+class BuildReport:
+    added: int = 0
+    updated: int = 0
+    removed: int = 0
+    unchanged: int = 0
+    failed: List[Tuple[str, str]] = field(default_factory=list)
+    index_path: str = ""
+
+    @property
+    def total(self) -> int:
+        return self.added + self.updated + self.unchanged
+
+    def __str__(self):
+        return (f"Index at {self.index_path}: {self.total} entries "
+                f"(added={self.added}, updated={self.updated}, removed={self.removed}, "
+                f"unchanged={self.unchanged}, failed={len(self.failed)})")
+
+
+def hash_file(path: str) -> dict:
+    """Worker: read one image, return its side-table entry and pHash."""
+    return hash_bytes(Path(path), Path(path).read_bytes())
+
+
+def hash_bytes(p: Path, data: bytes) -> dict:
+    """Side-table entry and pHash for the file at p, whose content is already in memory as data."""
+    st = p.stat()
+    with Image.open(BytesIO(data)) as img:
+        # every hash kind from this one decode; column 0 is the pHash
+        multi = multi_hash(img.convert("RGB"))
+    return {
+        "path": str(p),
+        "label": p.stem.split("_")[0],
+        "size": st.st_size,
+        "mtime_ns": st.st_mtime_ns,
+        "sha256": hashlib.sha256(data).hexdigest(),
+        "phash": int(multi[0]),
+        "multi": multi,
+    }
+
+
+def list_images(image_dir: Path) -> List[Path]:
+    return sorted(p for p in image_dir.glob("*") if p.is_file() and p.suffix.lower() in IMAGE_EXTS)
+
+
+def build_index(image_dir: Optional[str] = None, index_path: Optional[str] = None,
+                workers: Optional[int] = None, full: bool = False) -> BuildReport:
+    """
+    Incrementally (re)build the packed pHash index for image_dir.
+    Existing entries are keyed by path + size + mtime; only new or changed
+    files are hashed (on a process pool), entries whose files disappeared are
+    dropped, and the index is rewritten atomically only if something changed.
+    `full=True` ignores the existing index and re-hashes everything, as does
+    an index saved without the multi-hash table (built before it existed).
+    An index_path naming a shard manifest builds the sharded index instead.
+    """
+    images_dir = Path(image_dir) if image_dir else ROOT / "data" / "damage_db" / "images"
+    index_path = Path(index_path) if index_path else resolve_path(load_config()["retrieval"]["hash_index_path"])
+    from .shards import build_shards, is_manifest
+    if is_manifest(index_path):
+        return build_shards(images_dir, index_path, workers=workers, full=full)
+    return update_index(index_path, list_images(images_dir), workers, full)
+
+
+def update_index(index_path: Path, paths: List[Path], workers: Optional[int] = None, full: bool = False,
+                 hashed: Optional[Dict[str, dict]] = None, drop_unlisted: bool = False) -> BuildReport:
+    """
+    The incremental build behind build_index() for an explicit list of image
+    files. `hashed` maps paths to hash_file() results computed by the caller,
+    so they aren't hashed twice; drop_unlisted=True also drops entries whose
+    file still exists but isn't in `paths` (a shard losing images to another).
+    """
+    workers = workers or os.cpu_count() or 1
+    hashed = hashed or {}
+    report = BuildReport(index_path=str(index_path))
+
+    old = PackedIndex.empty() if full else PackedIndex.load(index_path)
+    if len(old) and old.multi is None:
+        old = PackedIndex.empty()
+    hashes = [int(h) for h in np.asarray(old.hashes)]
+    multis = list(np.asarray(old.multi)) if old.multi is not None else []
+    entries = list(old.entries)
+    by_path = {e["path"]: i for i, e in enumerate(entries)}
+
+    todo = []
+    for p in paths:
+        st = p.stat()
+        i = by_path.get(str(p))
+        if i is None or entries[i].get("size") != st.st_size or entries[i].get("mtime_ns") != st.st_mtime_ns:
+            todo.append(str(p))
+
+    done = [(p, dict(hashed[p]), None) for p in todo if p in hashed]
+    for path, entry, error in done + list(map_reported(hash_file, [p for p in todo if p not in hashed], workers)):
+        if error:
+            report.failed.append((path, error))
+            continue
+        phash, multi = entry.pop("phash"), entry.pop("multi")
+        i = by_path.get(path)
+        if i is None:
+            by_path[path] = len(entries)
+            entries.append(entry)
+            hashes.append(phash)
+            multis.append(multi)
+            report.added += 1
+        else:
+            entries[i], hashes[i], multis[i] = entry, phash, multi
+            report.updated += 1
+
+    listed = {str(p) for p in paths}
+    keep = [i for i, e in enumerate(entries)
+            if Path(e["path"]).exists() and (not drop_unlisted or e["path"] in listed)]
+    report.removed = len(entries) - len(keep)
+    # includes rows for other directories and files that failed to re-hash (they keep their old row)
+    report.unchanged = len(keep) - report.added - report.updated
+
+    if report.added or report.updated or report.removed or full or not index_exists(index_path):
+        packed = np.array([hashes[i] for i in keep], dtype=np.uint64)
+        multi = np.array([multis[i] for i in keep], dtype=np.uint64).reshape(len(keep), len(HASH_KINDS))
+        PackedIndex(packed, [entries[i] for i in keep], multi).save(index_path)
+        report.failed += refresh_side_tables(index_path)
+    return report
+
+
+def refresh_side_tables(index_path: Path) -> List[Tuple[str, str]]:
+    """
+    After the index changed: update whichever cluster, tile and embedding
+    tables it has. Returns (path, error) for every image a table could not read.
+    """
+    failed = []
+    for attr, table_cls in side_tables():
+        table_report = table_cls.refresh(index_path)
+        if table_report is not None:
+            failed += [(path, f"{attr}: {error}") for path, error in table_report.failed]
+    return failed
+
+
+def main():
+    ap = argparse.ArgumentParser(description="Incrementally build the pHash / multi-hash similarity index.")
+    ap.add_argument("--image-dir", default=None, help="defaults to data/damage_db/images")
+    ap.add_argument("--index", default=None, help="defaults to retrieval.hash_index_path from config.yaml")
+    ap.add_argument("--workers", type=int, default=None)
+    ap.add_argument("--full", action="store_true", help="re-hash every image")
+    args = ap.parse_args()
+
+    report = build_index(args.image_dir, args.index, args.workers, args.full)
+    for path, error in report.failed:
+        print(f"FAILED {path}: {error}")
+    print(report)
 
 if __name__ == '__main__':
-    build_index()
+    main()
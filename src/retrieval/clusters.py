@@ -0,0 +1,281 @@
+
+# src/retrieval/clusters.py
+#
+# Near-duplicate clusters over the whole damage DB: every pair of pHashes
+# within Hamming radius r is linked and connected components are stored next
+# to the index (hash_index.clusters.npz), so a lookup is an array read.
+#   python -m src.retrieval.clusters --radius 6
+#   python -m src.retrieval.clusters --summary 20
+# With a shard manifest as --index, one table covers all shards (see shards.py).
+
+import argparse
+import os
+from itertools import combinations
+from math import comb
+from pathlib import Path
+from typing import Any, Dict, Iterator, List, Optional, Tuple, Union
+
+import numpy as np
+
+from src.utils.config import load_config, resolve_path
+from .packed_index import PackedIndex, clusters_path, popcount64
+from .side_table import SideTable, TableReport, expand_spans
+
+# Candidate pairs expanded per step; bounds memory when a bucket is very full
+_MAX_PAIRS = 1 << 22
+
+
+def plan_bands(n: int, radius: int) -> int:
+    """
+    Number of bands m for candidate_pairs, minimising its rough cost for n rows:
+    C(m, m - radius) sorts of the index plus the expected bucket collisions.
+    """
+    def cost(m: int) -> float:
+        key_bits = 64 * (m - radius) / m
+        return comb(m, m - radius) * (2 * n + n * n / 2 ** (key_bits + 1))
+    return min(range(radius + 1, min(64, radius + 16) + 1), key=cost)
+
+
+def band_keys(radius: int, bands: int) -> List[np.uint64]:
+    """
+    Masks selecting every combination of bands - radius of the 64 bits' `bands`
+    bands. Two hashes within `radius` bits differ in at most `radius` bands,
+    so (pigeonhole) they agree exactly under at least one of these masks.
+    """
+    if not radius < bands <= 64:
+        raise ValueError(f"bands must be in ({radius}, 64], got {bands}")
+    edges = np.linspace(0, 64, bands + 1).round().astype(int)
+    band_masks = [((1 << int(hi)) - 1) ^ ((1 << int(lo)) - 1) for lo, hi in zip(edges[:-1], edges[1:])]
+    return [np.uint64(sum(band_masks[i] for i in combo)) for combo in combinations(range(bands), bands - radius)]
+
+
+def candidate_pairs(hashes: np.ndarray, radius: int, bands: int,
+                    start: int = 0) -> Iterator[Tuple[np.ndarray, np.ndarray]]:
+    """
+    (row, row) pairs that agree exactly under one of band_keys(): a superset of
+    the pairs within `radius`, to be verified by the caller. With start=0 every
+    pair is produced once per key it matches (first row < second row);
+    otherwise only pairs with at least one row >= start (new row first).
+    """
+    hashes = np.asarray(hashes, dtype=np.uint64)
+    n = len(hashes)
+    for mask in band_keys(radius, bands):
+        keys = hashes & mask
+        if start == 0:
+            # self-join: pair each position with the ones after it in its run of equal keys
+            order = np.argsort(keys)
+            sorted_keys = keys[order]
+            bounds = np.flatnonzero(np.concatenate(([True], sorted_keys[1:] != sorted_keys[:-1], [True])))
+            run_end = np.repeat(bounds[1:], np.diff(bounds))
+            pos = np.flatnonzero(run_end - np.arange(n) > 1)
+            d = 1
+            while pos.size:
+                a, b = order[pos], order[pos + d]
+                yield np.minimum(a, b), np.maximum(a, b)
+                d += 1
+                pos = pos[run_end[pos] - pos > d]
+            continue
+        # incremental: only the new rows are sorted, every row probes them
+        new_order = np.argsort(keys[start:]) + start
+        new_keys = keys[new_order]
+        lo = np.searchsorted(new_keys, keys, side="left")
+        rows = np.flatnonzero(new_keys[np.minimum(lo, len(new_keys) - 1)] == keys)
+        lo = lo[rows]
+        counts = np.searchsorted(new_keys, keys[rows], side="right") - lo
+        ends = np.cumsum(counts)
+        i = 0
+        while i < len(rows):
+            # largest run of rows whose candidates fit in _MAX_PAIRS (at least one row)
+            base = ends[i - 1] if i else 0
+            stop = max(i + 1, int(np.searchsorted(ends, base + _MAX_PAIRS, side="right")))
+            c = counts[i:stop]
+            yield new_order[expand_spans(lo[i:stop], c)], np.repeat(rows[i:stop], c)
+            i = stop
+
+
+def link_components(n: int, a: np.ndarray, b: np.ndarray, labels: Optional[np.ndarray] = None) -> np.ndarray:
+    """
+    Union-find over edges (a[i], b[i]) in array form: every row ends up
+    labelled with the smallest row of its component. `labels` continues from
+    an earlier result, so only the new edges need to be passed.
+    """
+    labels = np.arange(n, dtype=np.int64) if labels is None else np.concatenate(
+        [labels.astype(np.int64), np.arange(len(labels), n, dtype=np.int64)])
+    while True:
+        la, lb = labels[a], labels[b]
+        split = la != lb
+        if not split.any():
+            return labels
+        # hook the larger root under the smaller one, then compress every path
+        np.minimum.at(labels, np.maximum(la[split], lb[split]), np.minimum(la[split], lb[split]))
+        while True:
+            nxt = labels[labels]
+            if np.array_equal(nxt, labels):
+                break
+            labels = nxt
+        a, b = a[split], b[split]
+
+
+def near_pairs(hashes: np.ndarray, radius: int, bands: int, start: int = 0) -> Tuple[np.ndarray, np.ndarray]:
+    """All pairs within `radius` that involve at least one row >= start (start=0: every pair)."""
+    hashes = np.asarray(hashes, dtype=np.uint64)
+    found_a, found_b = [], []
+    for a, b in candidate_pairs(hashes, radius, bands, start):
+        if start:
+            keep = (a < b) | (b < start)  # new-new pairs once; new-old pairs are only seen from the new side
+            a, b = a[keep], b[keep]
+        close = popcount64(hashes[a] ^ hashes[b]) <= radius
+        found_a.append(a[close])
+        found_b.append(b[close])
+    if not found_a:
+        return np.zeros(0, np.int64), np.zeros(0, np.int64)
+    return np.concatenate(found_a), np.concatenate(found_b)
+
+
+def _hashes(index: Union[PackedIndex, np.ndarray]) -> np.ndarray:
+    return np.asarray(index.hashes if isinstance(index, PackedIndex) else index, dtype=np.uint64)
+
+
+class ClusterTable(SideTable):
+    """Component label (smallest member row) and component size for every index row."""
+
+    path_for = staticmethod(clusters_path)
+
+    def __init__(self, labels: np.ndarray, hashes: np.ndarray, radius: int, bands: int):
+        self.labels = labels
+        self.errors: List[Tuple[str, str]] = []
+        self.sources = np.asarray(hashes, dtype=np.uint64)
+        self.radius = radius
+        self.bands = bands
+        _, inverse, counts = np.unique(labels, return_inverse=True, return_counts=True)
+        self.sizes = counts[inverse]
+
+    @property
+    def hashes(self) -> np.ndarray:
+        return self.sources
+
+    @classmethod
+    def settle(cls, old: Optional["ClusterTable"], radius: Optional[int] = None,
+               bands: Optional[int] = None) -> Dict[str, Any]:
+        """radius=None keeps the table's radius (6 on a first build); bands=None keeps its bands."""
+        radius = radius if radius is not None else (old.radius if old else 6)
+        return {"radius": radius, "bands": bands}
+
+    def accepts(self, radius: int, bands: Optional[int]) -> bool:
+        return self.radius == radius and bands in (None, self.bands)
+
+    @classmethod
+    def build(cls, index: Union[PackedIndex, np.ndarray], radius: int = 6, bands: Optional[int] = None,
+              workers: Optional[int] = None) -> "ClusterTable":
+        """Table over a PackedIndex or a pHash array; bands=None picks them with plan_bands()."""
+        hashes = _hashes(index)
+        bands = bands or plan_bands(len(hashes), radius)
+        a, b = near_pairs(hashes, radius, bands)
+        return cls(link_components(len(hashes), a, b), hashes, radius, bands)
+
+    def extend(self, index: Union[PackedIndex, np.ndarray], workers: Optional[int] = None) -> "ClusterTable":
+        """Only pairs touching the new rows are searched."""
+        hashes = _hashes(index)
+        a, b = near_pairs(hashes, self.radius, self.bands, start=len(self))
+        return ClusterTable(link_components(len(hashes), a, b, self.labels), hashes, self.radius, self.bands)
+
+    def remaps(self, reuse: np.ndarray) -> bool:
+        """Only when every old row is still there: a removed or changed row may split its cluster."""
+        return int((reuse >= 0).sum()) == len(self)
+
+    def remap(self, index: Union[PackedIndex, np.ndarray], reuse: np.ndarray,
+              workers: Optional[int] = None) -> "ClusterTable":
+        """
+        Rows inserted anywhere (e.g. into one shard of a manifest-wide table):
+        the old rows are moved to the front, the new ones compared against them
+        as in extend(), and every cluster relabelled to its smallest row.
+        """
+        hashes = _hashes(index)
+        kept = np.flatnonzero(reuse >= 0)
+        order = np.concatenate([kept[np.argsort(reuse[kept])], np.flatnonzero(reuse < 0)])
+        moved = self.extend(hashes[order]).labels
+        smallest = np.full(len(order), len(order), dtype=np.int64)
+        np.minimum.at(smallest, moved, order)
+        labels = np.empty(len(order), dtype=np.int64)
+        labels[order] = smallest[moved]
+        return ClusterTable(labels, hashes, self.radius, self.bands)
+
+    def lookup(self, row: int) -> Tuple[int, int]:
+        return int(self.labels[row]), int(self.sizes[row])
+
+    def view(self, offset: int) -> "ClusterView":
+        return ClusterView(self, offset)
+
+    def groups(self, min_size: int = 2):
+        """(cluster_id, member rows) for every cluster of at least min_size, largest first."""
+        big = np.flatnonzero(self.sizes >= min_size)
+        order = big[np.argsort(self.labels[big], kind="stable")]
+        ids, starts = np.unique(self.labels[order], return_index=True)
+        members = np.split(order, starts[1:])
+        for i in sorted(range(len(ids)), key=lambda i: (-len(members[i]), ids[i])):
+            yield int(ids[i]), members[i]
+
+    # ----------------------------- I/O -----------------------------
+    def save(self, path: Union[str, Path]) -> None:
+        path = Path(path)
+        tmp = path.with_name(path.stem + ".tmp.npz")
+        np.savez(tmp, labels=self.labels, hashes=self.hashes, radius=self.radius, bands=self.bands)
+        os.replace(tmp, path)
+
+    @classmethod
+    def load(cls, path: Union[str, Path]) -> Optional["ClusterTable"]:
+        path = Path(path)
+        if not path.exists():
+            return None
+        with np.load(path) as npz:
+            return cls(npz["labels"], npz["hashes"], int(npz["radius"]), int(npz["bands"]))
+
+
+class ClusterView:
+    """One shard's rows of a manifest-wide table (see shards.py), looked up by row within the shard."""
+
+    def __init__(self, table: ClusterTable, offset: int):
+        self.table = table
+        self.offset = offset
+
+    def lookup(self, row: int) -> Tuple[int, int]:
+        return self.table.lookup(self.offset + row)
+
+
+def update_clusters(index_path: Union[str, Path], radius: Optional[int] = None,
+                    bands: Optional[int] = None) -> Tuple[ClusterTable, TableReport]:
+    """
+    ClusterTable.update(); bands=None keeps the table's bands, or picks them
+    with plan_bands() on a rebuild. A shard manifest gets one table over all
+    of its shards (shards.update_shard_clusters).
+    """
+    from .shards import is_manifest, update_shard_clusters
+    if is_manifest(index_path):
+        return update_shard_clusters(index_path, radius, bands)
+    return ClusterTable.update(index_path, radius=radius, bands=bands)
+
+
+def main():
+    cfg = load_config()["retrieval"]
+    ap = argparse.ArgumentParser(description="Precompute near-duplicate clusters over the pHash index.")
+    ap.add_argument("--index", default=cfg["hash_index_path"])
+    ap.add_argument("--radius", type=int, default=cfg.get("cluster_radius", 6))
+    ap.add_argument("--bands", type=int, default=cfg.get("cluster_bands"), help="default: chosen from index size")
+    ap.add_argument("--summary", type=int, default=10, help="print the N largest clusters")
+    args = ap.parse_args()
+
+    index_path = resolve_path(args.index)
+    table, report = update_clusters(index_path, args.radius, args.bands)
+    from .shards import is_manifest, open_sharded
+    entries = open_sharded(index_path).combined().entries if is_manifest(index_path) \
+        else PackedIndex.load(index_path).entries
+    groups = list(table.groups())
+    print(f"Clusters {report.how}: {len(table)} images, {len(groups)} near-duplicate clusters "
+          f"(radius={table.radius}, bands={table.bands}) -> {clusters_path(index_path)}")
+    for cid, rows in groups[:args.summary]:
+        names = ", ".join(Path(entries[r]["path"]).name for r in rows[:5])
+        print(f"  cluster {cid}: {len(rows)} images  {names}{' ...' if len(rows) > 5 else ''}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,293 @@
+
+# src/retrieval/embedding.py
+#
+# Descriptor backend for re-photographed damage: a pHash flips many bits when
+# the same dent is shot again from a slightly different angle, a colour +
+# gradient-orientation descriptor barely moves. Descriptors of every index row
+# go into an IVF (inverted file) index: vectors are grouped by their nearest
+# k-means centroid and stored list by list (hash_index.embed.npy, float16,
+# memory-mapped on load), so a query scans only the nprobe closest lists.
+#   python -m src.retrieval.embedding
+#   python -m src.retrieval.embedding --query claim.jpg
+# With a shard manifest as --index, every shard gets its own index.
+
+import argparse
+import os
+from pathlib import Path
+from typing import List, Optional, Tuple, Union
+
+import cv2
+import numpy as np
+from PIL import Image
+
+from src.analysis.context import as_context
+from src.utils.config import load_config, resolve_path
+from src.utils.pool import map_reported
+from .packed_index import PackedIndex, embed_path
+from .side_table import SideTable, TableReport
+
+EMBED_SIDE = 128
+HSV_BINS = (8, 4, 4)
+GRID = 4          # gradient histograms per cell of a GRID x GRID layout
+ORIENTATIONS = 8
+DIM = int(np.prod(HSV_BINS)) + GRID * GRID * ORIENTATIONS
+
+DEFAULT_NPROBE = 8
+# Lists are retrained once the index has grown this many times past the size they were trained on
+RETRAIN_GROWTH = 4
+_KMEANS_SAMPLE = 50_000
+# Vectors assigned to lists per step; bounds the (block, nlist) similarity matrix
+_ASSIGN_BLOCK = 1 << 14
+
+
+def embed_image(image) -> np.ndarray:
+    """
+    Unit-length float32 descriptor of a path, PIL image or ImageContext: an
+    HSV colour histogram and a 4x4 grid of gradient-orientation histograms
+    (HOG-like) of a 128x128 thumbnail, each square-rooted (Hellinger) and
+    weighted equally. Cosine similarity is a plain dot product.
+    """
+    img = as_context(image).image
+    rgb = np.asarray(img.resize((EMBED_SIDE, EMBED_SIDE), Image.BILINEAR, reducing_gap=2.0))
+
+    hsv = cv2.cvtColor(rgb, cv2.COLOR_RGB2HSV)
+    colour = cv2.calcHist([hsv], [0, 1, 2], None, list(HSV_BINS), [0, 180, 0, 256, 0, 256]).ravel()
+
+    gray = cv2.cvtColor(rgb, cv2.COLOR_RGB2GRAY).astype(np.float32)
+    mag, ang = cv2.cartToPolar(cv2.Sobel(gray, cv2.CV_32F, 1, 0), cv2.Sobel(gray, cv2.CV_32F, 0, 1))
+    # unsigned orientation, as in HOG: a light-to-dark edge and its reverse count alike
+    bins = (np.mod(ang, np.pi) * (ORIENTATIONS / np.pi)).astype(np.int64) % ORIENTATIONS
+    cell = np.arange(EMBED_SIDE) * GRID // EMBED_SIDE
+    cells = cell[:, None] * GRID + cell[None, :]
+    shape = np.bincount((cells * ORIENTATIONS + bins).ravel(), weights=mag.ravel(),
+                        minlength=GRID * GRID * ORIENTATIONS)
+
+    parts = [np.sqrt(p / p.sum()) if p.sum() > 0 else np.zeros_like(p) for p in (colour, shape)]
+    return (np.concatenate(parts) / np.sqrt(len(parts))).astype(np.float32)
+
+
+def _embed_rows(index: PackedIndex, rows: np.ndarray, workers: Optional[int]):
+    """
+    Descriptors of the given index rows on a process pool. Returns the rows
+    that were read, their vectors (float16), and (path, error) for the others.
+    """
+    ids, vectors, errors = [], [], []
+    for i, (path, vector, error) in zip(rows, map_reported(embed_image, [index.entries[i]["path"] for i in rows],
+                                                           workers)):
+        if error is not None:
+            errors.append((path, error))
+        else:
+            ids.append(i)
+            vectors.append(vector)
+    return np.array(ids, dtype=np.int64), np.array(vectors, dtype=np.float16).reshape(-1, DIM), errors
+
+
+def spherical_kmeans(x: np.ndarray, k: int, iters: int = 10, seed: int = 0) -> np.ndarray:
+    """k unit-length centroids for unit vectors x (cosine k-means), trained on a sample of at most 50k rows."""
+    rng = np.random.default_rng(seed)
+    x = np.asarray(x, dtype=np.float32)
+    if len(x) > _KMEANS_SAMPLE:
+        x = x[rng.choice(len(x), _KMEANS_SAMPLE, replace=False)]
+    centroids = x[rng.choice(len(x), k, replace=False)].copy()
+    for _ in range(iters):
+        assign = np.argmax(x @ centroids.T, axis=1)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assign, x)
+        norms = np.linalg.norm(sums, axis=1)
+        # an empty list keeps its old centroid
+        filled = norms > 0
+        centroids[filled] = sums[filled] / norms[filled, None]
+    return centroids
+
+
+def default_nlist(n: int) -> int:
+    return int(np.clip(round(np.sqrt(n)), 1, 4096))
+
+
+class EmbeddingIndex(SideTable):
+    """
+    IVF index over embed_image() descriptors. vectors[offsets[l]:offsets[l+1]]
+    is inverted list l (vectors nearest centroids[l]) and ids[i] is the index
+    row of vectors[i]; rows that could not be read have no vector and are set
+    in `failed`. `trained` is the row count the centroids were fitted on.
+    Rows are keyed by content (PackedIndex.row_keys), so an update embeds
+    only new or changed images.
+    """
+
+    path_for = staticmethod(embed_path)
+
+    def __init__(self, vectors: np.ndarray, ids: np.ndarray, offsets: np.ndarray, centroids: np.ndarray,
+                 sources: np.ndarray, trained: int, failed: Optional[np.ndarray] = None):
+        self.vectors = vectors
+        self.errors: List[Tuple[str, str]] = []
+        self.ids = np.asarray(ids, dtype=np.int64)
+        self.offsets = np.asarray(offsets, dtype=np.int64)
+        self.centroids = np.asarray(centroids, dtype=np.float32)
+        self.sources = np.asarray(sources, dtype=np.uint64)
+        self.trained = int(trained)
+        self.failed = np.zeros(len(self.sources), dtype=bool) if failed is None else np.asarray(failed, dtype=bool)
+
+    @staticmethod
+    def index_keys(index: PackedIndex) -> np.ndarray:
+        return index.row_keys()
+
+    def failed_rows(self) -> np.ndarray:
+        return self.failed
+
+    def accepts(self, nlist: Optional[int] = None) -> bool:
+        return nlist in (None, self.nlist)
+
+    @property
+    def nlist(self) -> int:
+        return len(self.centroids)
+
+    @classmethod
+    def from_vectors(cls, vectors: np.ndarray, ids: np.ndarray, sources: np.ndarray, nlist: Optional[int] = None,
+                     centroids: Optional[np.ndarray] = None, trained: int = 0,
+                     failed: Optional[np.ndarray] = None) -> "EmbeddingIndex":
+        """Group `vectors` into inverted lists, training nlist centroids unless they are given."""
+        vectors = np.asarray(vectors).reshape(-1, DIM)
+        if centroids is None:
+            nlist = min(nlist or default_nlist(len(vectors)), max(1, len(vectors)))
+            centroids = spherical_kmeans(vectors, nlist) if len(vectors) else np.zeros((1, DIM), np.float32)
+            trained = len(sources)
+        centroids = np.asarray(centroids, dtype=np.float32)
+        assign = np.zeros(len(vectors), dtype=np.int64)
+        for start in range(0, len(vectors), _ASSIGN_BLOCK):
+            block = np.asarray(vectors[start:start + _ASSIGN_BLOCK], dtype=np.float32)
+            assign[start:start + len(block)] = np.argmax(block @ centroids.T, axis=1)
+        order = np.argsort(assign, kind="stable")
+        offsets = np.concatenate(([0], np.cumsum(np.bincount(assign, minlength=len(centroids)))))
+        return cls(vectors[order].astype(np.float16), np.asarray(ids)[order], offsets, centroids, sources, trained,
+                   failed)
+
+    @classmethod
+    def build(cls, index: PackedIndex, nlist: Optional[int] = None, workers: Optional[int] = None) -> "EmbeddingIndex":
+        ids, vectors, errors = _embed_rows(index, np.arange(len(index)), workers)
+        failed = np.ones(len(index), dtype=bool)
+        failed[ids] = False
+        table = cls.from_vectors(vectors, ids, index.row_keys(), nlist, failed=failed)
+        table.errors = errors
+        return table
+
+    def remap(self, index: PackedIndex, reuse: np.ndarray, workers: Optional[int] = None) -> "EmbeddingIndex":
+        """
+        Reused rows keep their stored vectors; the others are embedded and
+        filed into the existing lists. The lists are retrained from the
+        vectors once the index outgrows its training size by RETRAIN_GROWTH.
+        """
+        new_ids, new_vectors, errors = _embed_rows(index, np.flatnonzero(reuse < 0), workers)
+        position = np.full(len(self), -1, dtype=np.int64)
+        position[self.ids] = np.arange(len(self.ids))
+        # failed rows are never reused, so every reused row has a stored vector
+        kept = np.flatnonzero(reuse >= 0)
+        at = position[reuse[kept]]
+        order = np.argsort(at)  # read the memory-mapped vectors front to back
+        vectors = np.concatenate([np.asarray(self.vectors[at[order]], dtype=np.float16), new_vectors])
+        ids = np.concatenate([kept[order], new_ids])
+        failed = np.ones(len(index), dtype=bool)
+        failed[ids] = False
+        sources = index.row_keys()
+        if len(index) > RETRAIN_GROWTH * max(1, self.trained):
+            table = EmbeddingIndex.from_vectors(vectors, ids, sources, failed=failed)
+        else:
+            table = EmbeddingIndex.from_vectors(vectors, ids, sources, centroids=self.centroids, trained=self.trained,
+                                                failed=failed)
+        table.errors = errors
+        return table
+
+    # ----------------------------- Query -----------------------------
+    def search(self, query: np.ndarray, top_k: int = 4, nprobe: int = DEFAULT_NPROBE,
+               max_distance: Optional[float] = None) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Index rows and cosine distances (1 - similarity) of the top_k nearest
+        descriptors among the nprobe lists whose centroids are closest to the
+        query, ordered by (distance, row). nprobe >= nlist is an exact scan.
+        """
+        q = np.asarray(query, dtype=np.float32)
+        nprobe = min(nprobe, self.nlist)
+        lists = np.argpartition(-(self.centroids @ q), nprobe - 1)[:nprobe]
+        spans = [(self.offsets[l], self.offsets[l + 1]) for l in np.sort(lists)]
+        spans = [(a, b) for a, b in spans if b > a]
+        if not spans or top_k <= 0:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float32)
+        # float16 on disk, float32 for the dot product (NumPy has no BLAS path for float16)
+        dist = 1.0 - np.concatenate([np.asarray(self.vectors[a:b], dtype=np.float32) @ q for a, b in spans])
+        rows = np.concatenate([self.ids[a:b] for a, b in spans])
+        if max_distance is not None:
+            keep = dist <= max_distance
+            rows, dist = rows[keep], dist[keep]
+        order = np.lexsort((rows, dist))[:top_k]
+        return rows[order], dist[order]
+
+    # ----------------------------- I/O -----------------------------
+    def save(self, path: Union[str, Path]) -> None:
+        """Vectors to <path>.npy, everything else to the .npz at path; temp files + os.replace."""
+        path = Path(path)
+        vec_path = path.with_suffix(".npy")
+        tmp_vec = vec_path.with_name(vec_path.name + ".tmp")
+        with open(tmp_vec, "wb") as f:
+            np.save(f, np.ascontiguousarray(self.vectors, dtype=np.float16))
+        tmp = path.with_name(path.stem + ".tmp.npz")
+        np.savez(tmp, ids=self.ids, offsets=self.offsets, centroids=self.centroids, sources=self.sources,
+                 trained=self.trained, failed=self.failed)
+        os.replace(tmp_vec, vec_path)
+        os.replace(tmp, path)
+
+    @classmethod
+    def load(cls, path: Union[str, Path]) -> Optional["EmbeddingIndex"]:
+        path = Path(path)
+        if not path.exists() or not path.with_suffix(".npy").exists():
+            return None
+        with np.load(path) as npz:
+            ids = npz["ids"]
+            vectors = np.load(path.with_suffix(".npy"), mmap_mode="r") if len(ids) else np.zeros((0, DIM), np.float16)
+            if vectors.shape != (len(ids), DIM):
+                return None
+            return cls(vectors, ids, npz["offsets"], npz["centroids"], npz["sources"], int(npz["trained"]),
+                       npz["failed"] if "failed" in npz else None)
+
+
+def update_embeddings(index_path: Union[str, Path], nlist: Optional[int] = None,
+                      workers: Optional[int] = None) -> Tuple[EmbeddingIndex, TableReport]:
+    """EmbeddingIndex.update(); a different nlist than the saved one rebuilds."""
+    return EmbeddingIndex.update(index_path, workers, nlist=nlist)
+
+
+def main():
+    cfg = load_config()["retrieval"]
+    ap = argparse.ArgumentParser(description="Build the descriptor IVF index or query it with an image.")
+    ap.add_argument("--index", default=cfg["hash_index_path"])
+    ap.add_argument("--nlist", type=int, default=None, help="inverted lists (default: about sqrt(entries))")
+    ap.add_argument("--workers", type=int, default=None)
+    ap.add_argument("--query", default=None, help="image to look up")
+    ap.add_argument("--top-k", type=int, default=cfg["top_k"])
+    ap.add_argument("--nprobe", type=int, default=cfg.get("embed_nprobe", DEFAULT_NPROBE))
+    args = ap.parse_args()
+
+    from .shards import index_paths, is_manifest
+    index_path = resolve_path(args.index)
+    if args.query and is_manifest(index_path):
+        from .simple_hash import nearest
+        for h in nearest(args.query, str(index_path), args.top_k, backend="embed", nprobe=args.nprobe):
+            print(f"  d={h['distance']:.2f}  {h['label']:<12} {h['path']}  [{h['shard']}]")
+        return
+    if args.query:
+        from .packed_index import open_index
+        index = open_index(index_path)
+        if index.embeddings is None:
+            print(f"No embedding index for {index_path}; run python -m src.retrieval.embedding first.")
+            return
+        for h in index.describe(*index.embeddings.search(embed_image(args.query), args.top_k, args.nprobe)):
+            print(f"  d={h['distance']:.2f}  {h['label']:<12} {h['path']}")
+        return
+    for path in index_paths(index_path):
+        table, report = update_embeddings(path, args.nlist, args.workers)
+        for failed, error in report.failed:
+            print(f"FAILED {failed}: {error}")
+        print(f"Embedding index {report}: {len(table.ids)} vectors over {len(table)} images, {table.nlist} lists "
+              f"({DIM}-d float16) -> {embed_path(path)}")
+
+
+if __name__ == "__main__":
+    main()
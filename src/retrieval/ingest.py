@@ -0,0 +1,336 @@
+
+# src/retrieval/ingest.py
+#
+# One ingestion path for the damage DB, whatever the source (folder, ZIP,
+# Hugging Face dataset): images are deduplicated by content hash, written on a
+# process pool, and pHashed from the bytes already in memory so the new rows
+# go straight into the packed index (or, for a shard manifest, into the
+# shards they belong to).
+
+import hashlib
+import os
+import sys
+import zipfile
+from concurrent.futures import FIRST_COMPLETED, Future, wait
+from dataclasses import dataclass, field
+from io import BytesIO
+from pathlib import Path
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Sequence, Set, Tuple, Union
+
+import numpy as np
+from PIL import Image
+
+from src.utils.config import ROOT, load_config, resolve_path
+from src.utils.pool import map_reported, process_pool
+from .build_index import IMAGE_EXTS, hash_bytes, refresh_side_tables
+from .packed_index import PackedIndex, path_key
+from .shards import append_to_shards, is_manifest, open_sharded
+
+DEFAULT_DB = ROOT / "data" / "damage_db" / "images"
+
+# One ingest item: a file name plus either its encoded bytes or an image still to be encoded
+Item = Tuple[str, Union[bytes, Image.Image]]
+
+# sha256 of a DB file the index does not cover, valid while its size and mtime hold
+DIGEST_DTYPE = np.dtype([("path", "<u8"), ("size", "<i8"), ("mtime_ns", "<i8"), ("sha256", "S64")])
+
+
+@dataclass
+class IngestReport:
+    added: int = 0
+    duplicates: int = 0
+    indexed: int = 0
+    failed: List[Tuple[str, str]] = field(default_factory=list)
+    out_dir: str = ""
+
+    def __str__(self):
+        return (f"Ingested {self.added} images to {self.out_dir} "
+                f"(duplicates={self.duplicates}, indexed={self.indexed}, failed={len(self.failed)})")
+
+
+def sha256_file(path: Path, chunk: int = 2**20) -> str:
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(chunk), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+def digests_path(out_dir: Path) -> Path:
+    """Digest cache of out_dir's unindexed files: data/damage_db/images -> images.digests.npy."""
+    return out_dir.with_name(out_dir.name + ".digests.npy")
+
+
+def file_digests(files: Sequence[Path], cache: np.ndarray) -> np.ndarray:
+    """DIGEST_DTYPE rows for files, with the sha256 taken from `cache` where path, size and mtime match."""
+    rows = np.zeros(len(files), dtype=DIGEST_DTYPE)
+    stats = [p.stat() for p in files]
+    rows["path"] = [path_key(p) for p in files]
+    rows["size"] = [st.st_size for st in stats]
+    rows["mtime_ns"] = [st.st_mtime_ns for st in stats]
+    if len(cache) and len(rows):
+        order = np.argsort(cache["path"], kind="stable")
+        hit = cache[order[np.minimum(np.searchsorted(cache["path"][order], rows["path"]), len(order) - 1)]]
+        fresh = (hit["path"] == rows["path"]) & (hit["size"] == rows["size"]) & (hit["mtime_ns"] == rows["mtime_ns"])
+        rows["sha256"][fresh] = hit["sha256"][fresh]
+    return rows
+
+
+def save_digests(path: Path, rows: np.ndarray) -> None:
+    tmp = path.with_name(path.stem + ".tmp.npy")
+    np.save(tmp, rows)
+    os.replace(tmp, path)
+
+
+def encode_jpeg(image: Image.Image, quality: int = 95) -> bytes:
+    buf = BytesIO()
+    image.convert("RGB").save(buf, format="JPEG", quality=quality)
+    return buf.getvalue()
+
+
+def store(target: str, payload: Union[bytes, Image.Image], with_phash: bool = True) -> Dict[str, Any]:
+    """
+    Worker: encode `payload` if it is an image, write it to target and return
+    its index entry (with "phash" unless with_phash=False) or just its sha256.
+    """
+    data = payload if isinstance(payload, bytes) else encode_jpeg(payload)
+    p = Path(target)
+    p.write_bytes(data)
+    if with_phash:
+        return hash_bytes(p, data)
+    return {"path": str(p), "sha256": hashlib.sha256(data).hexdigest()}
+
+
+# ----------------------------- Sources -----------------------------
+def iter_folder(src: Union[str, Path], exts: Iterable[str] = IMAGE_EXTS) -> Iterator[Item]:
+    exts = {e.lower() for e in exts}
+    for p in sorted(Path(src).rglob("*")):
+        if p.is_file() and p.suffix.lower() in exts:
+            yield p.name, p.read_bytes()
+
+
+def iter_zip(zip_path: Union[str, Path], exts: Iterable[str] = IMAGE_EXTS) -> Iterator[Item]:
+    """Members are read one at a time straight from the archive; nothing is extracted to disk."""
+    exts = {e.lower() for e in exts}
+    with zipfile.ZipFile(zip_path, "r") as z:
+        for info in z.infolist():
+            name = Path(info.filename).name
+            if not info.is_dir() and Path(name).suffix.lower() in exts:
+                yield name, z.read(info)
+
+
+def iter_dataset(rows: Iterable[Dict[str, Any]], limit: Optional[int] = None, prefix: str = "hf") -> Iterator[Item]:
+    """
+    Images from Hugging Face dataset rows (any iterable, e.g. a streaming
+    dataset). Rows without an image column are skipped; images are encoded as
+    JPEG q95 later, on the worker pool.
+    """
+    for i, row in enumerate(rows):
+        if limit is not None and i >= limit:
+            break
+        img = next((row[k] for k in ("image", "img", "Image", "image_bytes") if row.get(k) is not None), None)
+        if isinstance(img, dict):  # Image feature with decode=False
+            img = img.get("bytes")
+        if img is None:
+            continue
+        if not hasattr(img, "convert"):
+            img = Image.open(BytesIO(img))
+        yield f"{prefix}_{i:06d}.jpg", img
+
+
+def open_dataset(repo: str, split: str = "train", streaming: bool = True):
+    """
+    load_dataset(repo) lazily row by row. `repo` may also be a local directory:
+    one written by Dataset(Dict).save_to_disk, or any folder load_dataset
+    reads (e.g. an imagefolder of images).
+    """
+    path = Path(repo)
+    if (path / "state.json").exists() or (path / "dataset_dict.json").exists():
+        from datasets import load_from_disk
+        ds = load_from_disk(str(path))
+        ds = ds[split] if (path / "dataset_dict.json").exists() else ds
+        return ds.to_iterable_dataset() if streaming else ds
+    from datasets import load_dataset
+    return load_dataset(repo, split=split, streaming=streaming)
+
+
+# ----------------------------- Pipeline -----------------------------
+class Ingestor:
+    """
+    Writes items into out_dir on a process pool (workers=0: in-process),
+    skipping any whose content hash is already in the DB or was seen earlier
+    in the run. Items that arrive as bytes are deduplicated before any work is
+    queued; images still to be encoded are checked once encoded, and the
+    losing copy is removed. New rows are added to the pHash index on close().
+    """
+
+    def __init__(self, out_dir: Union[str, Path, None] = None, index_path: Union[str, Path, None] = None,
+                 workers: Optional[int] = None, max_in_flight: Optional[int] = None, update_index: bool = True):
+        self.out_dir = resolve_path(out_dir) if out_dir else DEFAULT_DB
+        self.out_dir.mkdir(parents=True, exist_ok=True)
+        self.index_path = Path(index_path) if index_path else resolve_path(load_config()["retrieval"]["hash_index_path"])
+        self.update_index = update_index
+        self.report = IngestReport(out_dir=str(self.out_dir))
+        workers = (os.cpu_count() or 1) if workers is None else workers
+
+        self.sharded = is_manifest(self.index_path)
+        self.index = PackedIndex.empty()
+        if update_index and not self.sharded:
+            self.index = PackedIndex.load(self.index_path)
+        indexes = open_sharded(self.index_path).indexes() if update_index and self.sharded else [self.index]
+
+        files = list(self.out_dir.iterdir())
+        self.taken: Set[str] = {p.name for p in files}
+        listed = np.array([path_key(p) for p in files], dtype=np.uint64)
+        # content keys of the indexed images that still exist, from the per-row stats; only the
+        # entries of rows whose file is not in out_dir (deleted, or another directory) are read
+        known, indexed = [], []
+        for index in indexes:
+            rows = index.rows()
+            here = np.isin(rows["path"], listed)
+            gone = [i for i in np.flatnonzero(~here).tolist() if not Path(index.entries[i]["path"]).exists()]
+            known.append(np.delete(rows["key"], gone))
+            indexed.append(rows["path"])
+        self.known = np.sort(np.concatenate(known + [np.zeros(0, dtype=np.uint64)]))
+        # files the index doesn't know (copied in by hand, or every file with --no-index) still count
+        # as present; their digests are cached next to the DB and only new or changed files are hashed
+        unindexed = ~np.isin(listed, np.concatenate(indexed + [np.zeros(0, dtype=np.uint64)]))
+        extra = [p for p, new in zip(files, unindexed.tolist())
+                 if new and p.is_file() and p.suffix.lower() in IMAGE_EXTS]
+        self.digests_path = digests_path(self.out_dir)
+        cache = np.load(self.digests_path) if self.digests_path.exists() else np.zeros(0, dtype=DIGEST_DTYPE)
+        self.digests = file_digests(extra, cache)
+        todo = np.flatnonzero(self.digests["sha256"] == b"")
+        for i, (p, digest, error) in zip(todo, map_reported(sha256_file, [extra[i] for i in todo], workers)):
+            if error:
+                self.report.failed.append((p.name, error))
+            else:
+                self.digests["sha256"][i] = digest
+        self.digests = self.digests[self.digests["sha256"] != b""]
+        if len(todo) or len(self.digests) != len(cache):
+            save_digests(self.digests_path, self.digests)
+        self.seen: Set[str] = {d.decode() for d in self.digests["sha256"]}
+        self.written: List[Tuple[Path, str]] = []
+        self._stems: Dict[str, int] = {}
+        self.new_entries: List[Dict[str, Any]] = []
+        self.new_hashes: List[int] = []
+        self.new_multi: List[np.ndarray] = []
+
+        self.max_in_flight = max_in_flight or 2 * max(1, workers)
+        self.pool = process_pool(workers) if workers > 0 else None
+        self.pending: Dict[Future, Tuple[str, bool]] = {}
+
+    def _is_seen(self, digest: str) -> bool:
+        if digest in self.seen:
+            return True
+        key = np.uint64(int(digest[:16], 16))
+        i = np.searchsorted(self.known, key)
+        return bool(i < len(self.known) and self.known[i] == key)
+
+    def _reserve(self, name: str) -> Path:
+        """A free file name in out_dir; collisions get a numeric suffix from an in-memory counter."""
+        stem, suffix = Path(name).stem, Path(name).suffix
+        while name in self.taken:
+            i = self._stems.get(stem, 0)
+            self._stems[stem] = i + 1
+            name = f"{stem}_{i}{suffix}"
+        self.taken.add(name)
+        return self.out_dir / name
+
+    def add(self, name: str, payload: Union[bytes, Image.Image]) -> None:
+        prechecked = isinstance(payload, bytes)
+        if prechecked:
+            digest = hashlib.sha256(payload).hexdigest()
+            if self._is_seen(digest):
+                self.report.duplicates += 1
+                return
+            self.seen.add(digest)
+        target = str(self._reserve(name))
+        if self.pool is None:
+            fut: Future = Future()
+            try:
+                fut.set_result(store(target, payload, self.update_index))
+            except Exception as e:
+                fut.set_exception(e)
+            self.pending[fut] = (target, prechecked)
+            self._collect(block=False)
+            return
+        self.pending[self.pool.submit(store, target, payload, self.update_index)] = (target, prechecked)
+        if len(self.pending) >= self.max_in_flight:
+            self._collect(block=True)
+
+    def _collect(self, block: bool) -> None:
+        if block:
+            done, _ = wait(self.pending, return_when=FIRST_COMPLETED)
+        else:
+            done = [f for f in self.pending if f.done()]
+        for fut in done:
+            target, prechecked = self.pending.pop(fut)
+            try:
+                entry = fut.result()
+            except Exception as e:
+                Path(target).unlink(missing_ok=True)
+                self.report.failed.append((Path(target).name, f"{type(e).__name__}: {e}"))
+                continue
+            if not prechecked:
+                if self._is_seen(entry["sha256"]):
+                    Path(target).unlink(missing_ok=True)
+                    self.report.duplicates += 1
+                    continue
+                self.seen.add(entry["sha256"])
+            self.report.added += 1
+            if not self.update_index:
+                self.written.append((Path(target), entry["sha256"]))
+            else:
+                self.new_hashes.append(entry.pop("phash"))
+                self.new_multi.append(entry.pop("multi"))
+                self.new_entries.append(entry)
+
+    def ingest(self, items: Iterable[Item], progress: bool = False) -> "Ingestor":
+        for n, (name, payload) in enumerate(items, 1):
+            self.add(name, payload)
+            if progress and n % 100 == 0:
+                print(f"\r{n} read, {self.report.added} added, {self.report.duplicates} duplicates",
+                      end="", file=sys.stderr, flush=True)
+        if progress:
+            print(file=sys.stderr)
+        return self
+
+    def close(self) -> IngestReport:
+        """Wait for outstanding writes, then append the new rows to the packed index (or its shards)."""
+        while self.pending:
+            self._collect(block=True)
+        if self.pool is not None:
+            self.pool.shutdown()
+            self.pool = None
+        if self.update_index and self.new_entries:
+            if self.sharded:
+                self.report.failed += append_to_shards(self.index_path, self.new_entries, self.new_hashes,
+                                                       self.new_multi)
+            else:
+                self.index.appended(np.array(self.new_hashes, dtype=np.uint64), self.new_entries,
+                                    np.array(self.new_multi, dtype=np.uint64)).save(self.index_path)
+                self.report.failed += refresh_side_tables(self.index_path)
+            self.report.indexed = len(self.new_entries)
+        if self.written:
+            # files left out of the index are not hashed again by the next run
+            rows = file_digests([p for p, _ in self.written], np.zeros(0, dtype=DIGEST_DTYPE))
+            rows["sha256"] = [d for _, d in self.written]
+            self.digests = np.concatenate([self.digests, rows])
+            save_digests(self.digests_path, self.digests)
+            self.written = []
+        return self.report
+
+    def __enter__(self) -> "Ingestor":
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+
+def ingest(items: Iterable[Item], out_dir: Union[str, Path, None] = None, index_path: Union[str, Path, None] = None,
+           workers: Optional[int] = None, update_index: bool = True, progress: bool = False) -> IngestReport:
+    """Run `items` through an Ingestor and return its report."""
+    with Ingestor(out_dir, index_path, workers, update_index=update_index) as ing:
+        ing.ingest(items, progress)
+    return ing.report
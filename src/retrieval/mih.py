@@ -0,0 +1,136 @@
+
+from functools import lru_cache
+from itertools import combinations
+from typing import Optional, Tuple
+
+import numpy as np
+
+from .packed_index import hamming_many, popcount64_inplace
+
+
+@lru_cache(maxsize=None)
+def _flip_masks(bits: int, radius: int) -> np.ndarray:
+    """All `bits`-wide masks with exactly `radius` bits set."""
+    masks = [sum(1 << b for b in combo) for combo in combinations(range(bits), radius)]
+    return np.array(masks, dtype=np.uint64)
+
+
+def _gather(order: np.ndarray, lo: np.ndarray, hi: np.ndarray) -> np.ndarray:
+    """Concatenate order[lo[i]:hi[i]] for every i without a Python loop."""
+    lengths = hi - lo
+    keep = lengths > 0
+    lo, lengths = lo[keep], lengths[keep]
+    if lengths.size == 0:
+        return np.zeros(0, dtype=order.dtype)
+    starts = np.repeat(lo - np.concatenate(([0], np.cumsum(lengths)[:-1])), lengths)
+    return order[starts + np.arange(lengths.sum())]
+
+
+class MultiIndexHash:
+    """
+    Multi-index hashing over 64-bit hashes (Norouzi et al.). The hash is split
+    into `bands` substrings; each band keeps its keys sorted next to the row
+    order so a probe is a searchsorted. By pigeonhole, any entry within
+    distance bands * (s + 1) - 1 of the query matches it in some band with at
+    most s differing bits, so probing every band at sub-radius s and verifying
+    the candidates gives exact answers while touching only a small slice of
+    the index.
+    """
+
+    # Past this sub-radius the probe count outgrows a plain scan of the array
+    MAX_SUB_RADIUS = 3
+
+    def __init__(self, hashes: np.ndarray, bands: int = 4):
+        if 64 % bands:
+            raise ValueError(f"bands must divide 64, got {bands}")
+        self.hashes = hashes
+        self.bands = bands
+        self.bits = 64 // bands
+        mask = np.uint64((1 << self.bits) - 1)
+        self._keys, self._orders = [], []
+        for b in range(bands):
+            keys = (np.asarray(hashes) >> np.uint64(b * self.bits)) & mask
+            order = np.argsort(keys, kind="stable")
+            self._keys.append(keys[order])
+            self._orders.append(order)
+
+    def __len__(self):
+        return len(self.hashes)
+
+    def _probe(self, query: int, sub_radius: int) -> np.ndarray:
+        """Rows (unsorted, may repeat) that differ from the query by exactly `sub_radius` bits in some band."""
+        mask = (1 << self.bits) - 1
+        flips = _flip_masks(self.bits, sub_radius)
+        found = []
+        for b in range(self.bands):
+            probes = np.sort(np.uint64((query >> (b * self.bits)) & mask) ^ flips)
+            keys = self._keys[b]
+            lo = np.searchsorted(keys, probes, side="left")
+            hi = np.searchsorted(keys, probes, side="right")
+            found.append(_gather(self._orders[b], lo, hi))
+        return np.concatenate(found)
+
+    def _scored(self, rows: np.ndarray, query: int, limit: int) -> Tuple[np.ndarray, np.ndarray]:
+        dist = hamming_many(query, self.hashes[rows])
+        keep = dist <= limit
+        rows, dist = rows[keep], dist[keep]
+        order = np.argsort(dist, kind="stable")  # rows are unique and ascending
+        return rows[order], dist[order]
+
+    def radius(self, query: int, max_distance: int) -> Tuple[np.ndarray, np.ndarray]:
+        """All rows within max_distance, ordered by (distance, row)."""
+        sub = max_distance // self.bands
+        if sub > self.MAX_SUB_RADIUS:
+            return self._scored(np.arange(len(self)), query, max_distance)
+        rows = np.unique(np.concatenate([self._probe(query, r) for r in range(sub + 1)]))
+        return self._scored(rows, query, max_distance)
+
+    def radius_many(self, queries: np.ndarray, max_distance: int) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """
+        radius() for a batch of queries with one searchsorted per band:
+        (query position, row, distance) for every pair within max_distance,
+        unordered; a pair found through several bands is listed once per band.
+        """
+        queries = np.asarray(queries, dtype=np.uint64)
+        sub = max_distance // self.bands
+        if sub > self.MAX_SUB_RADIUS:
+            found = [self.radius(int(q), max_distance) for q in queries.tolist()]
+            qpos = np.repeat(np.arange(len(queries)), [len(r) for r, _ in found])
+            rows = np.concatenate([np.zeros(0, dtype=np.int64)] + [r for r, _ in found])
+            return qpos, rows, np.concatenate([np.zeros(0, dtype=np.uint8)] + [d for _, d in found])
+        flips = np.concatenate([_flip_masks(self.bits, r) for r in range(sub + 1)])
+        mask = np.uint64((1 << self.bits) - 1)
+        found_q, found_r = [np.zeros(0, dtype=np.int64)], [np.zeros(0, dtype=np.int64)]
+        for b in range(self.bands):
+            probes = (((queries >> np.uint64(b * self.bits)) & mask)[:, None] ^ flips[None, :]).ravel()
+            # sorted needles keep searchsorted's bisection in cache
+            order = np.argsort(probes)
+            keys = self._keys[b]
+            lo = np.searchsorted(keys, probes[order], side="left")
+            hi = np.searchsorted(keys, probes[order], side="right")
+            found_q.append(np.repeat(order // len(flips), hi - lo))
+            found_r.append(_gather(self._orders[b], lo, hi))
+        qpos, rows = np.concatenate(found_q), np.concatenate(found_r)
+        x = np.asarray(self.hashes)[rows]
+        np.bitwise_xor(x, queries[qpos], out=x)
+        dist = popcount64_inplace(x, np.empty_like(x)).astype(np.uint8)
+        keep = dist <= max_distance
+        return qpos[keep], rows[keep], dist[keep]
+
+    def topk(self, query: int, top_k: int = 4, max_distance: Optional[int] = None) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Exact top_k by (distance, row), optionally capped at max_distance.
+        The sub-radius grows until the guaranteed-complete radius holds top_k hits.
+        """
+        limit = 64 if max_distance is None else max_distance
+        if len(self) == 0 or top_k <= 0:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.uint8)
+        seen = []
+        for sub in range(self.MAX_SUB_RADIUS + 1):
+            seen.append(self._probe(query, sub))
+            complete = min(self.bands * (sub + 1) - 1, limit)
+            rows, dist = self._scored(np.unique(np.concatenate(seen)), query, complete)
+            if len(rows) >= top_k or complete == limit:
+                return rows[:top_k], dist[:top_k]
+        rows, dist = self._scored(np.arange(len(self)), query, limit)
+        return rows[:top_k], dist[:top_k]
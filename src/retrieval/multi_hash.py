@@ -0,0 +1,95 @@
+
+# src/retrieval/multi_hash.py
+#
+# Several compact perceptual hashes per image, all from one decode, so recycled
+# photos that were mirrored, rotated, cropped or recoloured still rank high:
+# pHash of the image and of its mirrored/rotated variants, dHash, aHash,
+# wHash and a colour-histogram hash. Rows are stored as one uint64 per kind
+# (hash_index.multi.npy) and scored with a single fused distance.
+
+from typing import Dict, Optional
+
+import imagehash
+import numpy as np
+import scipy.fftpack
+from PIL import Image
+
+from src.analysis.context import as_context
+from .packed_index import popcount64_inplace
+
+HASH_KINDS = ("phash", "phash_mirror", "phash_rot90", "phash_rot180", "phash_rot270",
+              "dhash", "ahash", "whash", "colorhash")
+HASH_BITS = {kind: 64 for kind in HASH_KINDS}
+HASH_BITS["colorhash"] = 42   # 14 bins x 3 bits
+
+# Columns a query's upright pHash is compared against; the closest one counts
+PHASH_COLUMNS = 5
+DEFAULT_WEIGHTS = {"phash": 0.4, "dhash": 0.2, "ahash": 0.1, "whash": 0.2, "colorhash": 0.1}
+
+# Colour fractions barely move under downscaling, so colorhash runs on a thumbnail
+_COLOR_SIDE = 256
+_SIGN = (-1.0) ** np.arange(8)
+
+
+def _pack(bits: np.ndarray) -> int:
+    """Bits in imagehash order (row-major, first bit most significant) as an int, like int(str(h), 16)."""
+    value = 0
+    for b in np.asarray(bits).ravel():
+        value = (value << 1) | int(b)
+    return value
+
+
+def _above_median(coeffs: np.ndarray) -> int:
+    return _pack(coeffs > np.median(coeffs))
+
+
+def multi_hash(image) -> np.ndarray:
+    """
+    One uint64 per HASH_KINDS entry for a path, PIL image or ImageContext.
+    "phash" equals phash_image(); the other kinds are this module's own
+    (computed from reduced copies) and only compared with each other. The
+    variant pHashes come from the same DCT: mirroring a signal negates its odd
+    coefficients and rotating transposes the block, so nothing is resampled twice.
+    """
+    img = as_context(image).image
+    gray = img.convert("L")
+
+    pixels = np.asarray(gray.resize((32, 32), Image.LANCZOS))
+    low = scipy.fftpack.dct(scipy.fftpack.dct(pixels, axis=0), axis=1)[:8, :8]
+    cols, rows = _SIGN[None, :], _SIGN[:, None]
+    variants = [low, low * cols, rows * low.T, low * rows * cols, low.T * cols]
+
+    # dHash, aHash and wHash share one 64x64 reduction instead of resampling the full frame each
+    base = gray.resize((64, 64), Image.LANCZOS)
+    small = np.asarray(base.resize((9, 8), Image.LANCZOS))
+    tiny = np.asarray(base.resize((8, 8), Image.LANCZOS))
+    thumb = img.reduce(max(1, max(img.size) // _COLOR_SIDE))
+
+    values = [_above_median(v) for v in variants]
+    values.append(_pack(small[:, 1:] > small[:, :-1]))
+    values.append(_pack(tiny > tiny.mean()))
+    values.append(_pack(imagehash.whash(base, 8, image_scale=64).hash))
+    values.append(_pack(imagehash.colorhash(thumb, binbits=3).hash))
+    return np.array(values, dtype=np.uint64)
+
+
+def fused_distances(table: np.ndarray, query: np.ndarray, weights: Optional[Dict[str, float]] = None) -> np.ndarray:
+    """
+    Weighted mean of per-kind Hamming distances between `query` (a multi_hash
+    row) and every row of `table`, each kind scaled to 64 bits, so the result
+    reads like a pHash distance. The pHash term is the smallest distance from
+    the query's pHash to any stored pHash variant, which catches mirrored and
+    rotated copies.
+    """
+    weights = DEFAULT_WEIGHTS if weights is None else weights
+    q = np.array(query, dtype=np.uint64)
+    q[1:PHASH_COLUMNS] = q[0]
+    table = np.asarray(table, dtype=np.uint64)
+    x = np.bitwise_xor(table, q)
+    bits = popcount64_inplace(x, np.empty_like(x)).astype(np.float32)
+    total = sum(weights.values()) or 1.0
+    scale = np.array([weights.get(kind, 0.0) * 64 / HASH_BITS[kind] / total
+                      for kind in HASH_KINDS[PHASH_COLUMNS:]], dtype=np.float32)
+    out = bits[:, :PHASH_COLUMNS].min(axis=1) * np.float32(weights.get("phash", 0.0) / total)
+    out += bits[:, PHASH_COLUMNS:] @ scale
+    return out
@@ -0,0 +1,471 @@
+
+import hashlib
+import json
+import os
+import re
+import threading
+from pathlib import Path
+from typing import Any, Dict, Iterable, List, Optional, Sequence, Tuple, Union
+
+import numpy as np
+
+from src.utils.config import file_stamp
+from src.utils.profiling import phase
+
+FORMAT_VERSION = 3
+# Readers that find the arrays of the generation they just read gone retry this often
+_LOAD_ATTEMPTS = 3
+
+# Rows scored per step by fused_topk
+_FUSED_BLOCK = 1 << 13
+
+_M1 = np.uint64(0x5555555555555555)
+_M2 = np.uint64(0x3333333333333333)
+_M4 = np.uint64(0x0F0F0F0F0F0F0F0F)
+_H01 = np.uint64(0x0101010101010101)
+
+
+def popcount64(x: np.ndarray) -> np.ndarray:
+    """Vectorized popcount of a uint64 array (SWAR; np.bitwise_count on NumPy 2)."""
+    if hasattr(np, "bitwise_count"):
+        return np.bitwise_count(x)
+    x = x - ((x >> np.uint64(1)) & _M1)
+    x = (x & _M2) + ((x >> np.uint64(2)) & _M2)
+    x = (x + (x >> np.uint64(4))) & _M4
+    return (x * _H01) >> np.uint64(56)
+
+
+def popcount64_inplace(x: np.ndarray, scratch: np.ndarray) -> np.ndarray:
+    """popcount64 written over x, using a same-shape scratch array instead of temporaries."""
+    if hasattr(np, "bitwise_count"):
+        return np.bitwise_count(x, out=x)
+    np.bitwise_and(np.right_shift(x, np.uint64(1), out=scratch), _M1, out=scratch)
+    np.subtract(x, scratch, out=x)
+    np.bitwise_and(np.right_shift(x, np.uint64(2), out=scratch), _M2, out=scratch)
+    np.add(np.bitwise_and(x, _M2, out=x), scratch, out=x)
+    np.add(x, np.right_shift(x, np.uint64(4), out=scratch), out=x)
+    np.bitwise_and(x, _M4, out=x)
+    return np.right_shift(np.multiply(x, _H01, out=x), np.uint64(56), out=x)
+
+
+def hamming_many(query: int, hashes: np.ndarray) -> np.ndarray:
+    """Hamming distance from one 64-bit hash to every entry of a uint64 array."""
+    return popcount64(hashes ^ np.uint64(query)).astype(np.uint8)
+
+
+def meta_path(path: Union[str, Path]) -> Path:
+    """Side table next to the hash array: hash_index.npy -> hash_index.meta.json."""
+    return Path(path).with_suffix(".meta.json")
+
+
+def multi_path(path: Union[str, Path]) -> Path:
+    """Per-kind hash table of a version-1 index (see multi_hash.py): hash_index.npy -> hash_index.multi.npy."""
+    return Path(path).with_suffix(".multi.npy")
+
+
+def array_paths(path: Union[str, Path], generation: Optional[str]) -> Tuple[Path, Path]:
+    """
+    Hash array and multi-hash table of one saved generation:
+    hash_index.npy -> hash_index.g<id>.npy, hash_index.g<id>.multi.npy.
+    generation=None is the version-1 layout (hash_index.npy, hash_index.multi.npy).
+    """
+    if generation is None:
+        return Path(path), multi_path(path)
+    return Path(path).with_suffix(f".{generation}.npy"), Path(path).with_suffix(f".{generation}.multi.npy")
+
+
+def entries_paths(path: Union[str, Path], generation: str) -> Tuple[Path, Path]:
+    """
+    Entries of a version-3 generation: one JSON object per line
+    (hash_index.g<id>.entries.jsonl) and the per-row stats (hash_index.g<id>.rows.npy).
+    """
+    return Path(path).with_suffix(f".{generation}.entries.jsonl"), Path(path).with_suffix(f".{generation}.rows.npy")
+
+
+def index_exists(path: Union[str, Path]) -> bool:
+    """True once a packed index has been saved at path (its side table is the commit point)."""
+    return meta_path(path).exists()
+
+
+def _remove_stale_arrays(path: Path, generation: str) -> None:
+    """Drop the files of earlier generations (and of the version-1 layout) after a save."""
+    stem = re.escape(path.stem)
+    pattern = re.compile(stem + r"(\.g[0-9a-f]+)?(\.multi)?\.npy|" + stem + r"\.g[0-9a-f]+\.(rows\.npy|entries\.jsonl)")
+    keep = set(array_paths(path, generation)) | set(entries_paths(path, generation))
+    for p in path.parent.glob(f"{path.stem}.*"):
+        if pattern.fullmatch(p.name) and p not in keep:
+            try:
+                p.unlink()
+            except OSError:
+                pass  # still mapped by a reader on a platform that won't unlink it; a later save retries
+
+
+def clusters_path(path: Union[str, Path]) -> Path:
+    """Near-duplicate cluster table: hash_index.npy -> hash_index.clusters.npz (see clusters.py)."""
+    return Path(path).with_suffix(".clusters.npz")
+
+
+def tiles_path(path: Union[str, Path]) -> Path:
+    """Region tile-hash table: hash_index.npy -> hash_index.tiles.npz (see tile_index.py)."""
+    return Path(path).with_suffix(".tiles.npz")
+
+
+def embed_path(path: Union[str, Path]) -> Path:
+    """Descriptor IVF index: hash_index.npy -> hash_index.embed.npz + hash_index.embed.npy (see embedding.py)."""
+    return Path(path).with_suffix(".embed.npz")
+
+
+# Per-row stats stored next to the entries, so builds and ingestion can check
+# rows without parsing them: content key (row_keys), path key (path_key),
+# size, mtime and the end offset of the row's line in the .entries.jsonl file
+ROW_DTYPE = np.dtype([("key", "<u8"), ("path", "<u8"), ("size", "<i8"), ("mtime_ns", "<i8"), ("end", "<u8")])
+
+
+def path_key(path: Union[str, Path]) -> int:
+    """uint64 key of a path string (the leading 64 bits of its sha256)."""
+    return int(hashlib.sha256(str(path).encode("utf-8")).hexdigest()[:16], 16)
+
+
+def row_stats(entries: Iterable[Dict[str, Any]], lines: Optional[List[bytes]] = None) -> np.ndarray:
+    """
+    ROW_DTYPE row of every entry. The content key is the leading 64 bits of
+    its sha256; entries without one (legacy JSON) are keyed by path, size and
+    mtime instead. `lines`, when given, receives each entry's JSON line and
+    `end` counts from the first of them.
+    """
+    rows, end = [], 0
+    for e in entries:
+        digest = e.get("sha256") or hashlib.sha256(
+            f"{e['path']}|{e.get('size')}|{e.get('mtime_ns')}".encode("utf-8")).hexdigest()
+        if lines is not None:
+            line = (json.dumps(e) + "\n").encode("utf-8")
+            lines.append(line)
+            end += len(line)
+        rows.append((int(digest[:16], 16), path_key(e["path"]), e.get("size") or 0, e.get("mtime_ns") or 0, end))
+    return np.array(rows, dtype=ROW_DTYPE)
+
+
+class LazyEntries(Sequence):
+    """
+    Side-table entries of a version-3 index. The .entries.jsonl file is
+    memory-mapped and a row is parsed only when it is read, so a query
+    touches only the entries of the rows it returns. `extra` holds rows
+    appended in memory (PackedIndex.appended) that are not saved yet.
+    """
+
+    def __init__(self, path: Path, rows: np.ndarray, extra: Sequence[Dict[str, Any]] = ()):
+        self.path = path
+        self.rows = rows
+        self.extra = list(extra)
+        end = int(rows["end"][-1]) if len(rows) else 0
+        self._data = np.memmap(path, dtype=np.uint8, mode="r", shape=(end,)) if end else np.zeros(0, np.uint8)
+
+    def __len__(self):
+        return len(self.rows) + len(self.extra)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        i = range(len(self))[i]
+        if i >= len(self.rows):
+            return self.extra[i - len(self.rows)]
+        start = int(self.rows["end"][i - 1]) if i else 0
+        return json.loads(self._data[start:int(self.rows["end"][i])].tobytes())
+
+    def plus(self, entries: Sequence[Dict[str, Any]]) -> "LazyEntries":
+        return LazyEntries(self.path, self.rows, self.extra + list(entries))
+
+    def raw(self) -> memoryview:
+        """The saved rows' JSON lines as stored."""
+        return memoryview(self._data)
+
+
+class PackedIndex:
+    """
+    pHash index stored as a packed uint64 array (memory-mapped on load) plus a
+    side table of paths and labels. Row i of the array belongs to entries[i].
+    `multi`, when present, holds one row of multi_hash() values per entry for
+    the fused backend. Each save writes the arrays and the entries under a new
+    generation id (hash_index.g<id>.npy, .g<id>.multi.npy, .g<id>.entries.jsonl,
+    .g<id>.rows.npy) and then switches to them by replacing hash_index.meta.json,
+    which names the generation. Entries are parsed only when read
+    (LazyEntries). When a cluster table built on exactly these rows exists,
+    results also carry cluster_id and cluster_size; matching tile and
+    descriptor indexes are attached as `tiles` and `embeddings`.
+    """
+
+    def __init__(self, hashes: np.ndarray, entries: Sequence[Dict[str, Any]], multi: Optional[np.ndarray] = None):
+        if len(hashes) != len(entries):
+            raise ValueError(f"{len(hashes)} hashes but {len(entries)} side-table entries")
+        if multi is not None and len(multi) != len(entries):
+            raise ValueError(f"{len(multi)} multi-hash rows but {len(entries)} side-table entries")
+        self.hashes = hashes
+        self.entries = entries
+        self.multi = multi
+        self._mih: Dict[int, Any] = {}
+        self._rows: Optional[np.ndarray] = None
+        self.clusters = None
+        self.tiles = None
+        self.embeddings = None
+
+    def __len__(self):
+        return len(self.entries)
+
+    # ----------------------------- I/O -----------------------------
+    @classmethod
+    def empty(cls) -> "PackedIndex":
+        from .multi_hash import HASH_KINDS
+        return cls(np.zeros(0, dtype=np.uint64), [], np.zeros((0, len(HASH_KINDS)), dtype=np.uint64))
+
+    @classmethod
+    def from_json(cls, path: Union[str, Path]) -> "PackedIndex":
+        """Import the legacy {'entries': [{'path', 'label', 'phash'}]} JSON index."""
+        with open(path, "r", encoding="utf-8") as f:
+            raw = json.load(f).get("entries", [])
+        hashes = np.array([int(e["phash"]) for e in raw], dtype=np.uint64)
+        entries = [{"path": e["path"], "label": e["label"]} for e in raw]
+        return cls(hashes, entries)
+
+    @classmethod
+    def load(cls, path: Union[str, Path]) -> "PackedIndex":
+        """
+        Load a packed index, memory-mapping the hash array. A '.json' path, or a
+        missing packed index with a legacy JSON sibling, is imported in memory.
+        The arrays are always those of the generation the side table names.
+        """
+        path = Path(path)
+        if path.suffix == ".json":
+            return cls.from_json(path)
+        if not index_exists(path):
+            legacy = path.with_suffix(".json")
+            return cls.from_json(legacy) if legacy.exists() else cls.empty()
+        for attempt in range(_LOAD_ATTEMPTS):
+            with open(meta_path(path), "r", encoding="utf-8") as f:
+                meta = json.load(f)
+            count = meta["count"] if "count" in meta else len(meta["entries"])
+            mode = "r" if count else None
+            generation = meta.get("generation")
+            hashes_file, multi_file = array_paths(path, generation)
+            try:
+                hashes = np.load(hashes_file, mmap_mode=mode)
+                multi = None
+                if meta.get("hash_kinds"):
+                    from .multi_hash import HASH_KINDS
+                    if tuple(meta["hash_kinds"]) == HASH_KINDS:
+                        multi = np.load(multi_file, mmap_mode=mode)
+                entries = meta.get("entries")
+                if entries is None:
+                    entries_file, rows_file = entries_paths(path, generation)
+                    entries = LazyEntries(entries_file, np.load(rows_file, mmap_mode=mode))
+                break
+            except FileNotFoundError:
+                # a writer switched to a newer generation and removed this one in between
+                if attempt == _LOAD_ATTEMPTS - 1:
+                    raise
+        index = cls(hashes, entries, multi)
+        from .side_table import side_tables
+        for attr, table_cls in side_tables():
+            table = table_cls.load(table_cls.path_for(path))
+            if table is not None and table.attaches_to(index):
+                setattr(index, attr, table)
+        return index
+
+    def save(self, path: Union[str, Path]) -> None:
+        """
+        Write the arrays and entries of a new generation, then switch to it
+        with one os.replace of the side table, so a reader gets either the old
+        or the new rows, never a mix. Older generations are removed afterwards.
+        Saved rows of LazyEntries are copied as stored, without parsing them.
+        """
+        path = Path(path)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        generation = "g" + os.urandom(6).hex()
+        entries_file, rows_file = entries_paths(path, generation)
+        saved = self.entries if isinstance(self.entries, LazyEntries) else None
+        lines: List[bytes] = []
+        new_rows = row_stats(saved.extra if saved else self.entries, lines)
+        with open(entries_file, "wb") as f:
+            if saved is not None:
+                f.write(saved.raw())
+            f.writelines(lines)
+        base = saved.rows if saved is not None else np.zeros(0, dtype=ROW_DTYPE)
+        new_rows["end"] += int(base["end"][-1]) if len(base) else 0
+        with open(rows_file, "wb") as f:
+            np.save(f, np.concatenate([np.asarray(base), new_rows]))
+        hashes_file, multi_file = array_paths(path, generation)
+        with open(hashes_file, "wb") as f:
+            np.save(f, np.ascontiguousarray(self.hashes, dtype=np.uint64))
+        header: Dict[str, Any] = {"version": FORMAT_VERSION, "generation": generation, "count": len(self)}
+        if self.multi is not None:
+            from .multi_hash import HASH_KINDS
+            with open(multi_file, "wb") as f:
+                np.save(f, np.ascontiguousarray(self.multi, dtype=np.uint64))
+            header["hash_kinds"] = list(HASH_KINDS)
+        meta = meta_path(path)
+        tmp_meta = meta.with_name(meta.name + ".tmp")
+        with open(tmp_meta, "w", encoding="utf-8") as f:
+            json.dump(header, f)
+        os.replace(tmp_meta, meta)
+        _remove_stale_arrays(path, generation)
+
+    def appended(self, hashes: np.ndarray, entries: List[Dict[str, Any]], multi: np.ndarray) -> "PackedIndex":
+        """
+        This index plus new rows; the existing entries are not parsed. An index
+        without the multi-hash table stays without it until build_index re-hashes it.
+        """
+        grown = np.concatenate([np.asarray(self.hashes, dtype=np.uint64), np.asarray(hashes, dtype=np.uint64)])
+        table = None
+        if self.multi is not None:
+            table = np.concatenate([np.asarray(self.multi, dtype=np.uint64),
+                                    np.asarray(multi, dtype=np.uint64).reshape(len(entries), -1)])
+        grown_entries = self.entries.plus(entries) if isinstance(self.entries, LazyEntries) \
+            else list(self.entries) + list(entries)
+        return PackedIndex(grown, grown_entries, table)
+
+    def rows(self) -> np.ndarray:
+        """ROW_DTYPE stats of every row; read from disk for a saved index, without parsing the entries."""
+        if self._rows is None:
+            if isinstance(self.entries, LazyEntries):
+                self._rows = np.concatenate([np.asarray(self.entries.rows), row_stats(self.entries.extra)])
+            else:
+                self._rows = row_stats(self.entries)
+        return self._rows
+
+    def row_keys(self) -> np.ndarray:
+        """
+        uint64 content key of every row (see row_stats), so side tables can
+        reuse the rows of unchanged images.
+        """
+        return self.rows()["key"]
+
+    # ----------------------------- Query -----------------------------
+    def distances(self, query: int) -> np.ndarray:
+        return hamming_many(query, self.hashes)
+
+    def mih(self, bands: int = 4):
+        """Multi-index hash tables over this index, built on first use."""
+        if bands not in self._mih:
+            from .mih import MultiIndexHash
+            self._mih[bands] = MultiIndexHash(self.hashes, bands)
+        return self._mih[bands]
+
+    def topk(self, query: int, top_k: int = 4, max_distance: Optional[int] = None,
+             backend: str = "linear", bands: int = 4) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Rows and distances of the top_k nearest entries ordered by (distance, row),
+        matching a stable sort over the whole index. `max_distance` drops entries
+        farther than that; backend 'mih' answers from multi-index hash tables
+        instead of scanning the whole array.
+        """
+        n = len(self)
+        if n == 0 or top_k <= 0:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.uint8)
+        if backend == "mih":
+            return self.mih(bands).topk(query, top_k, max_distance)
+        if backend != "linear":
+            raise ValueError(f"Unknown retrieval backend: {backend}")
+        dist = self.distances(query)
+        if max_distance is not None:
+            rows = np.flatnonzero(dist <= max_distance)
+            rows = rows[np.argsort(dist[rows], kind="stable")][:top_k]
+            return rows, dist[rows]
+        if top_k < n:
+            kth = dist[np.argpartition(dist, top_k - 1)[top_k - 1]]
+            cand = np.flatnonzero(dist <= kth)
+        else:
+            cand = np.arange(n)
+        rows = cand[np.argsort(dist[cand], kind="stable")][:top_k]
+        return rows, dist[rows]
+
+    def fused_topk(self, query: np.ndarray, top_k: int = 4, max_distance: Optional[float] = None,
+                   weights: Optional[Dict[str, float]] = None) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Top_k rows by fused multi-hash distance (see multi_hash.fused_distances),
+        ordered by (distance, row). The table is scored in blocks that stay in
+        cache, keeping only each block's top_k.
+        """
+        from .multi_hash import fused_distances
+        if self.multi is None:
+            raise ValueError("index has no multi-hash table; rebuild it with build_index")
+        rows_out, dist_out = [np.zeros(0, dtype=np.int64)], [np.zeros(0, dtype=np.float32)]
+        for start in range(0, len(self), _FUSED_BLOCK):
+            dist = fused_distances(self.multi[start:start + _FUSED_BLOCK], query, weights)
+            rows = np.arange(len(dist)) if max_distance is None else np.flatnonzero(dist <= max_distance)
+            if len(rows) > top_k:
+                # keep ties at the cut so the final order matches a full stable sort
+                kth = np.partition(dist[rows], top_k - 1)[top_k - 1]
+                rows = rows[dist[rows] <= kth]
+            rows_out.append(rows + start)
+            dist_out.append(dist[rows])
+        rows, dist = np.concatenate(rows_out), np.concatenate(dist_out)
+        order = np.lexsort((rows, dist))[:top_k]
+        return rows[order], dist[order]
+
+    def describe(self, rows: np.ndarray, dist: np.ndarray) -> List[Dict[str, Any]]:
+        """Result dicts in the shape nearest() has always returned, plus cluster fields when available."""
+        as_number = int if np.issubdtype(dist.dtype, np.integer) else (lambda d: round(float(d), 2))
+        out = [{"path": self.entries[i]["path"], "label": self.entries[i]["label"], "distance": as_number(d)}
+               for i, d in zip(rows.tolist(), dist.tolist())]
+        if self.clusters is not None:
+            for r, i in zip(out, rows.tolist()):
+                r["cluster_id"], r["cluster_size"] = self.clusters.lookup(i)
+        return out
+
+    def nearest(self, query: int, top_k: int = 4, **kwargs) -> List[Dict[str, Any]]:
+        return self.describe(*self.topk(query, top_k, **kwargs))
+
+
+# ----------------------------- Process cache -----------------------------
+_cache: Dict[str, Any] = {}
+_cache_lock = threading.Lock()
+
+
+def index_stamp(path: Union[str, Path]) -> Tuple:
+    """
+    Change marker for everything a query reads from an index: the side table
+    (replaced by every save), a legacy JSON index and the optional cluster,
+    tile and descriptor tables; for a shard manifest, the manifest, its
+    cluster table and every shard.
+    """
+    from .shards import is_manifest, open_sharded
+    path = Path(path)
+    if is_manifest(path):
+        sharded = open_sharded(path)
+        return (file_stamp(path), file_stamp(clusters_path(path))) + tuple(index_stamp(sharded.manifest.shard_path(n)) for n in sharded.names)
+    return (file_stamp(meta_path(path)), file_stamp(path.with_suffix(".json")),
+            file_stamp(clusters_path(path)), file_stamp(tiles_path(path)), file_stamp(embed_path(path)))
+
+
+def open_index(path: Union[str, Path]) -> PackedIndex:
+    """
+    Process-wide cached index; reloaded only when index_stamp() changes (e.g.
+    after build_index or a side-table CLI).
+    """
+    path = Path(path)
+    stamp = index_stamp(path)
+    key = str(path)
+    hit = _cache.get(key)
+    if hit is not None and hit[0] == stamp:
+        return hit[1]
+    with phase("load"), _cache_lock:
+        hit = _cache.get(key)
+        if hit is None or hit[0] != stamp:
+            hit = (stamp, PackedIndex.load(path))
+            _cache[key] = hit
+        return hit[1]
+
+
+def migrate_json(json_path: Union[str, Path], out_path: Optional[Union[str, Path]] = None) -> Path:
+    """Convert a legacy JSON index to the packed format; returns the index path (.npy)."""
+    out = Path(out_path) if out_path else Path(json_path).with_suffix(".npy")
+    PackedIndex.from_json(json_path).save(out)
+    return out
+
+
+if __name__ == "__main__":
+    import sys
+    if len(sys.argv) < 2:
+        print("usage: python -m src.retrieval.packed_index <hash_index.json> [out.npy]")
+        sys.exit(1)
+    out = migrate_json(sys.argv[1], sys.argv[2] if len(sys.argv) > 2 else None)
+    print(f"Migrated {sys.argv[1]} -> {out}")
@@ -0,0 +1,436 @@
+
+# src/retrieval/shards.py
+#
+# Sharded damage-DB index for multi-million-image DBs: rows are split by label
+# or by pHash prefix into independent packed indexes (each with its own tile
+# and descriptor tables, plus one cluster table over all of them) listed in a
+# manifest. Point retrieval.hash_index_path at the
+# manifest and build_index, ingestion and nearest() use the shards: each shard
+# is rebuilt on its own, opened (memory-mapped) the first time a query
+# touches it, and queries fan out over the shards on a thread pool with the
+# per-shard top-k merged through a heap.
+#   python -m src.retrieval.shards --manifest data/index/shards/manifest.json --by prefix --bits 4
+#   python -m src.retrieval.shards --manifest data/index/shards/manifest.json --shard p3 --full
+
+import argparse
+import heapq
+import json
+import os
+import re
+import threading
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
+from pathlib import Path
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional, Sequence, Tuple, Union
+
+import numpy as np
+
+from src.utils.config import ROOT, file_stamp, load_config, resolve_path
+from src.utils.pool import map_reported
+from .build_index import BuildReport, hash_file, list_images, refresh_side_tables, update_index
+from .clusters import ClusterTable, ClusterView
+from .packed_index import ROW_DTYPE, PackedIndex, clusters_path, meta_path, open_index, path_key
+from .side_table import TableReport
+
+FORMAT_VERSION = 1
+MANIFEST = "manifest.json"
+SHARD_BY = ("prefix", "label")
+
+
+def is_manifest(path: Union[str, Path]) -> bool:
+    """True for a shard manifest path (manifest.json, or any name ending in it)."""
+    return Path(path).name.endswith(MANIFEST)
+
+
+def index_paths(path: Union[str, Path]) -> List[Path]:
+    """The packed indexes behind retrieval.hash_index_path: every shard of a manifest, else the path itself."""
+    if not is_manifest(path):
+        return [Path(path)]
+    manifest = Manifest.load(path)
+    if manifest is None:
+        raise FileNotFoundError(f"No shard manifest at {path}; build it with python -m src.retrieval.shards")
+    return [manifest.shard_path(n) for n in sorted(manifest.shards)]
+
+
+def shard_name(by: str, bits: int, path: str, phash: int) -> str:
+    """
+    Shard of one image: "p" + the top `bits` bits of its pHash in hex, or
+    "label_" + its label (the file-name prefix, as in the side table).
+    """
+    if by == "label":
+        return "label_" + re.sub(r"[^A-Za-z0-9_-]", "_", Path(path).stem.split("_")[0])
+    if by == "prefix":
+        return f"p{int(phash) >> (64 - bits):0{(bits + 3) // 4}x}"
+    raise ValueError(f"Unknown shard key: {by}")
+
+
+class Manifest:
+    """
+    Shard layout: key (`by`, `bits`) and name -> {"path", "entries"}, paths
+    relative to the manifest. `clusters` holds the shard stamps the
+    manifest-wide cluster table was built on (see update_shard_clusters).
+    """
+
+    def __init__(self, path: Union[str, Path], by: str = "prefix", bits: int = 4,
+                 shards: Optional[Dict[str, Dict[str, Any]]] = None,
+                 clusters: Optional[Dict[str, Any]] = None):
+        if by not in SHARD_BY:
+            raise ValueError(f"Unknown shard key: {by}")
+        self.path = Path(path)
+        self.by = by
+        self.bits = int(bits)
+        self.shards = shards or {}
+        self.clusters = clusters
+
+    def shard_path(self, name: str) -> Path:
+        return self.path.parent / self.shards.get(name, {}).get("path", f"{name}.npy")
+
+    def shard_of(self, path: str, phash: int) -> str:
+        return shard_name(self.by, self.bits, path, phash)
+
+    def stamps(self) -> Dict[str, Any]:
+        """Change marker of every shard (its meta.json), as stored in the manifest."""
+        return {n: list(file_stamp(meta_path(self.shard_path(n))) or ()) for n in sorted(self.shards)}
+
+    def lower_bound(self, name: str, phash: int) -> int:
+        """Least pHash Hamming distance from phash to any row of a prefix shard: its differing prefix bits."""
+        return bin(int(name[1:], 16) ^ (int(phash) >> (64 - self.bits))).count("1")
+
+    @classmethod
+    def load(cls, path: Union[str, Path]) -> Optional["Manifest"]:
+        path = Path(path)
+        if not path.exists():
+            return None
+        with open(path, "r", encoding="utf-8") as f:
+            raw = json.load(f)
+        return cls(path, raw["by"], raw.get("bits", 0), raw["shards"], raw.get("clusters"))
+
+    def save(self) -> None:
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = self.path.with_name(self.path.name + ".tmp")
+        raw = {"version": FORMAT_VERSION, "by": self.by, "bits": self.bits,
+               "shards": dict(sorted(self.shards.items()))}
+        if self.clusters is not None:
+            raw["clusters"] = self.clusters
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(raw, f, indent=1)
+        os.replace(tmp, self.path)
+
+
+# ----------------------------- Query -----------------------------
+_pool: Optional[ThreadPoolExecutor] = None
+_pool_lock = threading.Lock()
+
+
+def _executor() -> ThreadPoolExecutor:
+    """Process-wide fan-out pool; NumPy releases the GIL in the per-shard scans."""
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ThreadPoolExecutor(max_workers=os.cpu_count() or 1, thread_name_prefix="shard")
+        return _pool
+
+
+class ChainedEntries(Sequence):
+    """The entries of several shards back to back, read through to the shard holding each row."""
+
+    def __init__(self, parts: Sequence[Sequence[Dict[str, Any]]]):
+        self.parts = list(parts)
+        self.ends = np.cumsum([len(p) for p in self.parts], dtype=np.int64)
+
+    def __len__(self):
+        return int(self.ends[-1]) if len(self.ends) else 0
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        i = range(len(self))[i]
+        part = int(np.searchsorted(self.ends, i, side="right"))
+        return self.parts[part][i - (int(self.ends[part - 1]) if part else 0)]
+
+
+class ShardedIndex:
+    """
+    The shards of one manifest. Nothing is read until a query touches a
+    shard; open_index() then memory-maps it and keeps it for the process.
+    Entries are parsed only for the rows a query returns (LazyEntries).
+    Rows are numbered across shards in name order (combined()); the
+    manifest-wide cluster table and its cluster ids use that numbering.
+    """
+
+    def __init__(self, manifest: Manifest):
+        self.manifest = manifest
+        counts = [manifest.shards[n].get("entries", 0) for n in self.names]
+        self.offsets = dict(zip(self.names, np.cumsum([0] + counts[:-1]).tolist()))
+        self._clusters: Optional[ClusterTable] = None
+        self._clusters_read = False
+
+    def __len__(self):
+        return sum(s.get("entries", 0) for s in self.manifest.shards.values())
+
+    @property
+    def names(self) -> List[str]:
+        return sorted(self.manifest.shards)
+
+    def shard(self, name: str) -> PackedIndex:
+        index = open_index(self.manifest.shard_path(name))
+        table = self.cluster_table()
+        if table is not None or isinstance(index.clusters, ClusterView):
+            index.clusters = table.view(self.offsets[name]) if table is not None else None
+        return index
+
+    def cluster_table(self) -> Optional[ClusterTable]:
+        """The manifest-wide cluster table, if there is one and it was built on the current shards."""
+        if not self._clusters_read:
+            table = ClusterTable.load(clusters_path(self.manifest.path))
+            if table is not None and len(table) == len(self) and self.manifest.clusters == self.manifest.stamps():
+                self._clusters = table
+            self._clusters_read = True
+        return self._clusters
+
+    def combined(self) -> PackedIndex:
+        """Every shard's rows in one index, in name order; entries stay on disk (ChainedEntries)."""
+        parts = list(self.indexes())
+        hashes = np.concatenate([np.asarray(p.hashes, dtype=np.uint64) for p in parts] + [np.zeros(0, np.uint64)])
+        return PackedIndex(hashes, ChainedEntries([p.entries for p in parts]))
+
+    def indexes(self) -> Iterator[PackedIndex]:
+        """Every shard in turn, loaded for the caller only (not kept open)."""
+        for name in self.names:
+            yield PackedIndex.load(self.manifest.shard_path(name))
+
+    def entries(self) -> Iterable[Dict[str, Any]]:
+        for index in self.indexes():
+            yield from index.entries
+
+    def search(self, fn: Callable[[PackedIndex], List[Dict[str, Any]]], top_k: int,
+               key: Callable[[Dict[str, Any]], Any] = lambda r: r["distance"],
+               names: Optional[Sequence[str]] = None,
+               bound: Optional[Callable[[str], Any]] = None) -> List[Dict[str, Any]]:
+        """
+        Run fn (a shard's results, best first) on the shards in parallel and
+        merge the top_k by key; ties go to the earlier shard, then its own order.
+        Results carry the name of their shard. With `bound` (the least key any
+        result of a shard can have), shards are searched a pool-width at a time
+        in bound order, and the rest are skipped once top_k results beat them.
+        """
+        names = sorted(self.names if names is None else names)
+        rank = {n: i for i, n in enumerate(names)}
+        todo = sorted(names, key=lambda n: (bound(n), rank[n])) if bound else names
+        step = (os.cpu_count() or 1) if bound else len(todo)
+
+        def run(name: str) -> List[Dict[str, Any]]:
+            return [dict(r, shard=name) for r in fn(self.shard(name))]
+
+        per_shard: Dict[str, List[Dict[str, Any]]] = {}
+        best: List[Dict[str, Any]] = []
+        for start in range(0, len(todo), max(1, step)):
+            chunk = todo[start:start + step]
+            per_shard.update(zip(chunk, _executor().map(run, chunk) if len(chunk) > 1 else map(run, chunk)))
+            merged = heapq.merge(*[[(key(r), rank[n], j, r) for j, r in enumerate(res)]
+                                   for n, res in sorted(per_shard.items(), key=lambda kv: rank[kv[0]])])
+            best = [r for *_, r in islice(merged, top_k)]
+            rest = todo[start + step:]
+            if not rest or (len(best) >= top_k and key(best[-1]) < bound(rest[0])):
+                break
+        return best
+
+
+_cache: Dict[str, Tuple[Any, ShardedIndex]] = {}
+
+
+def open_sharded(path: Union[str, Path]) -> ShardedIndex:
+    """Process-wide cached ShardedIndex; the manifest is re-read only when it changes on disk."""
+    path = Path(path)
+    stamp = (file_stamp(path), file_stamp(clusters_path(path)))
+    hit = _cache.get(str(path))
+    if hit is None or hit[0] != stamp:
+        manifest = Manifest.load(path) or Manifest(path)
+        hit = (stamp, ShardedIndex(manifest))
+        _cache[str(path)] = hit
+    return hit[1]
+
+
+# ----------------------------- Build -----------------------------
+def _drop_shard(manifest: Manifest, name: str) -> None:
+    """Remove a shard that has no images left: its array, side table and side indexes."""
+    stem = manifest.shard_path(name).stem
+    for p in manifest.path.parent.glob(f"{stem}.*"):
+        p.unlink()
+    manifest.shards.pop(name, None)
+
+
+def build_shards(image_dir: Union[str, Path], manifest_path: Union[str, Path], by: Optional[str] = None,
+                 bits: Optional[int] = None, workers: Optional[int] = None, full: bool = False,
+                 only: Optional[Sequence[str]] = None) -> BuildReport:
+    """
+    Incrementally build the sharded index for image_dir. Files are grouped
+    into shards (by label from the file name, or by pHash prefix, which needs
+    the hash of new and changed files first); each shard is then brought up
+    to date with update_index() and rewritten only if it changed. `only`
+    limits the work to those shards (with full=True: re-hash just them).
+    Changing `by`/`bits` re-shards everything.
+    """
+    manifest_path = Path(manifest_path)
+    cfg = load_config()["retrieval"]
+    manifest = Manifest.load(manifest_path)
+    by = by or (manifest.by if manifest else cfg.get("shard_by", "prefix"))
+    bits = bits or (manifest.bits if manifest else cfg.get("shard_bits", 4))
+    old_names = set(manifest.shards) if manifest else set()
+    changed = manifest is None
+    if manifest is None or (manifest.by, manifest.bits) != (by, bits):
+        manifest, full, changed = Manifest(manifest_path, by, bits, {}), True, True
+    report = BuildReport(index_path=str(manifest_path))
+
+    groups: Dict[str, List[Path]] = defaultdict(list)
+    hashed: Dict[str, dict] = {}
+    images = list_images(Path(image_dir))
+    if by == "label":
+        for p in images:
+            groups[manifest.shard_of(str(p), 0)].append(p)
+    else:
+        # which shard holds each file, from the per-row stats: no shard's entries are parsed
+        names = sorted(manifest.shards)
+        stats = [PackedIndex.load(manifest.shard_path(n)).rows() for n in names]
+        known = np.concatenate([np.asarray(r) for r in stats] + [np.zeros(0, dtype=ROW_DTYPE)])
+        shard_of_row = np.repeat(np.arange(len(names)), [len(r) for r in stats])
+        order = np.argsort(known["path"], kind="stable")
+        keys = np.array([path_key(p) for p in images], dtype=np.uint64)
+        pos = np.minimum(np.searchsorted(known["path"][order], keys), max(0, len(order) - 1))
+        todo = []
+        for p, k, j in zip(images, keys, pos.tolist()):
+            st = p.stat()
+            row = order[j] if len(order) and known["path"][order[j]] == k else None
+            name = names[shard_of_row[row]] if row is not None else None
+            rehash = full and (not only or name in only)
+            if name is not None and (int(known["size"][row]), int(known["mtime_ns"][row])) == (
+                    st.st_size, st.st_mtime_ns) and not rehash:
+                groups[name].append(p)
+            else:
+                todo.append(str(p))
+        for path, entry, error in map_reported(hash_file, todo, workers or None):
+            if error:
+                report.failed.append((path, error))
+                continue
+            hashed[path] = entry
+            groups[manifest.shard_of(path, entry["phash"])].append(Path(path))
+
+    names = sorted(set(groups) | set(manifest.shards))
+    for name in names:
+        if only and name not in only:
+            continue
+        if not groups.get(name):
+            _drop_shard(manifest, name)
+            changed = True
+            continue
+        r = update_index(manifest.shard_path(name), groups[name], workers, full, hashed, drop_unlisted=True)
+        manifest.shards[name] = {"path": f"{name}.npy", "entries": r.total}
+        changed = changed or bool(r.added or r.updated or r.removed or full)
+        report.added += r.added
+        report.updated += r.updated
+        report.removed += r.removed
+        report.unchanged += r.unchanged
+        report.failed += r.failed
+    # shards of a previous layout (other key or bits) are gone after a re-shard
+    for name in old_names - set(manifest.shards):
+        _drop_shard(Manifest(manifest_path, by, bits, {name: {"path": f"{name}.npy"}}), name)
+    if changed and clusters_path(manifest_path).exists():
+        _refresh_shard_clusters(manifest)
+    # the manifest's stamp marks the whole index as changed (e.g. for the result cache)
+    if changed:
+        manifest.save()
+    return report
+
+
+def append_to_shards(manifest_path: Union[str, Path], entries: List[Dict[str, Any]], hashes: Sequence[int],
+                     multi: Sequence[np.ndarray]) -> List[Tuple[str, str]]:
+    """
+    Append already hashed rows (ingestion) to the shards they belong to; other
+    shards are untouched. Returns the side-table failures, as refresh_side_tables().
+    """
+    failed = []
+    manifest = Manifest.load(manifest_path) or Manifest(manifest_path, **_default_layout())
+    rows: Dict[str, List[int]] = defaultdict(list)
+    for i, (e, h) in enumerate(zip(entries, hashes)):
+        rows[manifest.shard_of(e["path"], h)].append(i)
+    for name, idx in sorted(rows.items()):
+        path = manifest.shard_path(name)
+        grown = PackedIndex.load(path).appended(np.array([hashes[i] for i in idx], dtype=np.uint64),
+                                                [entries[i] for i in idx], np.array([multi[i] for i in idx]))
+        grown.save(path)
+        failed += refresh_side_tables(path)
+        manifest.shards[name] = {"path": path.name, "entries": len(grown)}
+    if clusters_path(manifest_path).exists():
+        _refresh_shard_clusters(manifest)
+    manifest.save()
+    return failed
+
+
+# ----------------------------- Clusters -----------------------------
+def _refresh_shard_clusters(manifest: Manifest, radius: Optional[int] = None,
+                            bands: Optional[int] = None) -> Tuple[ClusterTable, TableReport]:
+    """Bring manifest.clusters.npz up to date with the shards and record their stamps (saved by the caller)."""
+    table, report = ClusterTable.update(manifest.path, index=ShardedIndex(manifest).combined(),
+                                        radius=radius, bands=bands)
+    for name in manifest.shards:
+        # per-shard tables of older builds would never link across shards
+        clusters_path(manifest.shard_path(name)).unlink(missing_ok=True)
+    manifest.clusters = manifest.stamps()
+    return table, report
+
+
+def update_shard_clusters(manifest_path: Union[str, Path], radius: Optional[int] = None,
+                          bands: Optional[int] = None) -> Tuple[ClusterTable, TableReport]:
+    """
+    One cluster table over all shards (manifest.clusters.npz), so near-duplicates
+    in different shards are linked and cluster ids (global rows, as in
+    combined()) are unique. Rows inserted into any shard only extend the
+    table; removed or changed rows rebuild it.
+    """
+    manifest = Manifest.load(manifest_path)
+    if manifest is None:
+        raise FileNotFoundError(f"No shard manifest at {manifest_path}")
+    table, report = _refresh_shard_clusters(manifest, radius, bands)
+    manifest.save()
+    return table, report
+
+
+def _default_layout() -> Dict[str, Any]:
+    cfg = load_config()["retrieval"]
+    return {"by": cfg.get("shard_by", "prefix"), "bits": cfg.get("shard_bits", 4)}
+
+
+def main():
+    cfg = load_config()["retrieval"]
+    ap = argparse.ArgumentParser(description="Build or inspect the sharded similarity index.")
+    ap.add_argument("--manifest", default=cfg["hash_index_path"] if is_manifest(cfg["hash_index_path"])
+                    else "./data/index/shards/manifest.json")
+    ap.add_argument("--image-dir", default=None, help="defaults to data/damage_db/images")
+    ap.add_argument("--by", choices=SHARD_BY, default=None, help="default: the manifest's, else shard_by")
+    ap.add_argument("--bits", type=int, default=None, help="pHash prefix bits for --by prefix (2**bits shards)")
+    ap.add_argument("--shard", nargs="+", default=None, help="only (re)build these shards")
+    ap.add_argument("--workers", type=int, default=None)
+    ap.add_argument("--full", action="store_true", help="re-hash every image (of --shard, if given)")
+    ap.add_argument("--list", action="store_true", help="print the manifest and exit")
+    args = ap.parse_args()
+
+    manifest_path = resolve_path(args.manifest)
+    if not args.list:
+        image_dir = args.image_dir or ROOT / "data" / "damage_db" / "images"
+        report = build_shards(image_dir, manifest_path, args.by, args.bits, args.workers, args.full, args.shard)
+        for path, error in report.failed:
+            print(f"FAILED {path}: {error}")
+        print(report)
+    manifest = Manifest.load(manifest_path)
+    if manifest is None:
+        print(f"No manifest at {manifest_path}")
+        return
+    layout = f"prefix ({manifest.bits} bits)" if manifest.by == "prefix" else manifest.by
+    print(f"{len(manifest.shards)} shards by {layout}")
+    for name, info in sorted(manifest.shards.items()):
+        print(f"  {name:<20} {info['entries']:>9} entries  {info['path']}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,170 @@
+
+# src/retrieval/side_table.py
+#
+# Common base of the opt-in tables kept next to a packed index, one row per
+# index row: near-duplicate clusters (clusters.py), region tiles
+# (tile_index.py) and descriptors (embedding.py). The base knows which index
+# rows a table was built on and brings a saved table up to date after the
+# index changed; subclasses only build, extend / remap, save and load.
+
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple, Type, Union
+
+import numpy as np
+
+from .packed_index import PackedIndex
+
+
+def expand_spans(lo: np.ndarray, counts: np.ndarray) -> np.ndarray:
+    """Concatenate arange(lo[i], lo[i] + counts[i]) without a Python loop."""
+    return np.repeat(lo - np.cumsum(counts) + counts, counts) + np.arange(counts.sum())
+
+
+def lookup(old: np.ndarray, new: np.ndarray, usable: Optional[np.ndarray] = None) -> np.ndarray:
+    """
+    For every key in `new`, a usable row of `old` with the same key, or -1.
+    Repeated keys get distinct rows (the k-th repeat in `new` the k-th in `old`).
+    """
+    rows = np.arange(len(old)) if usable is None else np.flatnonzero(usable)
+    if not len(rows):
+        return np.full(len(new), -1, dtype=np.int64)
+    rows = rows[np.argsort(old[rows], kind="stable")]
+    order = np.argsort(new, kind="stable")
+    repeat = np.empty(len(new), dtype=np.int64)
+    repeat[order] = np.arange(len(new)) - np.searchsorted(new[order], new[order], side="left")
+    pos = np.searchsorted(old[rows], new) + repeat
+    pos_ok = np.minimum(pos, len(rows) - 1)
+    return np.where((pos < len(rows)) & (old[rows[pos_ok]] == new), rows[pos_ok], -1).astype(np.int64)
+
+
+@dataclass
+class TableReport:
+    how: str                                  # "unchanged", "extended", "updated" or "rebuilt"
+    reused: int = 0
+    computed: int = 0
+    failed: List[Tuple[str, str]] = field(default_factory=list)
+
+    def __str__(self):
+        return f"{self.how} (reused={self.reused}, computed={self.computed}, failed={len(self.failed)})"
+
+
+class SideTable:
+    """
+    A table with one row per index row. `sources` holds index_keys() of the
+    rows it was built on, so it can tell whether it still matches the index.
+    Subclasses set `path_for` (index path -> table path) and implement build,
+    save, load and either extend (append-only) or remap (any row change).
+    Rows computed by the last build / extend / remap that failed are listed
+    in `errors` as (path, error); every instance sets its own list.
+    """
+
+    sources: np.ndarray
+    errors: List[Tuple[str, str]]
+
+    def __len__(self):
+        return len(self.sources)
+
+    @staticmethod
+    def path_for(index_path: Union[str, Path]) -> Path:
+        raise NotImplementedError
+
+    @staticmethod
+    def index_keys(index: PackedIndex) -> np.ndarray:
+        """Key of every index row; the whole-image pHash unless a table keys rows by content."""
+        return np.asarray(index.hashes, dtype=np.uint64)
+
+    def failed_rows(self) -> np.ndarray:
+        """Rows whose images could not be read; they are retried on the next update."""
+        return np.zeros(len(self), dtype=bool)
+
+    def covers(self, index: PackedIndex) -> bool:
+        """True if this table was built on exactly the leading rows of `index`."""
+        return len(self) <= len(index) and np.array_equal(self.sources, self.index_keys(index)[:len(self)])
+
+    def attaches_to(self, index: PackedIndex) -> bool:
+        """True if this table was built on exactly the rows of `index`."""
+        return len(self) == len(index) and self.covers(index)
+
+    # --------------------------- Parameters ---------------------------
+    @classmethod
+    def settle(cls, old: Optional["SideTable"], **params: Any) -> Dict[str, Any]:
+        """Fill the parameters left as None from the saved table (or the defaults)."""
+        return params
+
+    def accepts(self, **params: Any) -> bool:
+        """True if this table was built with the settled `params`."""
+        return True
+
+    # ---------------------------- Subclass ----------------------------
+    @classmethod
+    def build(cls, index: PackedIndex, workers: Optional[int] = None, **params: Any) -> "SideTable":
+        raise NotImplementedError
+
+    def remap(self, index: PackedIndex, reuse: np.ndarray, workers: Optional[int] = None) -> "SideTable":
+        """
+        Table for `index` in which row i copies this table's row reuse[i], or
+        is computed afresh where reuse[i] is -1.
+        """
+        raise NotImplementedError
+
+    def remaps(self, reuse: np.ndarray) -> bool:
+        """True if remap(index, reuse) beats a rebuild; False when there is no remap()."""
+        return type(self).remap is not SideTable.remap
+
+    def extend(self, index: PackedIndex, workers: Optional[int] = None) -> "SideTable":
+        """Table for `index`, whose first len(self) rows are this table's."""
+        reuse = np.concatenate([np.arange(len(self)), np.full(len(index) - len(self), -1)])
+        return self.remap(index, reuse, workers)
+
+    def save(self, path: Union[str, Path]) -> None:
+        raise NotImplementedError
+
+    @classmethod
+    def load(cls, path: Union[str, Path]) -> Optional["SideTable"]:
+        raise NotImplementedError
+
+    # ----------------------------- Update -----------------------------
+    @classmethod
+    def update(cls, index_path: Union[str, Path], workers: Optional[int] = None,
+               index: Optional[PackedIndex] = None, **params: Any) -> Tuple["SideTable", TableReport]:
+        """
+        Bring the table of an index up to date. Appended rows only extend it.
+        A table with remap() reuses every row whose key is still in the index
+        and computes the rest ("updated"); one without, or whose remaps()
+        declines, is rebuilt when rows changed. Different parameters always rebuild. `index` is the index at
+        index_path when the caller already has it (or one that has no file of its own).
+        """
+        index = index if index is not None else PackedIndex.load(index_path)
+        old = cls.load(cls.path_for(index_path))
+        params = cls.settle(old, **params)
+        reused = 0
+        if old is None or not old.accepts(**params):
+            table, how = cls.build(index, workers=workers, **params), "rebuilt"
+        elif old.covers(index) and not old.failed_rows().any():
+            if len(old) == len(index):
+                return old, TableReport("unchanged", reused=len(old))
+            table, how, reused = old.extend(index, workers), "extended", len(old)
+        else:
+            reuse = lookup(old.sources, cls.index_keys(index), ~old.failed_rows())
+            if old.remaps(reuse):
+                table, how, reused = old.remap(index, reuse, workers), "updated", int((reuse >= 0).sum())
+            else:
+                table, how = cls.build(index, workers=workers, **params), "rebuilt"
+        table.save(cls.path_for(index_path))
+        return table, TableReport(how, reused, len(table) - reused, list(table.errors))
+
+    @classmethod
+    def refresh(cls, index_path: Union[str, Path]) -> Optional[TableReport]:
+        """After the index changed: update its table if it has one (side tables are opt-in)."""
+        if not cls.path_for(index_path).exists():
+            return None
+        return cls.update(index_path)[1]
+
+
+def side_tables() -> List[Tuple[str, Type[SideTable]]]:
+    """(PackedIndex attribute, table class) of every side table."""
+    from .clusters import ClusterTable
+    from .embedding import EmbeddingIndex
+    from .tile_index import TileIndex
+    return [("clusters", ClusterTable), ("tiles", TileIndex), ("embeddings", EmbeddingIndex)]
@@ -1,23 +1,107 @@
 
-from PIL import Image
+import threading
+from typing import Any, Callable, Dict, Optional
+
 import imagehash
-import json
 
-def phash_image(path: str) -> int:
-    img = Image.open(path).convert('RGB')
+from src.analysis.context import as_context
+from .embedding import embed_image
+from .multi_hash import multi_hash
+from .packed_index import PackedIndex, open_index
+from .shards import is_manifest, open_sharded
+from .tile_index import QUERY_OVERLAP, query_scales, reused_regions, tile_hashes
+
+def phash_image(image) -> int:
+    """pHash of a path, PIL image or already decoded ImageContext."""
+    img = as_context(image).image
     return int(str(imagehash.phash(img)), 16)
 
 def hamming(a: int, b: int) -> int:
     return bin(a ^ b).count('1')
 
-def nearest(query_path: str, index_path: str, top_k: int = 4):
-    q = phash_image(query_path)
-    with open(index_path, 'r', encoding='utf-8') as f:
-        index = json.load(f)
-    entries = index.get('entries', [])
-    scored = []
-    for e in entries:
-        dist = hamming(q, int(e['phash']))
-        scored.append({"path": e['path'], "label": e['label'], "distance": dist})
-    scored.sort(key=lambda x: x['distance'])
-    return scored[:top_k]
+class _Query:
+    """The query decoded once; each hash or descriptor is computed on first use and shared by all shards."""
+
+    def __init__(self, image):
+        self.image = as_context(image)
+        self._values: Dict[Any, Any] = {}
+        self._lock = threading.Lock()
+
+    def get(self, key, fn: Callable[[Any], Any]):
+        with self._lock:
+            if key not in self._values:
+                self._values[key] = fn(self.image)
+            return self._values[key]
+
+    @property
+    def phash(self) -> int:
+        return self.get("phash", phash_image)
+
+    @property
+    def multi(self):
+        return self.get("multi", multi_hash)
+
+    @property
+    def embedding(self):
+        return self.get("embed", embed_image)
+
+    def tiles(self, scales):
+        return self.get(("tiles", tuple(scales)), lambda img: tile_hashes(img, query_scales(scales), QUERY_OVERLAP))
+
+
+def nearest(query, index_path: str, top_k: int = 4, max_distance: Optional[int] = None,
+            backend: str = "linear", bands: int = 4, weights: Optional[Dict[str, float]] = None,
+            tile_radius: int = 8, min_votes: int = 2, nprobe: int = 8, embed_max_distance: Optional[float] = None):
+    """
+    Top-k entries by pHash Hamming distance, optionally limited to max_distance.
+    The packed index is loaded once per process (memory-mapped). backend='linear'
+    scores every entry with a vectorized popcount; backend='mih' uses
+    multi-index hashing and only verifies candidates that share a band.
+    backend='fused' ranks by the weighted multi-hash distance (see multi_hash.py),
+    falling back to the linear pHash scan for an index built without it.
+    backend='tiles' finds images that share regions with the query (crops,
+    pastes) by voting over tile hashes (see tile_index.py); results are ranked
+    by votes and also carry the matching boxes. backend='embed' ranks by the
+    cosine distance of colour/gradient descriptors in an IVF index scanning
+    `nprobe` lists (see embedding.py), which survives re-photographing; its
+    cutoff is embed_max_distance (0..2) rather than the Hamming max_distance.
+    Both fall back to the linear pHash scan when their table wasn't built.
+    An index_path naming a shard manifest (see shards.py) runs the search on
+    the shards in parallel and merges the per-shard top-k; for the pHash
+    backends on prefix shards, shards too far from the query are skipped.
+    """
+    q = _Query(query)
+
+    def search(index: PackedIndex):
+        return _search(index, q, top_k, max_distance, backend, bands, weights, tile_radius, min_votes, nprobe,
+                       embed_max_distance)
+
+    if is_manifest(index_path):
+        sharded = open_sharded(index_path)
+        key = (lambda r: (-r.get("votes", 0), r["distance"])) if backend == "tiles" else (lambda r: r["distance"])
+        names, bound = None, None
+        if backend in ("linear", "mih") and sharded.manifest.by == "prefix":
+            # only shards whose prefix is close enough to the query's can hold a match
+            bound = lambda name: sharded.manifest.lower_bound(name, q.phash)
+            if max_distance is not None:
+                names = [n for n in sharded.names if bound(n) <= max_distance]
+        return sharded.search(search, top_k, key, names, bound)
+    return search(open_index(index_path))
+
+
+def _search(index: PackedIndex, q: _Query, top_k, max_distance, backend, bands, weights, tile_radius,
+            min_votes, nprobe, embed_max_distance):
+    if backend == "embed":
+        if index.embeddings is not None:
+            return index.describe(*index.embeddings.search(q.embedding, top_k, nprobe, embed_max_distance))
+        return index.nearest(q.phash, top_k, max_distance=max_distance)
+    if backend == "tiles":
+        if index.tiles is not None:
+            return reused_regions(index, q.image, top_k, tile_radius, min_votes, bands,
+                                  tiles=q.tiles(index.tiles.scales))
+        return index.nearest(q.phash, top_k, max_distance=max_distance)
+    if backend == "fused":
+        if index.multi is not None:
+            return index.describe(*index.fused_topk(q.multi, top_k, max_distance, weights))
+        return index.nearest(int(q.multi[0]), top_k, max_distance=max_distance)
+    return index.nearest(q.phash, top_k, max_distance=max_distance, backend=backend, bands=bands)
@@ -0,0 +1,287 @@
+
+# src/retrieval/tile_index.py
+#
+# Region-level reuse detection: a photo cropped out of, or pasted into, a new
+# image shares no whole-image pHash with its source, but its regions still
+# match. Every DB image is cut into overlapping square tiles at a few scales,
+# each tile is pHashed, and all tile hashes go into one packed table next to
+# the index (hash_index.tiles.npz). A query's tiles are looked up with
+# multi-index hashing and the hits are voted per source image.
+#   python -m src.retrieval.tile_index --scales 1 0.71 0.5 0.35 0.25
+#   python -m src.retrieval.tile_index --query claim.jpg
+# With a shard manifest as --index, every shard gets its own table.
+
+import argparse
+import os
+from functools import partial
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Sequence, Tuple, Union
+
+import numpy as np
+import scipy.fftpack
+from numpy.lib.stride_tricks import sliding_window_view
+from PIL import Image
+
+from src.analysis.context import as_context
+from src.utils.config import load_config, resolve_path
+from src.utils.pool import map_reported
+from .packed_index import PackedIndex, tiles_path
+from .side_table import SideTable, TableReport, expand_spans
+
+DEFAULT_SCALES = (1.0, 0.71, 0.5, 0.35, 0.25)
+# DB tiles overlap by 3/4 so a query tile is never more than 1/8 tile off the grid
+DEFAULT_OVERLAP = 0.75
+QUERY_OVERLAP = 0.5
+# Near-flat tiles (sky, walls, blur) hash alike across unrelated photos; skip them
+MIN_STD = 8.0
+
+_SIDE = 32  # pHash works on a 32x32 window, like imagehash.phash
+
+
+def _starts(length: int, step: int) -> np.ndarray:
+    """Window offsets every `step` pixels, plus one flush with the far edge."""
+    starts = np.arange(0, length - _SIDE + 1, step)
+    if starts[-1] != length - _SIDE:
+        starts = np.append(starts, length - _SIDE)
+    return starts
+
+
+def tile_hashes(image, scales: Sequence[float] = DEFAULT_SCALES, overlap: float = DEFAULT_OVERLAP,
+                min_std: float = MIN_STD) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    pHashes of overlapping square tiles of a path, PIL image or ImageContext.
+    A tile at scale s has side s * min(width, height). Each scale resamples
+    the image once so that a tile is exactly 32x32 pixels; every window is then
+    DCT-hashed in one batch. Returns (uint64 hashes, int32 boxes of x, y, side
+    in source pixels). A square image's scale-1 tile equals phash_image().
+    """
+    gray = as_context(image).image.convert("L")
+    w, h = gray.size
+    hashes, boxes = [np.zeros(0, dtype=np.uint64)], [np.zeros((0, 3), dtype=np.int32)]
+    step = max(1, round(_SIDE * (1 - overlap)))
+    for scale in scales:
+        side = scale * min(w, h)
+        if side < _SIDE:
+            continue
+        factor = _SIDE / side
+        size = (max(_SIDE, round(w * factor)), max(_SIDE, round(h * factor)))
+        pixels = np.asarray(gray.resize(size, Image.LANCZOS), dtype=np.float64)
+        ys, xs = _starts(size[1], step), _starts(size[0], step)
+        windows = sliding_window_view(pixels, (_SIDE, _SIDE))[ys][:, xs].reshape(-1, _SIDE, _SIDE)
+        keep = windows.std(axis=(1, 2)) >= min_std
+        if not keep.any():
+            continue
+        low = scipy.fftpack.dct(scipy.fftpack.dct(windows[keep], axis=1), axis=2)[:, :8, :8].reshape(-1, 64)
+        bits = low > np.median(low, axis=1, keepdims=True)
+        hashes.append(np.packbits(bits, axis=1).view(">u8").ravel().astype(np.uint64))
+        gy, gx = np.meshgrid(ys, xs, indexing="ij")
+        # back to source pixels; clipped because the resampled size was rounded
+        x = np.minimum(np.round(gx.ravel()[keep] / factor), w - round(side))
+        y = np.minimum(np.round(gy.ravel()[keep] / factor), h - round(side))
+        boxes.append(np.stack([x, y, np.full(len(x), round(side))], axis=1).astype(np.int32))
+    return np.concatenate(hashes), np.concatenate(boxes)
+
+
+def query_scales(scales: Sequence[float]) -> List[float]:
+    """
+    The index scales plus the geometric midpoint of each neighbouring pair, so a
+    query rescaled between two index scales still has tiles of a matching size.
+    """
+    ordered = sorted(set(scales), reverse=True)
+    mids = [float(np.sqrt(a * b)) for a, b in zip(ordered, ordered[1:])]
+    return sorted(ordered + mids, reverse=True)
+
+
+class TileIndex(SideTable):
+    """
+    Tile pHashes of every index row, sorted by row: hashes[i] is a tile of
+    image rows[i] at boxes[i] (x, y, side). Rows are keyed by content
+    (PackedIndex.row_keys), so an update re-tiles only new or changed images.
+    """
+
+    path_for = staticmethod(tiles_path)
+
+    def __init__(self, hashes: np.ndarray, rows: np.ndarray, boxes: np.ndarray, sources: np.ndarray,
+                 scales: Sequence[float] = DEFAULT_SCALES, overlap: float = DEFAULT_OVERLAP,
+                 failed: Optional[np.ndarray] = None):
+        self.hashes = np.asarray(hashes, dtype=np.uint64)
+        self.errors: List[Tuple[str, str]] = []
+        self.rows = np.asarray(rows, dtype=np.int32)
+        self.boxes = np.asarray(boxes, dtype=np.int32).reshape(-1, 3)
+        self.sources = np.asarray(sources, dtype=np.uint64)
+        self.scales = tuple(float(s) for s in scales)
+        self.overlap = float(overlap)
+        self.failed = np.zeros(len(self.sources), dtype=bool) if failed is None else np.asarray(failed, dtype=bool)
+        self._mih: Dict[int, Any] = {}
+
+    @staticmethod
+    def index_keys(index: PackedIndex) -> np.ndarray:
+        return index.row_keys()
+
+    def failed_rows(self) -> np.ndarray:
+        return self.failed
+
+    @classmethod
+    def settle(cls, old: Optional["TileIndex"], scales: Optional[Sequence[float]] = None) -> Dict[str, Any]:
+        """scales=None keeps the table's scales (DEFAULT_SCALES on a first build)."""
+        return {"scales": tuple(float(s) for s in scales) if scales else (old.scales if old else DEFAULT_SCALES)}
+
+    def accepts(self, scales: Tuple[float, ...]) -> bool:
+        return self.scales == scales
+
+    @classmethod
+    def build(cls, index: PackedIndex, scales: Sequence[float] = DEFAULT_SCALES,
+              overlap: float = DEFAULT_OVERLAP, workers: Optional[int] = None) -> "TileIndex":
+        empty = cls(np.zeros(0), np.zeros(0), np.zeros((0, 3)), np.zeros(0), scales, overlap)
+        return empty.remap(index, np.full(len(index), -1), workers)
+
+    def remap(self, index: PackedIndex, reuse: np.ndarray, workers: Optional[int] = None) -> "TileIndex":
+        """Reused rows keep their tiles; the others are tiled on a process pool."""
+        todo = np.flatnonzero(reuse < 0)
+        run = partial(tile_hashes, scales=self.scales, overlap=self.overlap)
+        found, failed, errors = [], np.zeros(len(index), dtype=bool), []
+        for i, (path, tiled, error) in zip(todo, map_reported(run, [index.entries[i]["path"] for i in todo], workers)):
+            if error is not None:
+                failed[i] = True
+                errors.append((path, error))
+                tiled = np.zeros(0, dtype=np.uint64), np.zeros((0, 3), dtype=np.int32)
+            found.append(tiled)
+
+        # every row is one span of a pool holding this table's tiles and then the new ones
+        own_starts = np.searchsorted(self.rows, np.arange(len(self)))
+        own_counts = np.diff(np.append(own_starts, len(self.hashes)))
+        new_counts = np.array([len(h) for h, _ in found], dtype=np.int64)
+        starts, counts = np.zeros(len(index), dtype=np.int64), np.zeros(len(index), dtype=np.int64)
+        kept = np.flatnonzero(reuse >= 0)
+        starts[kept], counts[kept] = own_starts[reuse[kept]], own_counts[reuse[kept]]
+        starts[todo] = len(self.hashes) + np.cumsum(new_counts) - new_counts
+        counts[todo] = new_counts
+        take = expand_spans(starts, counts)
+        table = TileIndex(
+            np.concatenate([self.hashes] + [h for h, _ in found])[take],
+            np.repeat(np.arange(len(index)), counts),
+            np.concatenate([self.boxes] + [b for _, b in found])[take],
+            index.row_keys(), self.scales, self.overlap, failed)
+        table.errors = errors
+        return table
+
+    def mih(self, bands: int = 4):
+        """Multi-index hash tables over the tile hashes, built on first use."""
+        if bands not in self._mih:
+            from .mih import MultiIndexHash
+            self._mih[bands] = MultiIndexHash(self.hashes, bands)
+        return self._mih[bands]
+
+    # ----------------------------- Query -----------------------------
+    def votes(self, query_hashes: np.ndarray, radius: int = 8, min_votes: int = 2,
+              bands: int = 4) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+        """
+        Source rows hit by at least min_votes distinct query tiles (each within
+        `radius` bits of one of the row's tiles), ordered by (-votes, best
+        distance, row). Returns rows, votes, best distance, and for each row the
+        (query tile, DB tile) pair behind its best distance.
+        """
+        qt, tiles, dist = self.mih(bands).radius_many(query_hashes, radius)
+        if not len(qt):
+            nothing = np.zeros(0, dtype=np.int64)
+            return nothing, nothing, np.zeros(0, dtype=np.uint8), np.zeros((0, 2), dtype=np.int64)
+        src = self.rows[tiles].astype(np.int64)
+
+        # best hit per (source, query tile): one vote each, however many DB tiles it matched
+        order = np.lexsort((tiles, dist, qt, src))
+        first = np.concatenate(([True], (src[order][1:] != src[order][:-1]) | (qt[order][1:] != qt[order][:-1])))
+        order = order[first]
+        src, qt, tiles, dist = src[order], qt[order], tiles[order], dist[order]
+        rows, start, votes = np.unique(src, return_index=True, return_counts=True)
+        best = np.minimum.reduceat(dist, start)
+        # the pair behind each row's best distance (first at that distance, lowest query tile)
+        at_best = np.flatnonzero(dist == np.repeat(best, votes))
+        pick = at_best[np.searchsorted(src[at_best], rows)]
+        keep = votes >= min_votes
+        rows, votes, best, pick = rows[keep], votes[keep], best[keep], pick[keep]
+        ranked = np.lexsort((rows, best, -votes))
+        pairs = np.stack([qt[pick], tiles[pick]], axis=1)[ranked]
+        return rows[ranked], votes[ranked], best[ranked], pairs
+
+    # ----------------------------- I/O -----------------------------
+    def save(self, path: Union[str, Path]) -> None:
+        path = Path(path)
+        tmp = path.with_name(path.stem + ".tmp.npz")
+        np.savez(tmp, hashes=self.hashes, rows=self.rows, boxes=self.boxes, sources=self.sources,
+                 scales=np.array(self.scales), overlap=self.overlap, failed=self.failed)
+        os.replace(tmp, path)
+
+    @classmethod
+    def load(cls, path: Union[str, Path]) -> Optional["TileIndex"]:
+        path = Path(path)
+        if not path.exists():
+            return None
+        with np.load(path) as npz:
+            return cls(npz["hashes"], npz["rows"], npz["boxes"], npz["sources"],
+                       npz["scales"].tolist(), float(npz["overlap"]), npz["failed"] if "failed" in npz else None)
+
+
+def reused_regions(index: PackedIndex, query, top_k: int = 4, radius: int = 8, min_votes: int = 2,
+                   bands: int = 4, tiles: Optional[Tuple[np.ndarray, np.ndarray]] = None) -> List[Dict[str, Any]]:
+    """
+    Indexed images that share regions with `query` (path, PIL image or
+    ImageContext), most votes first. Each result is a nearest()-style dict
+    whose "distance" is the best tile distance, plus "votes" (query tiles that
+    matched), "box" (the matching DB tile) and "query_box", both [x, y, side].
+    `tiles` are the query's (hashes, boxes) at query_scales() of the table's
+    scales when already computed (e.g. once for all shards).
+    """
+    table = index.tiles
+    if table is None or len(index) == 0:
+        return []
+    hashes, boxes = tiles if tiles is not None else tile_hashes(query, query_scales(table.scales), QUERY_OVERLAP)
+    rows, votes, dist, pairs = table.votes(hashes, radius, min_votes, bands)
+    out = index.describe(rows[:top_k], dist[:top_k])
+    for r, v, (q, t) in zip(out, votes.tolist(), pairs[:top_k].tolist()):
+        r["votes"] = v
+        r["box"] = table.boxes[t].tolist()
+        r["query_box"] = boxes[q].tolist()
+    return out
+
+
+def update_tiles(index_path: Union[str, Path], scales: Optional[Sequence[float]] = None,
+                 workers: Optional[int] = None) -> Tuple[TileIndex, TableReport]:
+    """TileIndex.update(); scales=None keeps the table's scales (DEFAULT_SCALES on a first build)."""
+    return TileIndex.update(index_path, workers, scales=scales)
+
+
+def main():
+    cfg = load_config()["retrieval"]
+    ap = argparse.ArgumentParser(description="Build the tile-hash table or look up reused regions of an image.")
+    ap.add_argument("--index", default=cfg["hash_index_path"])
+    ap.add_argument("--scales", type=float, nargs="+", default=cfg.get("tile_scales"),
+                    help="tile side as a fraction of the shorter image side")
+    ap.add_argument("--workers", type=int, default=None)
+    ap.add_argument("--query", default=None, help="image to search for reused regions")
+    ap.add_argument("--top-k", type=int, default=cfg["top_k"])
+    args = ap.parse_args()
+
+    from .shards import index_paths, is_manifest
+    index_path = resolve_path(args.index)
+    if args.query:
+        from .packed_index import open_index
+        from .simple_hash import nearest
+        radius, votes, bands = cfg.get("tile_radius", 8), cfg.get("tile_min_votes", 2), cfg.get("mih_bands", 4)
+        hits = nearest(args.query, str(index_path), args.top_k, backend="tiles", bands=bands, tile_radius=radius,
+                       min_votes=votes) if is_manifest(index_path) else \
+            reused_regions(open_index(index_path), args.query, args.top_k, radius, votes, bands)
+        for h in hits:
+            print(f"  {h['votes']:4d} votes  d={h['distance']:2d}  {h['path']}  box={h['box']}  query_box={h['query_box']}")
+        if not hits:
+            print("No reused regions found.")
+        return
+    for path in index_paths(index_path):
+        table, report = update_tiles(path, args.scales, args.workers)
+        for failed, error in report.failed:
+            print(f"FAILED {failed}: {error}")
+        print(f"Tile table {report}: {len(table.hashes)} tiles over {len(table)} images "
+              f"(scales={list(table.scales)}) -> {tiles_path(path)}")
+
+
+if __name__ == "__main__":
+    main()
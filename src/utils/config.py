@@ -0,0 +1,34 @@
+
+# src/utils/config.py
+
+from pathlib import Path
+from typing import Any, Dict, Optional, Union
+
+import yaml
+
+# Project root, so config and data paths work whether you run from the repo root or elsewhere
+ROOT = Path(__file__).resolve().parents[2]
+CONFIG_PATH = ROOT / "config" / "config.yaml"
+
+
+def resolve_path(path: Union[str, Path]) -> Path:
+    """
+    Resolve a path from config.yaml. Relative paths are taken relative to the
+    project root instead of the current working directory.
+    """
+    p = Path(path)
+    return p if p.is_absolute() else (ROOT / p).resolve()
+
+
+def load_config(path: Optional[Union[str, Path]] = None) -> Dict[str, Any]:
+    with open(path or CONFIG_PATH, "r", encoding="utf-8") as f:
+        return yaml.safe_load(f)
+
+
+def file_stamp(path: Union[str, Path]):
+    """Cheap change marker for a file: (mtime_ns, size), or None if missing."""
+    try:
+        st = Path(path).stat()
+    except FileNotFoundError:
+        return None
+    return (st.st_mtime_ns, st.st_size)
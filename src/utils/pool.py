@@ -0,0 +1,43 @@
+
+# src/utils/pool.py
+#
+# Process pools for CPU-bound fan-out. Workers are always started with the
+# spawn method: forking from a threaded host (Streamlit, the HTTP service, the
+# async chain) can hand the child a lock some other thread was holding.
+
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from typing import Any, Callable, Iterator, Optional, Sequence, Tuple
+
+
+def process_pool(workers: Optional[int] = None) -> ProcessPoolExecutor:
+    """Spawn-context process pool; workers=None starts one per CPU."""
+    return ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"))
+
+
+def _attempt(fn: Callable[[Any], Any], item: Any) -> Tuple[Any, Optional[str]]:
+    try:
+        return fn(item), None
+    except Exception as e:
+        return None, f"{type(e).__name__}: {e}"
+
+
+def map_reported(fn: Callable[[Any], Any], items: Sequence[Any],
+                 workers: Optional[int] = None) -> Iterator[Tuple[Any, Any, Optional[str]]]:
+    """
+    Yield (item, fn(item), None), or (item, None, "Error: message") when fn
+    raised, for every item in order. Runs on a process pool in chunks
+    (workers=None: one per CPU; workers <= 1 or a single item: in this
+    process), so fn must be picklable.
+    """
+    workers = (os.cpu_count() or 1) if workers is None else workers
+    run = partial(_attempt, fn)
+    if workers <= 1 or len(items) <= 1:
+        for item in items:
+            yield (item,) + run(item)
+        return
+    with process_pool(workers) as pool:
+        for item, outcome in zip(items, pool.map(run, items, chunksize=max(1, len(items) // (4 * workers)))):
+            yield (item,) + outcome
@@ -0,0 +1,130 @@
+
+# src/utils/profiling.py
+#
+# Per-stage instrumentation for the analysis chain. A stage (one tool branch,
+# aggregation, ...) runs under profile_stage(); code deeper down marks where its
+# time goes with `with phase("decode"):` and the remainder counts as compute.
+# Results are flattened into the chain's result["timings"] and can be exported
+# in the Prometheus text format.
+
+import threading
+import time
+import tracemalloc
+from bisect import bisect_left
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any, Callable, Dict, Iterator, Optional, Tuple
+
+# Phases code can attribute time to; whatever is left of a stage is "compute"
+PHASES = ("decode", "load", "cache", "serialize")
+
+_stage: ContextVar[Optional[Dict[str, float]]] = ContextVar("profiling_stage", default=None)
+
+
+@contextmanager
+def phase(name: str) -> Iterator[None]:
+    """Attribute the enclosed time to `name` in the current stage (no-op outside a stage)."""
+    rec = _stage.get()
+    if rec is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        rec[name] = rec.get(name, 0.0) + time.perf_counter() - start
+
+
+def profile_stage(fn: Callable[..., Any], *args, trace_memory: bool = False) -> Tuple[Any, Dict[str, float]]:
+    """
+    Run fn(*args) as one stage and return (result, profile). The profile holds
+    seconds per phase, "compute" for the rest, "total", and with trace_memory
+    "peak_mb": the tracemalloc peak above the stage's starting allocation.
+    That peak is process-wide, so it is only per-stage when stages don't overlap.
+    """
+    rec: Dict[str, float] = {}
+    token = _stage.set(rec)
+    if trace_memory:
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+        tracemalloc.reset_peak()
+        base = tracemalloc.get_traced_memory()[0]
+    start = time.perf_counter()
+    try:
+        result = fn(*args)
+    finally:
+        total = time.perf_counter() - start
+        _stage.reset(token)
+    rec["compute"] = max(0.0, total - sum(rec.values()))
+    rec["total"] = total
+    if trace_memory:
+        rec["peak_mb"] = (tracemalloc.get_traced_memory()[1] - base) / 2**20
+    return result, rec
+
+
+def flatten(stage: str, profile: Dict[str, float]) -> Dict[str, float]:
+    """{'total': t, 'compute': c} for stage 'ela' -> {'ela': t, 'ela.compute': c}."""
+    out = {stage: profile["total"]}
+    out.update({f"{stage}.{k}": v for k, v in profile.items() if k != "total"})
+    return out
+
+
+# ----------------------------- Prometheus export -----------------------------
+class StageMetrics:
+    """
+    Process-wide Prometheus-style metrics fed from chain result timings:
+    a request counter, a seconds histogram per stage/phase and the largest
+    peak allocation seen per stage.
+    """
+    BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+    def __init__(self, prefix: str = "claims_fraud"):
+        self.prefix = prefix
+        self._lock = threading.Lock()
+        self.requests = 0
+        self._hist: Dict[Tuple[str, str], list] = {}   # (stage, phase) -> [bucket counts..., count, sum]
+        self._peak: Dict[str, float] = {}
+
+    def observe(self, timings: Dict[str, float]) -> None:
+        with self._lock:
+            self.requests += 1
+            for key, value in timings.items():
+                stage, _, ph = key.partition(".")
+                if ph == "peak_mb":
+                    self._peak[stage] = max(self._peak.get(stage, 0.0), value)
+                    continue
+                h = self._hist.setdefault((stage, ph or "total"), [0] * (len(self.BUCKETS) + 2))
+                i = bisect_left(self.BUCKETS, value)
+                if i < len(self.BUCKETS):
+                    h[i] += 1
+                h[-2] += 1
+                h[-1] += value
+
+    def render(self) -> str:
+        """The text exposition format, e.g. for a /metrics endpoint."""
+        p = self.prefix
+        with self._lock:
+            lines = [f"# TYPE {p}_requests_total counter", f"{p}_requests_total {self.requests}",
+                     f"# TYPE {p}_stage_seconds histogram"]
+            for (stage, ph), h in sorted(self._hist.items()):
+                labels = f'stage="{stage}",phase="{ph}"'
+                cumulative = 0
+                for bound, n in zip(self.BUCKETS, h):
+                    cumulative += n
+                    lines.append(f'{p}_stage_seconds_bucket{{{labels},le="{bound}"}} {cumulative}')
+                lines.append(f'{p}_stage_seconds_bucket{{{labels},le="+Inf"}} {h[-2]}')
+                lines.append(f"{p}_stage_seconds_count{{{labels}}} {h[-2]}")
+                lines.append(f"{p}_stage_seconds_sum{{{labels}}} {h[-1]:.6f}")
+            if self._peak:
+                lines.append(f"# TYPE {p}_stage_peak_megabytes gauge")
+                lines += [f'{p}_stage_peak_megabytes{{stage="{s}"}} {v:.3f}' for s, v in sorted(self._peak.items())]
+        return "\n".join(lines) + "\n"
+
+    def reset(self) -> None:
+        with self._lock:
+            self.requests = 0
+            self._hist.clear()
+            self._peak.clear()
+
+
+METRICS = StageMetrics()
@@ -7,7 +7,10 @@ from pathlib import Path
 import textwrap
 
 
-def generate_pdf_report(pdf_path: str, original_image: str, results: dict):
+def generate_pdf_report(pdf_path: str, original_image: str, results):
+    # a ClaimResult from the chain, or its to_dict() form
+    if hasattr(results, "to_dict"):
+        results = results.to_dict()
     c = canvas.Canvas(pdf_path, pagesize=A4)
     width, height = A4
 
@@ -0,0 +1,36 @@
+import shutil
+from pathlib import Path
+
+import pytest
+
+from src.retrieval.build_index import build_index
+
+SAMPLES = sorted(Path("data/input").glob("*.jpg"))[:8]
+
+
+@pytest.fixture
+def samples():
+    """The sample JPEGs the retrieval tests index."""
+    return list(SAMPLES)
+
+
+@pytest.fixture
+def sample_db(tmp_path):
+    """sample_db(paths, root=tmp_path): copy paths into root/images and return that folder."""
+    def make(paths, root=None):
+        db = (root or tmp_path) / "images"
+        db.mkdir(parents=True, exist_ok=True)
+        for p in paths:
+            shutil.copy(p, db / p.name)
+        return db
+    return make
+
+
+@pytest.fixture
+def sample_index(tmp_path, sample_db):
+    """sample_index(paths): a DB of paths and its packed index tmp_path/hash_index.npy, as (db, index_path)."""
+    def make(paths):
+        db, index_path = sample_db(paths), tmp_path / "hash_index.npy"
+        build_index(str(db), str(index_path), workers=1)
+        return db, index_path
+    return make
@@ -0,0 +1,68 @@
+import json
+from pathlib import Path
+
+import pytest
+
+from src.pipeline import batch
+from src.pipeline.batch import completed_paths, iter_inputs, run_batch
+
+SAMPLES = [str(p) for p in sorted(Path("data/input").glob("*.jpg"))[:3]]
+
+
+def test_iter_inputs_accepts_folder_glob_and_manifests(tmp_path):
+    for name in ("a.jpg", "b.PNG", "notes.txt"):
+        (tmp_path / name).write_bytes(b"")
+    (tmp_path / "sub").mkdir()
+    (tmp_path / "sub" / "c.jpeg").write_bytes(b"")
+
+    assert [p.rsplit("/", 1)[-1] for p in iter_inputs(str(tmp_path))] == ["a.jpg", "b.PNG", "c.jpeg"]
+    assert [p.rsplit("/", 1)[-1] for p in iter_inputs(str(tmp_path / "*.jpg"))] == ["a.jpg"]
+
+    manifest = tmp_path / "m.csv"
+    manifest.write_text("image_path,label\nx.jpg,clean\ny.jpg,manipulated\n")
+    assert list(iter_inputs(str(manifest))) == ["x.jpg", "y.jpg"]
+
+
+def test_completed_paths_skips_errors_and_torn_lines(tmp_path):
+    out = tmp_path / "scores.jsonl"
+    out.write_text(json.dumps({"image_path": "ok.jpg", "error": None}) + "\n"
+                   + json.dumps({"image_path": "bad.jpg", "error": "OSError: boom"}) + "\n"
+                   + '{"image_path": "torn')
+    assert completed_paths(out) == {"ok.jpg"}
+
+
+@pytest.mark.parametrize("suffix", [".jsonl", ".parquet"])
+def test_run_batch_resumes_after_a_killed_run(tmp_path, monkeypatch, suffix):
+    if suffix == ".parquet":
+        pytest.importorskip("pyarrow", exc_type=ImportError)
+    out = tmp_path / f"scores{suffix}"
+
+    def killed_sink(path):
+        # a run killed outright: every row group is flushed, close() never runs
+        sink = batch.ParquetSink(path, row_group=1) if suffix == ".parquet" else batch.JsonlSink(path)
+        sink.close = lambda: None
+        return sink
+
+    def interrupted():
+        yield from SAMPLES[:2]
+        raise RuntimeError("killed")
+
+    monkeypatch.setattr(batch, "open_sink", killed_sink)
+    with pytest.raises(RuntimeError):
+        run_batch(interrupted(), str(out), workers=1, max_in_flight=1, progress=False)
+    assert completed_paths(out) == set(SAMPLES[:2])
+
+    monkeypatch.undo()
+    assert run_batch(SAMPLES, str(out), workers=1, progress=False) == {"scored": 1, "failed": 0, "skipped": 2}
+    assert completed_paths(out) == set(SAMPLES)
+    assert not out.with_name(out.name + ".parts").exists()
+
+
+def test_resume_drops_a_torn_last_line_before_appending(tmp_path):
+    out = tmp_path / "scores.jsonl"
+    assert run_batch(SAMPLES[:2], str(out), workers=1, progress=False)["scored"] == 2
+    with open(out, "a", encoding="utf-8") as f:
+        f.write('{"image_path": "' + SAMPLES[2])   # killed mid-line
+    assert run_batch(SAMPLES, str(out), workers=1, progress=False) == {"scored": 1, "failed": 0, "skipped": 2}
+    rows = [json.loads(line) for line in out.read_text().splitlines()]
+    assert [r["image_path"] for r in rows] == SAMPLES and completed_paths(out) == set(SAMPLES)
@@ -0,0 +1,26 @@
+from io import BytesIO
+
+from PIL import Image
+
+from benchmarks.run_benchmarks import compare, synthetic_image
+
+
+def test_synthetic_image_is_a_jpeg_of_the_requested_size():
+    img = Image.open(BytesIO(synthetic_image(96, 64)))
+    assert img.format == "JPEG" and img.size == (96, 64)
+
+
+def test_compare_flags_regressions_in_each_metrics_direction():
+    baseline = {"analyzer/ela/vga": {"value": 10.0, "unit": "ms"},
+                "analyzer/exif/vga": {"value": 0.01, "unit": "ms"},
+                "chain/scores/claims_per_s": {"value": 5.0, "unit": "claims/s"},
+                "peak_rss/analyzers": {"value": 100.0, "unit": "MB"}}
+    current = {"analyzer/ela/vga": {"value": 12.0, "unit": "ms"},
+               "analyzer/exif/vga": {"value": 0.03, "unit": "ms"},
+               "chain/scores/claims_per_s": {"value": 6.0, "unit": "claims/s"},
+               "peak_rss/analyzers": {"value": 90.0, "unit": "MB"}}
+    rows = {r["name"]: r for r in compare(current, baseline, tolerance=0.15)}
+    assert rows["analyzer/ela/vga"]["regressed"]
+    assert not rows["analyzer/exif/vga"]["regressed"]  # below the timer noise floor
+    assert not rows["chain/scores/claims_per_s"]["regressed"] and rows["chain/scores/claims_per_s"]["change"] > 0
+    assert not rows["peak_rss/analyzers"]["regressed"]
@@ -0,0 +1,26 @@
+import numpy as np
+
+from src.analysis.blocks import block_reduce, paint_blocks
+
+
+def _loop_reduce(arr, bs, fn):
+    h, w = arr.shape
+    out = []
+    for y in range(0, h, bs):
+        for x in range(0, w, bs):
+            out.append(float(fn(arr[y:min(y+bs,h), x:min(x+bs,w)])))
+    return np.array(out)
+
+
+def test_block_reduce_matches_loop_with_ragged_edges():
+    rng = np.random.default_rng(0)
+    for h, w, bs in [(37, 53, 16), (64, 64, 16), (5, 7, 16), (300, 200, 7)]:
+        arr = (rng.random((h, w)) * 255).astype(np.uint8).astype(np.float32)
+        assert np.array_equal(block_reduce(arr, bs, 'mean').ravel(), _loop_reduce(arr, bs, np.mean))
+        assert np.array_equal(block_reduce(arr, bs, 'var').ravel(), _loop_reduce(arr, bs, np.var))
+
+
+def test_paint_blocks_crops_edge_blocks():
+    plane = paint_blocks(np.array([[1, 2], [3, 4]], dtype=np.uint8), (20, 18), 16)
+    assert plane.shape == (20, 18)
+    assert plane[0, 0] == 1 and plane[0, 17] == 2 and plane[19, 0] == 3 and plane[19, 17] == 4
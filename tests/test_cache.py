@@ -0,0 +1,73 @@
+import numpy as np
+from PIL import Image
+
+from src.pipeline.cache import ResultCache, analyzer_params, cached_analyzer, fingerprint
+from src.utils.config import load_config
+
+
+def _image(seed=0):
+    return Image.fromarray((np.random.default_rng(seed).random((32, 48, 3)) * 255).astype("uint8"))
+
+
+def test_cache_hit_restores_scores_and_overlay(tmp_path):
+    cache = ResultCache(tmp_path / "c.sqlite")
+    calls = []
+
+    def analyzer(ctx):
+        calls.append(1)
+        return {"score": 0.5, "overlay": ctx.image}
+
+    run = cached_analyzer(cache, "ela", {"ela_quality": 95}, analyzer)
+    img = _image()
+    first, second = run(img), run(img.copy())
+    assert len(calls) == 1
+    assert second["score"] == first["score"]
+    assert np.array_equal(np.asarray(second["overlay"]), np.asarray(img))
+
+
+def test_fingerprint_only_tracks_each_analyzers_settings():
+    cfg = load_config()
+    before = analyzer_params(cfg)
+    cfg["analysis"]["ela_quality"] += 1
+    after = analyzer_params(cfg)
+    assert fingerprint("ela", before["ela"]) != fingerprint("ela", after["ela"])
+    for name in ("noise", "edges", "exif"):
+        assert fingerprint(name, before[name]) == fingerprint(name, after[name])
+
+
+def test_lru_eviction_respects_size_budget(tmp_path):
+    cache = ResultCache(tmp_path / "c.sqlite", max_bytes=10_000)
+    for i in range(20):
+        cache.put(f"noise:{i}:fp", {"score": i, "overlay": _image(i)})
+    assert cache.total_bytes() <= 10_000
+    assert cache.get("noise:19:fp") is not None
+    assert cache.get("noise:0:fp") is None
+    # overlays leave with their score row, and the running total matches the stored rows
+    db = cache._conn()
+    assert db.execute("SELECT COUNT(*) FROM overlays WHERE key NOT IN (SELECT key FROM scores)").fetchone()[0] == 0
+    assert cache.total_bytes() == sum(db.execute(f"SELECT SUM(size) FROM {t}").fetchone()[0]
+                                      for t in ("scores", "overlays"))
+    assert ResultCache(tmp_path / "c.sqlite", max_bytes=10_000).total_bytes() == cache.total_bytes()
+
+
+def test_scores_only_entry_is_a_miss_for_overlay_callers(tmp_path):
+    cache = ResultCache(tmp_path / "c.sqlite")
+    cache.put("edges:d:fp", {"score": 0.3, "overlay": None})
+    assert cache.get("edges:d:fp", with_overlay=False) == {"score": 0.3, "overlay": None}
+    assert cache.get("edges:d:fp") is None
+
+
+def test_similar_fingerprint_follows_side_tables(tmp_path):
+    from src.retrieval.clusters import update_clusters
+    from src.retrieval.packed_index import PackedIndex
+
+    index_path = tmp_path / "hash_index.npy"
+    PackedIndex(np.array([1, 3, 1 << 40], dtype=np.uint64), [{"path": str(i), "label": "x"} for i in range(3)]
+                ).save(index_path)
+    cfg = load_config()
+    cfg["retrieval"]["hash_index_path"] = str(index_path)
+    similar = analyzer_params(cfg)["similar"]
+    before = fingerprint("similar", similar())
+    assert fingerprint("similar", similar()) == before
+    update_clusters(index_path)
+    assert fingerprint("similar", similar()) != before
@@ -0,0 +1,50 @@
+import numpy as np
+
+import scripts.calibrate_scores as cal
+from src.utils.config import CONFIG_PATH, load_config
+
+CFG = load_config()
+
+
+def test_feature_cache_reuses_rows_until_analysis_config_changes(tmp_path, monkeypatch):
+    paths = ["data/input/sample_original.jpg", "data/input/sample_edited.jpg", "data/input/sample_original.jpg"]
+    cache = tmp_path / "features.npz"
+    X, kept, failed = cal.extract_features(paths, CFG, cache, workers=0)
+    assert X.shape == (3, len(cal.FEATURES)) and np.array_equal(X[0], X[2])
+    assert kept.tolist() == [0, 1, 2] and failed == []
+
+    # a cache hit never runs the analyzers, nor re-hashes unchanged files; only the scoring weights changed
+    monkeypatch.setattr(cal, "sha256_file", lambda *a, **k: (_ for _ in ()).throw(AssertionError("re-hashed")))
+    monkeypatch.setattr(cal, "features", lambda *a, **k: (_ for _ in ()).throw(AssertionError("re-extracted")))
+    cfg = dict(CFG, scoring=dict(CFG["scoring"], weights={"ela": 1.0}))
+    assert np.array_equal(cal.extract_features(paths, cfg, cache, workers=0)[0], X)
+
+    changed = dict(CFG, analysis=dict(CFG["analysis"], ela_threshold=31))
+    assert cal.feature_fingerprint(changed) != cal.feature_fingerprint(CFG)
+
+
+def test_unreadable_images_are_skipped_and_listed(tmp_path):
+    broken = tmp_path / "broken.jpg"
+    broken.write_bytes(b"not an image")
+    paths = [str(broken), "data/input/sample_original.jpg", str(tmp_path / "missing.jpg")]
+    X, kept, failed = cal.extract_features(paths, CFG, tmp_path / "features.npz", workers=0)
+    assert X.shape == (1, len(cal.FEATURES)) and kept.tolist() == [1]
+    assert sorted(p for p, _ in failed) == sorted([paths[0], paths[2]])
+
+
+def test_cross_validate_returns_one_auc_per_fold():
+    rng = np.random.default_rng(0)
+    y = np.repeat([0, 1], 20)
+    X = rng.normal(size=(40, 4)) + y[:, None]
+    aucs = cal.cross_validate(X, y, folds=4)
+    assert len(aucs) == 4 and min(aucs) > 0.5
+
+
+def test_save_weights_keeps_the_rest_of_config_yaml(tmp_path):
+    path = tmp_path / "config.yaml"
+    path.write_text(CONFIG_PATH.read_text())
+    weights = {"ela": 0.5, "noise": 0.125, "edges": 0.0, "exif": 1.0}
+    cal.save_weights(weights, path)
+    assert load_config(path)["scoring"]["weights"] == weights
+    before, after = CONFIG_PATH.read_text().splitlines(), path.read_text().splitlines()
+    assert len(before) == len(after) and sum(a != b for a, b in zip(before, after)) == 4
@@ -1,2 +1,121 @@
 from src.pipeline.chain import load_chain
 assert load_chain() is not None
+
+
+def test_registry_rebuilds_only_on_config_change(tmp_path):
+    import os
+    from src.pipeline.registry import ChainRegistry
+    from src.utils.config import CONFIG_PATH
+
+    cfg = tmp_path / "config.yaml"
+    cfg.write_bytes(CONFIG_PATH.read_bytes())
+    registry = ChainRegistry(cfg)
+    first = registry.get()
+    assert registry.get() is first
+
+    os.utime(cfg, ns=(0, 0))  # stamp moves, content identical
+    assert registry.get() is first
+
+    cfg.write_text(cfg.read_text().replace("top_k: 4", "top_k: 5"))
+    assert registry.get() is not first
+    assert registry.config["retrieval"]["top_k"] == 5
+
+
+def test_chain_runs_retrieval_in_parallel_stage_with_timings():
+    from src.utils.config import ROOT
+
+    result = load_chain().invoke({"image_path": str(ROOT / "data" / "input" / "sample_original.jpg")})
+    assert isinstance(result["similar"], list)
+    for branch in ("read", "ela", "noise", "edges", "exif", "similar", "total"):
+        assert result["timings"][branch] >= 0
+
+
+def test_scores_only_chain_matches_full_chain():
+    from src.utils.config import ROOT, load_config
+
+    config = dict(load_config(), cache={"enabled": False})
+    inputs = {"image_path": str(ROOT / "data" / "input" / "sample_edited.jpg")}
+    full = load_chain(config).invoke(inputs)
+    fast = load_chain(config, want_overlays=False).invoke(inputs)
+    assert fast["final_score"] == full["final_score"]
+    assert full["ela_overlay"] is not None
+    assert fast["ela_overlay"] is None and fast["noise_overlay"] is None and fast["edges_overlay"] is None
+
+
+def test_triage_decides_on_preview_or_escalates():
+    from src.utils.config import ROOT, load_config
+
+    inputs = {"image_path": str(ROOT / "data" / "input" / "sample_original.jpg")}
+    config = dict(load_config(), cache={"enabled": False})
+    full = load_chain(config, want_overlays=False).invoke(inputs)
+    assert full["stage"] == "full" and full["preview_score"] is None
+
+    cheap = dict(config, triage={"enabled": True, "preview_max_side": 128, "escalate_threshold": 2.0})
+    result = load_chain(cheap, want_overlays=False).invoke(inputs)
+    assert result["stage"] == "preview" and result["preview_score"] == result["final_score"]
+
+    assert result["similar"] == full["similar"]
+
+    strict = dict(cheap, triage=dict(cheap["triage"], escalate_threshold=0.0))
+    result = load_chain(strict, want_overlays=False).invoke(inputs)
+    assert result["stage"] == "full" and result["final_score"] == full["final_score"]
+    assert result["preview_score"] is not None and result["timings"]["preview"] >= 0
+
+    # ainvoke goes through the same flow
+    import asyncio
+    for cfg, stage in ((cheap, "preview"), (strict, "full")):
+        out = asyncio.run(load_chain(cfg, want_overlays=False).ainvoke(inputs))
+        assert out.stage == stage and out.preview_score is not None
+
+
+def test_escalated_claim_runs_retrieval_once_on_the_original(monkeypatch):
+    from src.pipeline import chain as chain_module
+    from src.utils.config import ROOT, load_config
+
+    seen, build_tools = [], chain_module.build_tools
+
+    def counting_tools(config, want_overlays):
+        tools = build_tools(config, want_overlays)
+        similar = tools["similar"].func
+        tools["similar"].func = lambda image: seen.append(image.size) or similar(image)
+        return tools
+    monkeypatch.setattr(chain_module, "build_tools", counting_tools)
+
+    config = dict(load_config(), cache={"enabled": False},
+                  triage={"enabled": True, "preview_max_side": 128, "escalate_threshold": 0.0})
+    result = load_chain(config, want_overlays=False).invoke(
+        {"image_path": str(ROOT / "data" / "input" / "sample_original.jpg")})
+    assert result["stage"] == "full" and len(seen) == 1 and max(seen[0]) > 128
+
+
+def test_ainvoke_matches_invoke_without_blocking_the_loop():
+    import asyncio
+    import pickle
+    from src.analysis.context import ImageContext
+    from src.utils.config import ROOT, load_config
+
+    path = ROOT / "data" / "input" / "sample_edited.jpg"
+    config = dict(load_config(), cache={"enabled": False})
+    chain = load_chain(config, want_overlays=False)
+    expected = chain.invoke({"image_path": str(path)})["final_score"]
+
+    async def main():
+        ticks = 0
+
+        async def ticker():
+            nonlocal ticks
+            while True:
+                await asyncio.sleep(0.001)
+                ticks += 1
+        task = asyncio.create_task(ticker())
+        results = await asyncio.gather(*[chain.ainvoke({"image_path": str(path)}) for _ in range(3)])
+        task.cancel()
+        return results, ticks
+
+    results, ticks = asyncio.run(main())
+    assert [r["final_score"] for r in results] == [expected] * 3
+    assert ticks > 0
+
+    ctx = ImageContext.open(str(path))
+    clone = pickle.loads(pickle.dumps(ctx))  # what the process executor ships
+    assert clone.data == ctx.data and clone.digest == ctx.digest
@@ -0,0 +1,57 @@
+import numpy as np
+
+from src.retrieval.clusters import ClusterTable, link_components, update_clusters
+from src.retrieval.packed_index import PackedIndex, open_index, popcount64
+
+
+def _hashes(n, seed=0):
+    rng = np.random.default_rng(seed)
+    base = rng.integers(0, 2**63, n, dtype=np.int64).astype(np.uint64)
+    # chains of near-duplicates: each copy is 1..5 bits away from the previous one
+    for i in range(0, n // 2, 5):
+        for j in range(1, 5):
+            bits = rng.choice(64, j % 5 + 1, replace=False)
+            base[n // 2 + i + j - 1] = base[i if j == 1 else n // 2 + i + j - 2] ^ np.uint64(sum(1 << int(b) for b in bits))
+    return base
+
+
+def _brute_labels(hashes, radius):
+    n = len(hashes)
+    d = popcount64(hashes[:, None] ^ hashes[None, :])
+    a, b = np.nonzero(np.triu(d <= radius, 1))
+    return link_components(n, a, b)
+
+
+def test_band_bucketing_matches_all_pairs_and_extends_incrementally():
+    hashes = _hashes(600)
+    for radius, bands in ((3, None), (6, 8), (9, 11)):
+        table = ClusterTable.build(hashes, radius, bands)
+        assert np.array_equal(table.labels, _brute_labels(hashes, radius))
+        grown = ClusterTable.build(hashes[:400], radius, bands).extend(hashes)
+        assert np.array_equal(grown.labels, table.labels)
+    assert table.sizes.max() > 1 and table.lookup(0)[0] == 0
+
+
+def test_nearest_reports_cluster_and_table_follows_appends(tmp_path):
+    path = tmp_path / "hash_index.npy"
+    hashes = _hashes(200)
+    PackedIndex(hashes[:150], [{"path": str(i), "label": "x"} for i in range(150)]).save(path)
+    assert "cluster_id" not in open_index(path).nearest(int(hashes[0]), 1)[0]
+
+    assert update_clusters(path, radius=6)[1].how == "rebuilt"
+    hit = open_index(path).nearest(int(hashes[0]), 1)[0]
+    table = ClusterTable.load(tmp_path / "hash_index.clusters.npz")
+    assert (hit["cluster_id"], hit["cluster_size"]) == table.lookup(0)
+
+    PackedIndex(hashes, [{"path": str(i), "label": "x"} for i in range(200)]).save(path)
+    assert update_clusters(path)[1].how == "extended"
+    assert update_clusters(path)[1].how == "unchanged"
+    assert np.array_equal(ClusterTable.load(tmp_path / "hash_index.clusters.npz").labels, _brute_labels(hashes, 6))
+
+    # rows inserted mid-table (another shard's rows) only link the new ones; a removed row rebuilds
+    mixed = np.concatenate([hashes[:100], _hashes(20, seed=1), hashes[100:]])
+    PackedIndex(mixed, [{"path": str(i), "label": "x"} for i in range(220)]).save(path)
+    assert update_clusters(path)[1].how == "updated"
+    assert np.array_equal(ClusterTable.load(tmp_path / "hash_index.clusters.npz").labels, _brute_labels(mixed, 6))
+    PackedIndex(mixed[1:], [{"path": str(i), "label": "x"} for i in range(219)]).save(path)
+    assert update_clusters(path)[1].how == "rebuilt"
@@ -0,0 +1,32 @@
+import io
+
+import numpy as np
+from PIL import Image, ImageChops, ImageEnhance
+
+from src.analysis.context import ImageContext
+from src.analysis.ela import compute_ela
+
+
+def _image():
+    rng = np.random.default_rng(1)
+    base = np.repeat(np.repeat(rng.integers(0, 255, (20, 24, 3)), 8, 0), 8, 1)
+    return Image.fromarray((base + rng.normal(0, 6, base.shape)).clip(0, 255).astype("uint8"))
+
+
+def test_ela_matches_pil_reference():
+    img = _image()
+    for quality, threshold in [(95, 30), (75, 10), (50, 254)]:
+        buf = io.BytesIO()
+        img.save(buf, format="JPEG", quality=quality)
+        reference = ImageEnhance.Brightness(ImageChops.difference(img, Image.open(buf))).enhance(20)
+        result = compute_ela(ImageContext(img), quality, threshold)
+        assert result["score"] == float((np.asarray(reference.convert("L")) > threshold).mean())
+        assert np.array_equal(np.asarray(result["overlay"]), np.asarray(reference))
+
+
+def test_multi_quality_and_cv2_backend():
+    ctx = ImageContext(_image())
+    multi = compute_ela(ctx, [95, 80], want_overlays=False)
+    assert multi["score"] == compute_ela(ctx, 95)["score"]
+    assert multi["by_quality"] == {"95": multi["score"], "80": compute_ela(ctx, 80)["score"]}
+    assert abs(compute_ela(ctx, 95, backend="cv2")["score"] - multi["score"]) < 0.05
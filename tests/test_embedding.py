@@ -0,0 +1,71 @@
+from pathlib import Path
+
+import numpy as np
+from PIL import Image, ImageEnhance
+
+from src.retrieval import embedding
+from src.retrieval.build_index import build_index
+from src.retrieval.embedding import DIM, EmbeddingIndex, embed_image, update_embeddings
+from src.retrieval.packed_index import PackedIndex, open_index
+from src.retrieval.simple_hash import nearest
+
+
+def test_ivf_search_matches_exact_scan_when_every_list_is_probed():
+    rng = np.random.default_rng(0)
+    x = rng.gamma(0.5, 1.0, (2000, DIM)).astype(np.float32)
+    x /= np.linalg.norm(x, axis=1, keepdims=True)
+    ivf = EmbeddingIndex.from_vectors(x, np.arange(2000), np.zeros(2000, dtype=np.uint64), nlist=20)
+    assert ivf.nlist == 20 and ivf.offsets[-1] == 2000 and ivf.vectors.dtype == np.float16
+    q = x[7]
+    rows, dist = ivf.search(q, top_k=5, nprobe=20)
+    exact = 1 - x.astype(np.float16).astype(np.float32) @ q
+    assert rows.tolist() == np.lexsort((np.arange(2000), exact))[:5].tolist() and rows[0] == 7
+    assert np.allclose(dist, exact[rows], atol=1e-3)
+
+
+def test_embed_backend_finds_rephotographed_copy_and_follows_appends(tmp_path, samples, sample_db, sample_index):
+    db, index_path = sample_index(samples[:4])
+    assert update_embeddings(index_path, workers=1)[1].how == "rebuilt"
+
+    img = Image.open(samples[2]).convert("RGB")
+    w, h = img.size
+    # shot again: slightly rotated, tighter framing, brighter
+    shot = ImageEnhance.Brightness(img.rotate(4, resample=Image.BILINEAR)).enhance(1.15)
+    shot = shot.crop((w // 20, h // 20, w - w // 20, h - h // 20)).resize((640, 480))
+    assert abs(np.linalg.norm(embed_image(shot)) - 1) < 1e-5
+    hit = nearest(shot, str(index_path), top_k=1, backend="embed")[0]
+    assert Path(hit["path"]).name == samples[2].name and hit["distance"] < 0.1
+    # the Hamming cutoff does not apply to cosine distances; the embed backend has its own
+    assert nearest(shot, str(index_path), top_k=1, max_distance=0, backend="embed") == [hit]
+    assert nearest(shot, str(index_path), top_k=1, backend="embed", embed_max_distance=hit["distance"] / 2) == []
+
+    sample_db(samples[4:])
+    build_index(str(db), str(index_path), workers=1)
+    index = open_index(index_path)
+    assert index.embeddings is not None and sorted(index.embeddings.ids.tolist()) == list(range(len(samples)))
+    assert update_embeddings(index_path)[1].how == "unchanged"
+
+
+def test_embedding_update_embeds_only_changed_rows_and_reports_failures(tmp_path, monkeypatch, samples, sample_index):
+    db, index_path = sample_index(samples[:4])
+    update_embeddings(index_path, workers=1)
+
+    embedded = []
+    monkeypatch.setattr(embedding, "embed_image", lambda path: embedded.append(path) or embed_image(path))
+    (db / samples[0].name).unlink()
+    Image.open(samples[1]).transpose(Image.FLIP_LEFT_RIGHT).save(db / samples[1].name)
+    data = (db / samples[3].name).read_bytes()
+    build_index(str(db), str(index_path), workers=1)
+    assert [Path(p).name for p in embedded] == [samples[1].name]
+    table = open_index(index_path).embeddings
+    entries = PackedIndex.load(index_path).entries
+    for row, vector in zip(table.ids, table.vectors):
+        assert np.allclose(vector, embed_image(entries[row]["path"]), atol=1e-3)
+
+    (db / samples[3].name).write_bytes(b"not an image")
+    table, report = update_embeddings(index_path, nlist=1, workers=1)
+    assert report.how == "rebuilt" and [Path(p).name for p, _ in report.failed] == [samples[3].name]
+    assert table.failed.sum() == 1 and len(table.ids) == len(table) - 1
+    (db / samples[3].name).write_bytes(data)
+    table, report = update_embeddings(index_path, workers=1)
+    assert (report.how, report.computed, report.failed) == ("updated", 1, []) and not table.failed.any()
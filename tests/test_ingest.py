@@ -0,0 +1,77 @@
+import zipfile
+from io import BytesIO
+
+import pytest
+from PIL import Image
+
+from src.retrieval import ingest as ingest_module
+from src.retrieval.build_index import build_index
+from src.retrieval.ingest import ingest, iter_dataset, iter_folder, iter_zip, open_dataset
+from src.retrieval.packed_index import PackedIndex
+
+
+def _jpeg(color):
+    buf = BytesIO()
+    Image.new("RGB", (64, 48), color).save(buf, format="JPEG")
+    return buf.getvalue()
+
+
+def test_zip_ingest_dedups_streams_and_indexes(tmp_path):
+    archive = tmp_path / "claims.zip"
+    with zipfile.ZipFile(archive, "w") as z:
+        z.writestr("a/car.jpg", _jpeg("red"))
+        z.writestr("b/car.jpg", _jpeg("blue"))      # name collision, new content
+        z.writestr("c/copy.jpg", _jpeg("red"))      # same content as a/car.jpg
+        z.writestr("notes.txt", b"skip me")
+    db, index = tmp_path / "images", tmp_path / "index" / "hash_index.npy"
+
+    report = ingest(iter_zip(archive), db, index, workers=1)
+    assert (report.added, report.duplicates, report.indexed) == (2, 1, 2)
+    assert sorted(p.name for p in db.iterdir()) == ["car.jpg", "car_0.jpg"]
+    assert not (tmp_path / "_tmp_extract").exists()
+
+    # a second run finds everything already in the DB, and build_index has nothing left to hash
+    assert ingest(iter_zip(archive), db, index, workers=0).duplicates == 3
+    assert len(PackedIndex.load(index)) == 2
+    rebuilt = build_index(str(db), str(index), workers=1)
+    assert (rebuilt.added, rebuilt.updated, rebuilt.unchanged) == (0, 0, 2)
+
+
+def test_dataset_rows_are_encoded_and_deduped_after_encoding(tmp_path):
+    rows = [{"image": Image.new("RGB", (32, 32), "green")}, {"label": "no image"},
+            {"img": _jpeg("white")}, {"image": Image.new("RGB", (32, 32), "green")}]
+    report = ingest(iter_dataset(rows), tmp_path / "images", tmp_path / "idx.npy", workers=0)
+    assert (report.added, report.duplicates) == (2, 1)
+    assert sorted(p.name for p in (tmp_path / "images").iterdir()) == ["hf_000000.jpg", "hf_000002.jpg"]
+
+
+def test_unindexed_files_are_hashed_once(tmp_path, monkeypatch):
+    src, db = tmp_path / "src", tmp_path / "images"
+    src.mkdir()
+    for color in ("red", "blue"):
+        (src / f"{color}.jpg").write_bytes(_jpeg(color))
+    assert ingest(iter_folder(src), db, tmp_path / "idx.npy", workers=0, update_index=False).added == 2
+
+    hashed = []
+    real = ingest_module.sha256_file
+    monkeypatch.setattr(ingest_module, "sha256_file", lambda p: hashed.append(p.name) or real(p))
+    assert ingest(iter_folder(src), db, tmp_path / "idx.npy", workers=0, update_index=False).duplicates == 2
+    assert hashed == []
+    (db / "red.jpg").write_bytes(_jpeg("green"))
+    assert ingest(iter_folder(src), db, tmp_path / "idx.npy", workers=0, update_index=False).added == 1
+    assert hashed == ["red.jpg"]
+
+
+def test_open_dataset_reads_local_directories(tmp_path):
+    datasets = pytest.importorskip("datasets", exc_type=ImportError)
+    folder = tmp_path / "folder" / "train"
+    folder.mkdir(parents=True)
+    for color in ("red", "blue"):
+        Image.new("RGB", (32, 32), color).save(folder / f"{color}.jpg")
+    saved = tmp_path / "saved"
+    datasets.Dataset.from_dict({"image_bytes": [_jpeg("red"), _jpeg("blue")]}).save_to_disk(str(saved))
+
+    for source in (folder.parent, saved):
+        report = ingest(iter_dataset(open_dataset(str(source))), tmp_path / source.name, tmp_path / "idx.npy",
+                        workers=0, update_index=False)
+        assert report.added == 2
@@ -0,0 +1,35 @@
+from pathlib import Path
+
+import numpy as np
+from PIL import Image, ImageOps
+
+from src.retrieval.multi_hash import HASH_KINDS, fused_distances, multi_hash
+from src.retrieval.packed_index import PackedIndex
+from src.retrieval.simple_hash import nearest, phash_image
+
+
+def test_variant_columns_track_phash_of_transformed_image(samples):
+    img = Image.open(samples[0]).convert("RGB")
+    row = multi_hash(img)
+    assert row.dtype == np.uint64 and len(row) == len(HASH_KINDS)
+    assert int(row[0]) == phash_image(img)
+    for kind, op in (("phash_mirror", Image.FLIP_LEFT_RIGHT), ("phash_rot90", Image.ROTATE_90),
+                     ("phash_rot180", Image.ROTATE_180), ("phash_rot270", Image.ROTATE_270)):
+        assert bin(int(row[HASH_KINDS.index(kind)]) ^ phash_image(img.transpose(op))).count("1") <= 4
+
+
+def test_fused_backend_finds_mirrored_and_recoloured_copies(tmp_path, samples, sample_index):
+    db, index_path = sample_index(samples)
+    index = PackedIndex.load(index_path)
+    assert index.multi is not None and index.multi.shape == (len(samples), len(HASH_KINDS))
+
+    original = Image.open(samples[3]).convert("RGB")
+    for disguised in (ImageOps.mirror(original), ImageOps.autocontrast(original.rotate(180), cutoff=5)):
+        hit = nearest(disguised, str(index_path), top_k=1, backend="fused")[0]
+        assert Path(hit["path"]).name == samples[3].name
+
+    q = multi_hash(original)
+    rows, dist = index.fused_topk(q, top_k=5)
+    full = fused_distances(index.multi, q)
+    expected = np.lexsort((np.arange(len(full)), full))[:5]
+    assert rows.tolist() == expected.tolist() and np.allclose(dist, full[expected])
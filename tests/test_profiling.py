@@ -0,0 +1,29 @@
+from src.utils.profiling import StageMetrics, flatten, phase, profile_stage
+
+
+def test_profile_stage_splits_phases_and_compute():
+    def work(x):
+        with phase("decode"):
+            sum(range(10_000))
+        return x * 2
+
+    result, profile = profile_stage(work, 21, trace_memory=True)
+    assert result == 42
+    assert profile["decode"] > 0 and profile["compute"] >= 0 and profile["peak_mb"] >= 0
+    assert abs(profile["decode"] + profile["compute"] - profile["total"]) < 1e-9
+    assert flatten("ela", profile)["ela"] == profile["total"]
+
+    with phase("decode"):  # outside a stage: no-op
+        pass
+
+
+def test_stage_metrics_render_prometheus_histograms():
+    metrics = StageMetrics(prefix="t")
+    metrics.observe({"ela": 0.02, "ela.compute": 0.015, "ela.peak_mb": 3.0, "total": 20.0})
+    text = metrics.render()
+    assert "t_requests_total 1" in text
+    assert 't_stage_seconds_bucket{stage="ela",phase="total",le="0.025"} 1' in text
+    assert 't_stage_seconds_bucket{stage="ela",phase="total",le="0.01"} 0' in text
+    assert 't_stage_seconds_bucket{stage="total",phase="total",le="10.0"} 0' in text
+    assert 't_stage_seconds_count{stage="total",phase="total"} 1' in text
+    assert 't_stage_peak_megabytes{stage="ela"} 3.000' in text
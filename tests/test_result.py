@@ -0,0 +1,50 @@
+import json
+import pickle
+
+import numpy as np
+
+from src.pipeline.chain import aggregate_scores
+from src.pipeline.result import AnalyzerScore, ClaimResult, ExifScore, Overlay
+
+
+def _result():
+    rng = np.random.default_rng(0)
+    overlay = Overlay(array=rng.integers(0, 255, (120, 160, 3), dtype=np.uint8))
+    return ClaimResult(final_score=0.42, explanation="x", ela=AnalyzerScore(0.5, overlay),
+                       noise=AnalyzerScore(0.1), edges=AnalyzerScore(0.2),
+                       exif=ExifScore(0.3, "Photoshop", ["edited"], True),
+                       similar=[{"path": "a.jpg", "distance": 3}], timings={"total": 0.1})
+
+
+def test_serialization_round_trips():
+    result = _result()
+    assert json.loads(result.to_json())["ela"] == {"score": 0.5, "overlay": None}
+    back = ClaimResult.from_bytes(result.to_bytes())
+    assert back.to_dict() == result.to_dict()
+    assert np.array_equal(back.ela.overlay.array, result.ela.overlay.array)
+    assert ClaimResult.from_dict(result.to_dict(overlays=True)).ela.overlay.png == result.ela.overlay.png
+    assert result["ela_overlay"] is result.ela.overlay and result.get("missing", 1) == 1
+
+
+def test_extra_analyzer_fields_are_kept():
+    by_quality = {"95": 0.5, "80": 0.25}
+    result = aggregate_scores({"ela": {"score": 0.5, "overlay": None, "by_quality": by_quality},
+                               "noise": {"score": 0.1}, "edges": {"score": 0.2}, "exif": {"score": 0.0}},
+                              weights={"ela": 1, "noise": 0, "edges": 0, "exif": 0})
+    assert result.ela.extra == {"by_quality": by_quality} and result["ela"]["by_quality"] == by_quality
+    assert ClaimResult.from_bytes(result.to_bytes()).ela.extra == {"by_quality": by_quality}
+
+
+def test_shared_overlays_pickle_without_pixels():
+    result = _result()
+    expected = result.ela.overlay.array.copy()
+    payload = pickle.dumps(result.share_overlays())
+    assert len(payload) < expected.nbytes // 10
+    received = pickle.loads(payload)
+    assert np.array_equal(received.ela.overlay.array, expected)
+
+    # shared but not handed over: pickling copies the pixels and changes nothing
+    kept = Overlay(array=expected.copy()).share()
+    for _ in range(2):
+        assert np.array_equal(pickle.loads(pickle.dumps(kept)).array, expected)
+    assert kept._owned[0] and not kept._handed_over
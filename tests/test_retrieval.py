@@ -0,0 +1,112 @@
+import json
+import random
+
+import numpy as np
+
+from src.retrieval.packed_index import PackedIndex, migrate_json, open_index, popcount64
+from src.retrieval.simple_hash import hamming
+
+
+def _legacy_entries(n, seed=0):
+    rng = random.Random(seed)
+    return [{"path": f"img_{i}.jpg", "label": f"l{i % 3}", "phash": str(rng.getrandbits(64))} for i in range(n)]
+
+
+def _legacy_nearest(entries, q, top_k):
+    scored = [{"path": e["path"], "label": e["label"], "distance": hamming(q, int(e["phash"]))} for e in entries]
+    scored.sort(key=lambda x: x["distance"])
+    return scored[:top_k]
+
+
+def test_popcount_matches_python():
+    vals = [0, 1, 2**64 - 1, 0x8000000000000001, 0x0123456789ABCDEF]
+    assert popcount64(np.array(vals, dtype=np.uint64)).tolist() == [bin(v).count("1") for v in vals]
+
+
+def test_packed_index_matches_legacy_json_scan(tmp_path):
+    entries = _legacy_entries(500)
+    # duplicate hashes so ties at the top-k boundary are exercised
+    entries += [dict(e, path=e["path"] + ".dup") for e in entries[:50]]
+    legacy = tmp_path / "hash_index.json"
+    legacy.write_text(json.dumps({"entries": entries}))
+
+    packed = migrate_json(legacy)
+    index = open_index(packed)
+    assert len(index) == len(entries)
+    assert isinstance(index.hashes, np.memmap)
+    for q in [int(e["phash"]) for e in entries[:20]] + [random.Random(1).getrandbits(64)]:
+        for k in (1, 4, 60):
+            assert index.nearest(q, k) == _legacy_nearest(entries, q, k)
+
+
+def test_missing_packed_index_falls_back_to_legacy_json(tmp_path):
+    (tmp_path / "hash_index.json").write_text(json.dumps({"entries": _legacy_entries(3)}))
+    assert len(PackedIndex.load(tmp_path / "hash_index.npy")) == 3
+    assert len(PackedIndex.load(tmp_path / "nothing.npy")) == 0
+
+
+def test_mih_backend_matches_linear_scan():
+    rng = np.random.default_rng(0)
+    base = rng.integers(0, 2**63, 2000, dtype=np.int64).astype(np.uint64)
+    # plant near-duplicates of the first rows at 1..12 flipped bits
+    flips = [base[i] ^ np.uint64(sum(1 << b for b in rng.choice(64, i % 12 + 1, replace=False)))
+             for i in range(200)]
+    hashes = np.concatenate([base, np.array(flips, dtype=np.uint64)])
+    index = PackedIndex(hashes, [{"path": str(i), "label": "x"} for i in range(len(hashes))])
+    for q in [int(h) for h in hashes[:30]] + [int(rng.integers(0, 2**63))]:
+        for kwargs in ({"top_k": 4}, {"top_k": 10, "max_distance": 10}, {"top_k": 3, "max_distance": 0}):
+            for bands in (2, 4, 8):
+                assert index.nearest(q, backend="mih", bands=bands, **kwargs) == index.nearest(q, **kwargs)
+
+
+def test_build_index_is_incremental(tmp_path):
+    from PIL import Image
+    from src.retrieval.build_index import build_index
+
+    images = tmp_path / "images"
+    images.mkdir()
+    rng = np.random.default_rng(0)
+    for name in ("a_1.jpg", "b_2.png"):
+        Image.fromarray((rng.random((48, 64, 3)) * 255).astype("uint8")).save(images / name)
+    (images / "broken.jpg").write_bytes(b"not an image")
+    index_path = tmp_path / "hash_index.npy"
+
+    first = build_index(str(images), str(index_path), workers=1)
+    assert (first.added, first.updated, first.removed, len(first.failed)) == (2, 0, 0, 1)
+
+    again = build_index(str(images), str(index_path), workers=1)
+    assert (again.added, again.updated, again.unchanged) == (0, 0, 2)
+
+    (images / "a_1.jpg").unlink()
+    Image.fromarray((rng.random((48, 64, 3)) * 255).astype("uint8")).save(images / "c_3.jpg")
+    last = build_index(str(images), str(index_path), workers=1)
+    assert (last.added, last.removed, last.unchanged) == (1, 1, 1)
+    index = PackedIndex.load(index_path)
+    assert sorted(e["label"] for e in index.entries) == ["b", "c"]
+
+
+def test_save_switches_generations_in_one_step(tmp_path):
+    path = tmp_path / "hash_index.npy"
+    first = PackedIndex(np.arange(3, dtype=np.uint64), [{"path": str(i), "label": "a"} for i in range(3)],
+                        np.zeros((3, 7), dtype=np.uint64))
+    first.save(path)
+    before = PackedIndex.load(path)
+    grown = first.appended(np.array([7], dtype=np.uint64), [{"path": "3", "label": "b"}],
+                           np.ones((1, 7), dtype=np.uint64))
+    grown.save(path)
+    # a reader holding the old generation keeps consistent rows; new readers see the new one
+    assert len(before) == 3 and before.hashes.tolist() == [0, 1, 2] and before.entries[2]["path"] == "2"
+    after = PackedIndex.load(path)
+    assert after.hashes.tolist() == [0, 1, 2, 7] and after.multi[3].tolist() == [1] * 7
+    assert [e["path"] for e in after.entries] == ["0", "1", "2", "3"] and after.entries[-1]["label"] == "b"
+    meta = json.loads((tmp_path / "hash_index.meta.json").read_text())
+    gen = meta["generation"]
+    assert "entries" not in meta and sorted(p.name for p in tmp_path.glob("hash_index.g*")) == sorted(
+        [f"hash_index.{gen}.npy", f"hash_index.{gen}.multi.npy", f"hash_index.{gen}.rows.npy",
+         f"hash_index.{gen}.entries.jsonl"])
+
+    # version-2 side tables held the entries inline
+    legacy = dict(meta, version=2, entries=after.entries[:])
+    del legacy["count"]
+    (tmp_path / "hash_index.meta.json").write_text(json.dumps(legacy))
+    assert PackedIndex.load(path).entries[3] == {"path": "3", "label": "b"}
@@ -0,0 +1,116 @@
+import base64
+import json
+import os
+import threading
+import urllib.error
+import urllib.request
+
+import pytest
+
+from src.pipeline import service as service_module
+from src.pipeline.service import QueueFull, ScoringService, make_server
+from src.utils.config import ROOT
+from src.utils.pool import process_pool
+from src.utils.profiling import METRICS
+
+SAMPLE = ROOT / "data" / "input" / "sample_original.jpg"
+
+
+def _serve(service, config=None):
+    server = make_server(service, port=0, config=config)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_address[1]}"
+
+
+def _post(url, body, content_type="application/json"):
+    req = urllib.request.Request(url, data=body, headers={"Content-Type": content_type})
+    try:
+        with urllib.request.urlopen(req) as resp:
+            return resp.status, json.loads(resp.read())
+    except urllib.error.HTTPError as e:
+        return e.code, json.loads(e.read())
+
+
+@pytest.mark.parametrize("workers", [0, 1])
+def test_score_paths_and_uploads_over_http(workers):
+    service = ScoringService(workers=workers)
+    server, url = _serve(service)
+    try:
+        requests = METRICS.requests
+        status, by_path = _post(url + "/score", json.dumps({"image_path": str(SAMPLE)}).encode())
+        assert status == 200 and 0 <= by_path["final_score"] and by_path["ela"]["overlay"] is None
+        assert METRICS.requests == requests + 1
+        assert set(by_path) >= {"final_score", "explanation", "ela", "noise", "edges", "exif", "similar", "timings"}
+
+        status, upload = _post(url + "/score?overlays=1", SAMPLE.read_bytes(), "image/jpeg")
+        assert status == 200 and upload["final_score"] == by_path["final_score"]
+        assert base64.b64decode(upload["ela"]["overlay"]).startswith(b"\x89PNG")
+
+        assert _post(url + "/score", json.dumps({"image_path": "/etc/passwd"}).encode())[0] == 403
+        assert _post(url + "/score", b"not an image", "image/jpeg")[0] == 422
+        with urllib.request.urlopen(url + "/metrics") as resp:
+            assert b"claims_fraud_requests_total" in resp.read()
+    finally:
+        server.shutdown()
+        service.close()
+
+
+def test_full_queue_rejects_requests():
+    service = ScoringService(workers=0, max_queue=1)
+    service._take_worker()  # stall the dispatcher as if every worker were busy
+    try:
+        with pytest.raises(QueueFull):
+            for _ in range(3):
+                service.submit({"image_path": str(SAMPLE)})
+    finally:
+        service._free_worker()
+        service.close()
+
+
+def test_requests_waiting_for_a_worker_go_out_as_one_batch(monkeypatch):
+    batches = []
+    monkeypatch.setattr(service_module, "score_batch", lambda jobs: batches.append(len(jobs)) or [{}] * len(jobs))
+    service = ScoringService(workers=0, batch_size=2)
+    service._take_worker()
+    try:
+        futures = [service.submit({"image_path": str(SAMPLE)}) for _ in range(3)]
+        service._free_worker()
+        assert [f.result(5) for f in futures] == [{}] * 3 and batches == [2, 1]
+    finally:
+        service.close()
+
+
+def test_broken_pool_fails_its_requests_and_is_replaced():
+    service = ScoringService(workers=1)
+    service.pool.shutdown()
+    service.pool = process_pool(1)
+    service.pool.submit(os._exit, 1).exception()  # the worker dies and breaks the pool
+    server, url = _serve(service)
+    try:
+        body = json.dumps({"image_path": str(SAMPLE)}).encode()
+        status, result = _post(url + "/score", body)
+        assert status == 500 and "BrokenProcessPool" in result["error"]
+        assert _post(url + "/score", body)[0] == 200
+    finally:
+        server.shutdown()
+        service.close()
+
+
+def test_image_paths_escaping_the_allowed_roots_are_refused(tmp_path):
+    root = tmp_path / "root"
+    root.mkdir()
+    (root / "inside.jpg").symlink_to(SAMPLE)
+    (tmp_path / "linked").symlink_to(root)
+    service = ScoringService(workers=0)
+    server, url = _serve(service, {"service": {"allowed_roots": [str(tmp_path / "linked")]}})
+    try:
+        def status(path):
+            return _post(url + "/score", json.dumps({"image_path": str(path)}).encode())[0]
+
+        linked = tmp_path / "linked"
+        assert status(str(linked) + "/../../../../../../etc/hostname") == 403
+        assert status(linked / "inside.jpg") == 403   # a symlink out of the root
+        assert status(root / "missing.jpg") == 404    # the root itself is compared resolved
+    finally:
+        server.shutdown()
+        service.close()
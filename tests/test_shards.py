@@ -0,0 +1,80 @@
+import shutil
+from pathlib import Path
+
+from PIL import Image
+
+from src.retrieval.build_index import build_index
+from src.retrieval.ingest import ingest, iter_folder
+from src.retrieval.packed_index import meta_path
+from src.retrieval.shards import Manifest, build_shards, open_sharded, update_shard_clusters
+from src.retrieval.simple_hash import nearest
+
+
+def test_sharded_nearest_matches_single_index(tmp_path, samples, sample_db):
+    db = sample_db(samples)
+    single = tmp_path / "hash_index.npy"
+    build_index(str(db), str(single), workers=1)
+    for by in ("prefix", "label"):
+        manifest_path = tmp_path / by / "manifest.json"
+        report = build_shards(db, manifest_path, by=by, bits=2, workers=1)
+        assert report.added == len(samples)
+        manifest = Manifest.load(manifest_path)
+        assert len(manifest.shards) > 1 and len(open_sharded(manifest_path)) == len(samples)
+
+        for backend in ("linear", "mih", "fused"):
+            query = Image.open(samples[3]).convert("RGB").resize((320, 240))
+            hits = nearest(query, str(manifest_path), top_k=5, backend=backend)
+            expect = nearest(query, str(single), top_k=5, backend=backend)
+            assert [h["distance"] for h in hits] == [h["distance"] for h in expect]
+            assert Path(hits[0]["path"]).name == samples[3].name and hits[0]["shard"] in manifest.shards
+            # prefix shards farther than max_distance from the query are skipped
+            close = nearest(query, str(manifest_path), top_k=5, max_distance=12, backend=backend)
+            assert [h["distance"] for h in close] == [
+                h["distance"] for h in nearest(query, str(single), top_k=5, max_distance=12, backend=backend)]
+
+
+def test_rebuild_touches_only_changed_shard_and_ingest_appends(tmp_path, samples, sample_db):
+    db = sample_db(samples[:6])
+    manifest_path = tmp_path / "shards" / "manifest.json"
+    build_index(str(db), str(manifest_path), workers=1)
+    manifest = Manifest.load(manifest_path)
+    stamps = {n: meta_path(manifest.shard_path(n)).stat().st_mtime_ns for n in manifest.shards}
+    assert build_shards(db, manifest_path, workers=1).total == 6
+
+    sharded = open_sharded(manifest_path)
+    touched = next(n for n in sharded.names
+                   if any(Path(e["path"]).name == samples[0].name for e in sharded.shard(n).entries))
+    (db / samples[0].name).unlink()
+    assert build_shards(db, manifest_path, workers=1).removed == 1
+    for n in Manifest.load(manifest_path).shards:
+        assert (meta_path(manifest.shard_path(n)).stat().st_mtime_ns == stamps[n]) == (n != touched)
+
+    extra = sample_db(samples[6:] + samples[:1], tmp_path / "new")
+    report = ingest(iter_folder(extra), db, manifest_path, workers=0)
+    assert report.added == report.indexed == 3
+    assert len(open_sharded(manifest_path)) == 8 and len(list(open_sharded(manifest_path).entries())) == 8
+    assert ingest(iter_folder(extra), db, manifest_path, workers=0).duplicates == 3
+    hit = nearest(str(samples[7]), str(manifest_path), top_k=1)[0]
+    assert hit["distance"] == 0
+
+
+def test_clusters_span_shards(tmp_path, samples, sample_db):
+    # the same photo under three labels lands in three label shards
+    db = sample_db(samples[:4])
+    shutil.copy(samples[0], db / "copy_a.jpg")
+    manifest_path = tmp_path / "shards" / "manifest.json"
+    build_shards(db, manifest_path, by="label", workers=1)
+    assert update_shard_clusters(manifest_path, radius=6)[1].how == "rebuilt"
+
+    hits = nearest(str(samples[0]), str(manifest_path), top_k=2)
+    assert len({h["shard"] for h in hits}) == 2 and len({h["cluster_id"] for h in hits}) == 1
+    assert hits[0]["cluster_size"] == 2
+
+    # re-encoded copies (new content, same pHash); "another" lands between existing shards
+    extra = sample_db([], tmp_path / "new")
+    for name, quality in (("another_b.jpg", 80), ("copy_c.jpg", 70)):
+        Image.open(samples[0]).save(extra / name, quality=quality)
+    assert ingest(iter_folder(extra), db, manifest_path, workers=0).added == 2
+    hits = nearest(str(samples[0]), str(manifest_path), top_k=4)
+    assert len({h["cluster_id"] for h in hits}) == 1 and hits[0]["cluster_size"] == 4
+    assert not list(manifest_path.parent.glob("label_*.clusters.npz"))
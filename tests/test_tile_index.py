@@ -0,0 +1,80 @@
+from pathlib import Path
+
+import numpy as np
+from PIL import Image
+
+from src.retrieval.build_index import build_index
+from src.retrieval.mih import MultiIndexHash
+from src.retrieval import tile_index
+from src.retrieval.packed_index import PackedIndex, open_index, popcount64
+from src.retrieval.simple_hash import nearest, phash_image
+from src.retrieval.tile_index import TileIndex, tile_hashes, update_tiles
+
+
+def test_tile_hashes_match_phash_on_whole_square_tile(samples):
+    img = Image.open(samples[0]).convert("RGB")
+    square = img.crop((0, 0, min(img.size), min(img.size)))
+    hashes, boxes = tile_hashes(square, scales=[1.0])
+    assert len(hashes) == 1 and int(hashes[0]) == phash_image(square)
+    assert boxes.tolist() == [[0, 0, min(img.size)]]
+
+    hashes, boxes = tile_hashes(img, scales=[0.5, 0.25])
+    assert hashes.dtype == np.uint64 and boxes.shape == (len(hashes), 3)
+    assert (boxes[:, :2] >= 0).all() and (boxes[:, :2] + boxes[:, 2:] <= np.array(img.size)).all()
+
+
+def test_radius_many_matches_brute_force():
+    rng = np.random.default_rng(0)
+    hashes = rng.integers(0, 2**63, 3000, dtype=np.int64).astype(np.uint64)
+    queries = hashes[:50] ^ np.uint64(0b101101)
+    qpos, rows, dist = MultiIndexHash(hashes, 4).radius_many(queries, 9)
+    found = set(zip(qpos.tolist(), rows.tolist()))
+    d = popcount64(queries[:, None] ^ hashes[None, :])
+    assert found == set(zip(*map(np.ndarray.tolist, np.nonzero(d <= 9))))
+    assert (dist == d[qpos, rows]).all()
+
+
+def test_tiles_backend_finds_cropped_source_and_follows_appends(tmp_path, samples, sample_db, sample_index):
+    db, index_path = sample_index(samples[:4])
+    assert update_tiles(index_path, workers=1)[1].how == "rebuilt"
+
+    img = Image.open(samples[0]).convert("RGB")
+    w, h = img.size
+    crop = img.crop((0, 0, int(0.75 * w), int(0.75 * h))).resize((900, int(900 * h / w)))
+    assert phash_image(crop) != phash_image(img)
+    hit = nearest(crop, str(index_path), top_k=1, backend="tiles")[0]
+    assert Path(hit["path"]).name == samples[0].name and hit["votes"] >= 2
+    assert len(hit["box"]) == len(hit["query_box"]) == 3
+
+    # ingestion / build_index keep an existing tile table in step with the index
+    sample_db(samples[4:])
+    build_index(str(db), str(index_path), workers=1)
+    index = open_index(index_path)
+    assert index.tiles is not None and len(index.tiles) == len(samples)
+    assert update_tiles(index_path)[1].how == "unchanged"
+
+
+def test_tile_update_retiles_only_changed_rows_and_reports_failures(tmp_path, monkeypatch, samples, sample_index):
+    db, index_path = sample_index(samples[:4])
+    update_tiles(index_path, workers=1)
+
+    tiled = []
+    monkeypatch.setattr(tile_index, "tile_hashes", lambda path, *a, **k: tiled.append(path) or tile_hashes(path, *a, **k))
+    (db / samples[1].name).unlink()
+    Image.open(samples[2]).transpose(Image.FLIP_LEFT_RIGHT).save(db / samples[2].name)
+    build_index(str(db), str(index_path), workers=1)
+    assert [Path(p).name for p in tiled] == [samples[2].name]
+    table = open_index(index_path).tiles
+    fresh = TileIndex.build(PackedIndex.load(index_path), table.scales, workers=1)
+    for name in ("hashes", "rows", "boxes"):
+        assert np.array_equal(getattr(table, name), getattr(fresh, name))
+
+    # an image that can't be read is reported, has no tiles and is retried on the next update
+    data = (db / samples[3].name).read_bytes()
+    (db / samples[3].name).write_bytes(b"not an image")
+    table, report = update_tiles(index_path, scales=[0.5], workers=1)
+    assert report.how == "rebuilt" and [Path(p).name for p, _ in report.failed] == [samples[3].name]
+    assert table.failed.sum() == 1 and not np.isin(np.flatnonzero(table.failed), table.rows).any()
+    (db / samples[3].name).write_bytes(data)
+    table, report = update_tiles(index_path, workers=1)
+    assert (report.how, report.computed, report.failed) == ("updated", 1, []) and not table.failed.any()
@@ -0,0 +1,27 @@
+import numpy as np
+import pytest
+from PIL import Image
+
+from src.analysis.context import ImageContext
+from src.analysis.edges import edge_inconsistency
+from src.analysis.ela import compute_ela
+from src.analysis.noise import block_noise_score
+from src.analysis.tiles import iter_strips, strip_rows
+
+
+def test_strip_rows_respects_alignment_and_budget():
+    assert strip_rows(1000, 800, 5, None, 16) == 800
+    assert strip_rows(1000, 800, 5, 10**9, 16) == 800
+    rows = strip_rows(1000, 800, 5, 200_000, 16)
+    assert rows % 16 == 0 and rows * 1000 * 5 <= 200_000
+    assert list(iter_strips(40, 16, halo=1)) == [(0, 16, 0, 17), (16, 32, 15, 33), (32, 40, 31, 40)]
+
+
+@pytest.mark.parametrize("analyzer", [compute_ela, block_noise_score, edge_inconsistency])
+def test_tiled_analysis_is_identical(analyzer):
+    rng = np.random.default_rng(0)
+    img = Image.fromarray((rng.random((203, 157, 3)) * 255).astype("uint8"))
+    full = analyzer(ImageContext(img))
+    tiled = analyzer(ImageContext(img), max_bytes=1)  # one aligned band per strip
+    assert tiled["score"] == full["score"]
+    assert np.array_equal(np.asarray(tiled["overlay"]), np.asarray(full["overlay"]))